@@ -0,0 +1,226 @@
+import os
+import io
+import stat
+import tarfile
+import threading
+from log import get_logger
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+PREFETCH_FILE_SIZE = 512 * 1024  # Files up to this size are read ahead in parallel, larger ones streamed in turn
+PREFETCH_FILES = 64  # Entries read ahead, or extracted files waiting to be written
+IO_WORKERS = 8
+PIPE_BUFFER_SIZE = 256 * 1024
+
+logger = get_logger(__name__)
+
+
+def _tree_entries(root):
+    """
+    Yield (path, archive name) for root's subdirectories, files and symlinks, parents before their contents.
+    """
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        relative_directory = os.path.relpath(directory, root).replace(os.sep, "/")
+        prefix = "" if relative_directory == "." else relative_directory + "/"
+        for name in subdirectories + sorted(files):
+            yield os.path.join(directory, name), prefix + name
+
+
+def _read_entry(path, name):
+    """
+    The tar header of an entry and, for small files, their contents; None for types tar cannot hold.
+    Owner names are left out, they are not restored on extraction anyway.
+    """
+    stat_result = os.lstat(path)
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(stat_result.st_mode)
+    info.mtime = int(stat_result.st_mtime)
+    info.uid, info.gid = stat_result.st_uid, stat_result.st_gid
+    data = None
+    if stat.S_ISREG(stat_result.st_mode):
+        info.size = stat_result.st_size
+        if info.size <= PREFETCH_FILE_SIZE:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Written as read, in case the file changed since it was listed
+            info.size = len(data)
+    elif stat.S_ISDIR(stat_result.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(stat_result.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+    else:
+        return None
+    return info, data
+
+
+def write_tree(root, fileobj, workers=IO_WORKERS):
+    """
+    Write the tree below root as an uncompressed tar stream to fileobj.
+    Entries are written in order while the ones after the current one are stat'ed, and small files read,
+    by a pool of threads, so many small files do not each wait for their own read. Unreadable entries are left out.
+    Returns the number of entries written.
+    """
+    queued = deque()
+    count = 0
+    entries = _tree_entries(root)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tar-read") as executor, \
+            tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+
+        def fill():
+            for path, name in entries:
+                queued.append((path, executor.submit(_read_entry, path, name)))
+                if len(queued) >= PREFETCH_FILES:
+                    return
+
+        fill()
+        while queued:
+            path, read = queued.popleft()
+            try:
+                entry = read.result()
+                if entry is None:
+                    pass  # Sockets and other types tar cannot hold
+                elif entry[1] is not None:
+                    tar.addfile(entry[0], io.BytesIO(entry[1]))
+                    count += 1
+                elif entry[0].isreg():
+                    with open(path, "rb") as f:
+                        tar.addfile(entry[0], f)
+                    count += 1
+                else:
+                    tar.addfile(entry[0])
+                    count += 1
+            except OSError as e:
+                if isinstance(e, BrokenPipeError):
+                    raise
+                logger.warning("Skipping %s: %s", path, e)
+            fill()
+    return count
+
+
+def tree_stream(root, workers=IO_WORKERS):
+    """
+    A readable binary stream of the tar archive of root, written by a background thread as it is read.
+    Closing the stream early stops the writer.
+    """
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, "rb", buffering=PIPE_BUFFER_SIZE)
+    writer = os.fdopen(write_fd, "wb", buffering=PIPE_BUFFER_SIZE)
+
+    def write():
+        try:
+            with writer:
+                write_tree(root, writer, workers)
+        except BrokenPipeError:
+            pass  # The reader went away
+        except Exception as e:
+            logger.exception("Archiving %s failed: %s", root, e)
+
+    threading.Thread(target=write, daemon=True, name="tar-write").start()
+    return reader
+
+
+def _write_file(path, data, member):
+    with open(path, "wb") as f:
+        f.write(data)
+    # Permissions as tarfile's "data" filter sets them
+    mode = member.mode & 0o755
+    if not mode & 0o100:
+        mode &= ~0o111
+    os.chmod(path, mode | 0o600)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def _file_path(destination, name, checked_directories):
+    """
+    Where a regular file member is written, None if it has to go through tarfile's own checks.
+    Its directory is resolved once, instead of every member's path as tarfile's "data" filter does.
+    """
+    if os.path.isabs(name) or ".." in name.split("/"):
+        return None
+    path = os.path.join(destination, name)
+    directory = os.path.dirname(path)
+    if directory not in checked_directories:
+        real_directory = os.path.realpath(directory)
+        if real_directory != destination and not real_directory.startswith(destination + os.sep):
+            return None
+        os.makedirs(directory, exist_ok=True)
+        checked_directories.add(directory)
+    if os.path.islink(path):
+        os.remove(path)  # Not written through a symlink placed by an earlier member
+    return path
+
+
+def extract_tree(fileobj, destination, workers=IO_WORKERS):
+    """
+    Extract a tar stream into destination as it is read, refusing members that would land outside of it.
+    Small files are written by a pool of threads while the following members are read.
+    Returns the number of entries extracted.
+    """
+    destination = os.path.realpath(destination)
+    os.makedirs(destination, exist_ok=True)
+    count = 0
+    writes = deque()
+    checked_directories = set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tar-write") as executor, \
+            tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            path = None
+            if member.isreg() and member.size <= PREFETCH_FILE_SIZE:
+                path = _file_path(destination, member.name, checked_directories)
+            if path:
+                writes.append(executor.submit(_write_file, path, tar.extractfile(member).read(), member))
+                while len(writes) >= PREFETCH_FILES:
+                    writes.popleft().result()
+            else:
+                tar.extract(member, destination, set_attrs=not member.isdir(), filter="data")
+                if not member.isreg():
+                    # A symlink may now stand where a checked directory was
+                    checked_directories.clear()
+            count += 1
+        for write in writes:
+            write.result()
+    return count
+
+
+class TreeExtractor:
+    """
+    File-like sink extracting the tar stream written to it into a directory while it is being received.
+    finish() waits for the extraction and returns the number of entries extracted.
+    """
+    def __init__(self, destination):
+        read_fd, write_fd = os.pipe()
+        self._writer = os.fdopen(write_fd, "wb", buffering=PIPE_BUFFER_SIZE)
+        self._count = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._extract, args=(os.fdopen(read_fd, "rb"), destination),
+                                        daemon=True, name="tar-extract")
+        self._thread.start()
+
+    def _extract(self, reader, destination):
+        try:
+            with reader:
+                self._count = extract_tree(reader, destination)
+                # Drain the end-of-archive padding so the writer never blocks
+                while reader.read(PIPE_BUFFER_SIZE):
+                    pass
+        except Exception as e:
+            self._error = e
+
+    def write(self, data):
+        try:
+            self._writer.write(data)
+        except BrokenPipeError:
+            # Extraction stopped, finish() reports why
+            pass
+
+    def finish(self):
+        try:
+            self._writer.close()
+        except BrokenPipeError:
+            pass
+        self._thread.join()
+        if self._error:
+            raise self._error
+        return self._count
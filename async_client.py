@@ -0,0 +1,285 @@
+import time
+import socket
+import select
+import asyncio
+import hashlib
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from socket_utils import Connection
+from delta import data_signature, make_data_delta
+from data.data_classes import Action
+from client import negotiate_protocol, send_request, receive_response
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_CONCURRENCY = 64
+DEFAULT_RETRIES = 1
+
+
+def parse_agent(agent):
+    """
+    Accept "host:port" strings as well as (host, port) pairs.
+    """
+    if isinstance(agent, str):
+        host, _, port = agent.rpartition(":")
+        return host, int(port)
+    host, port = agent
+    return host, int(port)
+
+
+def slave_deltas(content, base_contents, algorithm="md5"):
+    """
+    Deltas from each known previous slave.py to content, by the base's checksum, in the format upload_delta uses.
+    """
+    return {hashlib.new(algorithm, base).hexdigest(): make_data_delta(content, data_signature(base))
+            for base in base_contents}
+
+
+class RequestNotSent(ConnectionError):
+    """
+    A request failed before it was written to the agent, so it can be sent again without running twice.
+    """
+
+
+def is_dropped(connection):
+    """
+    Whether the agent closed an idle connection, which then turns readable.
+    """
+    if connection.has_buffered_data():
+        return False
+    try:
+        readable, _, _ = select.select([connection.socket], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+@dataclass
+class RolloutResult:
+    agent: tuple
+    success: bool
+    mode: str  # "unchanged", "delta", "full" or "failed"
+    seconds: float
+    message: str
+
+
+class AsyncClient:
+    """
+    asyncio client for one agent.
+
+    The protocol itself runs on a blocking socket in a worker thread (the executor), so it shares
+    all of client.py's protocol handling, while callers just await. Requests on one client are
+    sent one at a time, a per-request timeout shuts the connection down and the client has to
+    reconnect afterwards. A connection the agent closed while idle is reopened before the next request.
+    Failures before a request was written raise RequestNotSent.
+    """
+    def __init__(self, host, port, timeout=DEFAULT_TIMEOUT, executor=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+        self.connections = 0  # Opened so far, tells callers when what they learned on a connection may be stale
+        self._executor = executor
+        self._lock = asyncio.Lock()
+
+    @property
+    def connected(self):
+        return self.connection is not None
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.settimeout(None)
+        connection = Connection(sock)
+        try:
+            negotiate_protocol(connection)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    async def connect(self):
+        if not self.connection:
+            self.connection = await asyncio.wait_for(self._run(self._connect), self.timeout)
+            self.connections += 1
+        return self
+
+    async def send_action(self, action, params=None, timeout=None, blob_sink=None, on_partial=None):
+        timeout = timeout or self.timeout
+        async with self._lock:
+            if self.connection and is_dropped(self.connection):
+                self._abort(self.connection)
+            try:
+                await self.connect()
+            except TimeoutError:
+                raise
+            except OSError as e:
+                raise RequestNotSent(f"Failed to connect to {self.host}:{self.port}: {e}") from e
+            connection = self.connection
+            written = threading.Event()
+            try:
+                return await asyncio.wait_for(
+                    self._run(self._exchange, connection, written, action, params, blob_sink, on_partial), timeout)
+            except BaseException as e:
+                # The worker thread may still be blocked mid-message, the connection is unusable
+                self._abort(connection)
+                if isinstance(e, OSError) and not isinstance(e, TimeoutError) and not written.is_set():
+                    raise RequestNotSent(f"Failed to send {action} to {self.host}:{self.port}: {e}") from e
+                raise
+
+    @staticmethod
+    def _exchange(connection, written, action, params, blob_sink, on_partial):
+        send_request(connection, action, params)
+        written.set()
+        return receive_response(connection, blob_sink, on_partial)
+
+    def _abort(self, connection):
+        try:
+            connection.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.close()
+        if self.connection is connection:
+            self.connection = None
+
+    async def get_actions(self):
+        response = await self.send_action("get_actions")
+        if not response.success:
+            raise ConnectionError(f"Failed to fetch actions: {response.message}")
+        return [Action.from_dict(action) for action in response.message]
+
+    async def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+
+class ClientPool:
+    """
+    Persistent connections to many agents.
+
+    Connections are opened on first use and reopened when a request fails with a connection error before
+    it was written, retrying the request up to retries times. Requests that may have reached the agent,
+    timed out ones included, are not retried, so an action never runs twice. Each agent's get_actions result
+    is cached until its connection is reopened or its slave updated. fan_out() performs one action on many
+    agents at once, at most max_concurrency at a time, each under its own timeout.
+    """
+    def __init__(self, agents=(), max_concurrency=DEFAULT_MAX_CONCURRENCY, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES):
+        self.agents = [parse_agent(agent) for agent in agents]
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self._clients = {}
+        self._actions = {}  # Agent -> (client.connections when fetched, get_actions result)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # One thread per concurrent request, the default executor would cap the fan-out
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="pool")
+
+    def client(self, agent):
+        agent = parse_agent(agent)
+        if agent not in self._clients:
+            self._clients[agent] = AsyncClient(*agent, timeout=self.timeout, executor=self._executor)
+        return self._clients[agent]
+
+    async def send_action(self, agent, action, params=None, timeout=None, **kwargs):
+        agent = parse_agent(agent)
+        client = self.client(agent)
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    return await client.send_action(action, params, timeout, **kwargs)
+            except RequestNotSent:
+                # Retry on a fresh connection, the agent may just be restarting
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+
+    async def get_actions(self, agent):
+        agent = parse_agent(agent)
+        client = self.client(agent)
+        cached = self._actions.get(agent)
+        if cached is None or cached[0] != client.connections:
+            async with self._semaphore:
+                actions = await client.get_actions()
+            # Stale once the client opens another connection, whichever request reopened it
+            cached = self._actions[agent] = (client.connections, actions)
+        return cached[1]
+
+    async def update_slave(self, agent, content, deltas=None, algorithm="md5", timeout=None):
+        """
+        Bring an agent's slave.py to content, returning the update mode and the last response.
+        Agents already running it are left alone, agents running the base of one of deltas
+        (see slave_deltas) get only that delta, and the others, or a failed delta, get the full file.
+        """
+        agent = parse_agent(agent)
+        checksum = hashlib.new(algorithm, content).hexdigest()
+        report = await self.send_action(agent, "check_slave", {"algorithm": algorithm}, timeout)
+        current = report.message.get(algorithm) if isinstance(report.message, dict) else None
+        if current == checksum:
+            return "unchanged", report
+        if current in (deltas or {}):
+            response = await self.send_action(agent, "update_slave", {
+                "delta": deltas[current], "base_checksum": current, "checksum": checksum, "algorithm": algorithm,
+            }, timeout)
+            if response.success:
+                self._actions.pop(agent, None)
+                return "delta", response
+        response = await self.send_action(agent, "update_slave", {
+            "file_data": content, "checksum": checksum, "algorithm": algorithm,
+        }, timeout)
+        if response.success:
+            # The new slave may define other actions
+            self._actions.pop(agent, None)
+        return "full", response
+
+    async def rollout(self, content, base_contents=(), agents=None, algorithm="md5", timeout=None):
+        """
+        Push a new slave.py to every agent (or the given ones) concurrently, as deltas against
+        base_contents where an agent runs one of them. Returns a RolloutResult per agent.
+        """
+        agents = [parse_agent(agent) for agent in agents] if agents is not None else self.agents
+        deltas = slave_deltas(content, base_contents, algorithm)
+
+        async def update(agent):
+            started = time.perf_counter()
+            try:
+                mode, response = await self.update_slave(agent, content, deltas, algorithm, timeout)
+                success, message = response.success, response.message
+            except Exception as e:
+                mode, success, message = "failed", False, f"{type(e).__name__}: {e}"
+            return RolloutResult(agent, success, mode, time.perf_counter() - started, str(message))
+
+        return await asyncio.gather(*(update(agent) for agent in agents))
+
+    async def fan_out(self, action, params=None, agents=None, timeout=None):
+        """
+        Perform an action on every agent (or the given ones) concurrently.
+        Returns a dict from (host, port) to the Response, or to the exception that request raised.
+        """
+        agents = [parse_agent(agent) for agent in agents] if agents is not None else self.agents
+        results = await asyncio.gather(
+            *(self.send_action(agent, action, params, timeout) for agent in agents), return_exceptions=True)
+        return dict(zip(agents, results))
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.close()
+        self._clients.clear()
+        self._actions.clear()
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
@@ -0,0 +1,83 @@
+"""
+Compare the ways copy_file copies on the agent, for many small files and for one large file:
+
+    cp        the old copy_file, os.system("cp ...") forking a shell per copy
+    native    copy_contents with the fastest method available (copy_file_range first)
+    read      copy_contents with plain reads and writes only
+
+Run from the repository root:
+    python -m benchmarks.bench_copy --files 1000 --file-size 4K --large 512M
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import slave
+from benchmarks.bench_file_transfer import parse_size
+
+
+def copy_with_cp(source, destination):
+    os.system(f"cp {source} {destination}")
+
+
+def copy_native(source, destination):
+    slave.copy_contents(source, destination)
+
+
+def copy_read(source, destination):
+    methods = slave.COPY_METHODS
+    slave.COPY_METHODS = [slave._read_write]
+    try:
+        slave.copy_contents(source, destination)
+    finally:
+        slave.COPY_METHODS = methods
+
+
+MODES = {"cp": copy_with_cp, "native": copy_native, "read": copy_read}
+
+
+def measure(copy, pairs):
+    started = time.perf_counter()
+    for source, destination in pairs:
+        copy(source, destination)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--file-size", default="4K")
+    parser.add_argument("--large", default="512M")
+    args = parser.parse_args()
+
+    file_size = parse_size(args.file_size)
+    large_size = parse_size(args.large)
+    print(f"copy methods available: {', '.join(method.__name__.lstrip('_') for method in slave.COPY_METHODS)}")
+    print(f"{'workload':>18} {'mode':>7} {'seconds':>9} {'MB/s':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        small = []
+        for index in range(args.files):
+            source = os.path.join(directory, f"small-{index}.bin")
+            with open(source, "wb") as f:
+                f.write(os.urandom(file_size))
+            small.append(source)
+        large = os.path.join(directory, "large.bin")
+        with open(large, "wb") as f:
+            for _ in range(large_size // (1024 * 1024)):
+                f.write(os.urandom(1024 * 1024))
+
+        workloads = {
+            f"{args.files} x {args.file_size}": ([(path, path + ".copy") for path in small], args.files * file_size),
+            f"1 x {args.large}": ([(large, large + ".copy")], os.path.getsize(large)),
+        }
+        for name, (pairs, size) in workloads.items():
+            for mode, copy in MODES.items():
+                elapsed = measure(copy, pairs)
+                print(f"{name:>18} {mode:>7} {elapsed:>9.2f} {size / elapsed / 1024 ** 2:>9.1f}", flush=True)
+                for _, destination in pairs:
+                    os.remove(destination)
+
+
+if __name__ == "__main__":
+    main()
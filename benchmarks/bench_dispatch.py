@@ -0,0 +1,95 @@
+"""
+Measure the per-request cost of finding an action and building its typed response,
+with the real server and slave action names and a handler that does no work:
+
+    before  linear scans of the server and slave action lists, slave response type found with inspect.stack()
+    after   ActionRegistry dict lookups, response type stamped by the registry
+
+Run from the repository root:
+    python -m benchmarks.bench_dispatch --requests 100000
+"""
+import time
+import inspect
+import argparse
+
+import server
+import slave
+from data.data_classes import Action, ActionRegistry, Response
+
+
+def legacy_dispatcher(names):
+    """
+    The list-based dispatch the registry replaced.
+    """
+    server_names = [action.name for action in server.ACTIONS]
+    actions = []
+
+    def format_message_response(is_success, message):
+        function_that_called = inspect.stack()[1].function
+        action = [action for action in actions if action.function.__name__ == function_that_called][0]
+        return Response(success=is_success, message=message, type=action.response_type)
+
+    def server_handler(_):
+        return Response(success=True, message="ok")
+
+    def handler(_):
+        return format_message_response(True, "ok")
+
+    for name in names:
+        actions.append(Action(name=name, params=[], function=server_handler if name in server_names else handler))
+    server_actions = [action for action in actions if action.name in server_names]
+    slave_actions = [action for action in actions if action.name not in server_names]
+
+    def dispatch(action_name, params):
+        for action in server_actions:
+            if action.name == action_name:
+                return action.function(params)
+        slave_action = next((action for action in slave_actions if action.name == action_name), None)
+        return slave_action.function(params)
+    return dispatch
+
+
+def registry_dispatcher(names):
+    server_names = [action.name for action in server.ACTIONS]
+    server_actions, slave_actions = ActionRegistry(), ActionRegistry()
+
+    for name in names:
+        registry = server_actions if name in server_names else slave_actions
+
+        @registry.action(name=name)
+        def handler(_):
+            return Response(success=True, message="ok")
+
+    def dispatch(action_name, params):
+        action = server_actions.get(action_name) or slave_actions.get(action_name)
+        return action.function(params)
+    return dispatch
+
+
+def measure(dispatch, action_name, requests):
+    started = time.perf_counter()
+    for _ in range(requests):
+        dispatch(action_name, {})
+    return (time.perf_counter() - started) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100000)
+    args = parser.parse_args()
+
+    names = [action.name for action in server.ACTIONS] + [action.name for action in slave.ACTIONS]
+    # The first server action is the best case of the linear scans, the last slave action the worst
+    targets = [names[0], names[-1]]
+    dispatchers = {"before": legacy_dispatcher(names), "after": registry_dispatcher(names)}
+
+    print(f"{'action':>18} {'mode':>7} {'us/request':>11}")
+    for target in targets:
+        for mode, dispatch in dispatchers.items():
+            # inspect.stack() is far slower, keep its run short
+            requests = args.requests if mode == "after" else max(1, args.requests // 100)
+            print(f"{target:>18} {mode:>7} {measure(dispatch, target, requests) * 1e6:>11.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Measure ClientPool fan-out latency across many local agents: one server per agent, all in this
+process on ephemeral ports, and one action performed on every agent per round.
+
+The first round includes connecting and negotiating, the following rounds reuse the pooled connections.
+Each row is one concurrency limit, with the cold round's time and the warm rounds' p50 and p99.
+The agents share this process (and its GIL) with the client, so real agents on other hosts fan out better.
+
+Run from the repository root:
+    python -m benchmarks.bench_fan_out --agents 100 --concurrency 1 10 100
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import contextlib
+import statistics
+
+import server
+from async_client import ClientPool
+
+
+def start_agents(count):
+    agents = []
+    for _ in range(count):
+        agent = server.Server(host="127.0.0.1", port=0, mode="asyncio", workers=2)
+        agent.bind()
+        thread = threading.Thread(target=agent.serve_forever, daemon=True)
+        thread.start()
+        agents.append((agent, thread))
+    return agents
+
+
+def stop_agents(agents):
+    for agent, _ in agents:
+        agent.shutdown()
+    for _, thread in agents:
+        thread.join()
+
+
+async def fan_out_round(pool, action, params):
+    started = time.perf_counter()
+    results = await pool.fan_out(action, params)
+    elapsed = time.perf_counter() - started
+    failures = [result for result in results.values() if isinstance(result, BaseException) or not result.success]
+    if failures:
+        raise RuntimeError(f"{len(failures)} agents failed: {failures[0]}")
+    return elapsed
+
+
+async def run(addresses, concurrency, action, params, rounds, timeout):
+    async with ClientPool(addresses, max_concurrency=concurrency, timeout=timeout) as pool:
+        cold = await fan_out_round(pool, action, params)
+        warm = [await fan_out_round(pool, action, params) for _ in range(rounds)]
+    return cold, warm
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agents", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--action", default="get_actions")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    args = parser.parse_args()
+
+    out = sys.stdout
+    print(f"{args.agents} agents, action {args.action}")
+    print(f"{'limit':>6} {'cold ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    # The servers and clients log every message, keep that out of the results
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        agents = start_agents(args.agents)
+        try:
+            addresses = [("127.0.0.1", agent.port) for agent, _ in agents]
+            for concurrency in args.concurrency:
+                cold, warm = asyncio.run(run(addresses, concurrency, args.action, {}, args.rounds, args.timeout))
+                print(f"{concurrency:>6} {cold * 1000:>9.1f} {percentile(warm, 0.5) * 1000:>9.1f} "
+                      f"{percentile(warm, 0.99) * 1000:>9.1f} {statistics.mean(warm) * 1000:>9.1f}",
+                      file=out, flush=True)
+        finally:
+            stop_agents(agents)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compare download_file throughput, CPU time and the client's frame and recv counts over loopback
+for the available transfer paths:
+
+    legacy    protocol version 1, file contents as latin-1 text inside the JSON message
+    buffered  protocol version 2 binary frames, file read and sent block by block
+    sendfile  protocol version 2 binary frames, file sent with socket.sendfile
+
+Run from the repository root:
+    python -m benchmarks.bench_file_transfer --sizes 1M 100M 1G
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+import resource
+
+import client
+import server
+import socket_utils
+from socket_utils import Connection
+
+MODES = ("legacy", "buffered", "sendfile")
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.upper()
+    if text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def make_file(directory, size):
+    path = os.path.join(directory, f"payload-{size}.bin")
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            count = min(remaining, len(block))
+            f.write(block[:count])
+            remaining -= count
+    return path
+
+
+def connect(port, mode):
+    connection = Connection(socket.create_connection(("127.0.0.1", port)))
+    if mode != "legacy":
+        client.negotiate_protocol(connection)
+    return connection
+
+
+def run_transfer(port, mode, path):
+    socket_utils.USE_SENDFILE = mode == "sendfile"
+    connection = connect(port, mode)
+    try:
+        with open(os.devnull, "wb") as devnull:
+            started, cpu_started = time.perf_counter(), cpu_time()
+            response = client.send_action(connection, "download_file", {"file_path": path},
+                                          blob_sink=lambda field, header: devnull)
+            elapsed, cpu_used = time.perf_counter() - started, cpu_time() - cpu_started
+    finally:
+        connection.close()
+    if not response.success:
+        raise RuntimeError(response.message)
+    return elapsed, cpu_used, connection.counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["1M", "100M", "1G"])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--legacy-max-size", default="100M",
+                        help="Skip the legacy path above this size, it needs several times the file size in memory")
+    args = parser.parse_args()
+
+    legacy_max_size = parse_size(args.legacy_max_size)
+    out = sys.stdout
+    bench_server = server.Server(host="127.0.0.1", port=0)
+    bench_server.bind()
+    server_thread = threading.Thread(target=bench_server.serve_forever, daemon=True)
+
+    print(f"{'size':>8} {'mode':>9} {'MB/s':>9} {'wall s':>8} {'cpu s':>8} {'frames':>8} {'recvs':>8}")
+    # The server and client log every message, keep that out of the results
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        server_thread.start()
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                for size_text in args.sizes:
+                    size = parse_size(size_text)
+                    path = make_file(directory, size)
+                    for mode in args.modes:
+                        if mode == "legacy" and size > legacy_max_size:
+                            print(f"{size_text:>8} {mode:>9} {'skipped':>9}", file=out)
+                            continue
+                        results = [run_transfer(bench_server.port, mode, path) for _ in range(args.repeat)]
+                        elapsed, cpu_used, counters = min(results, key=lambda result: result[0])
+                        print(f"{size_text:>8} {mode:>9} {size / elapsed / 1024 ** 2:>9.1f} "
+                              f"{elapsed:>8.3f} {cpu_used:>8.3f} {counters.frames_received:>8} "
+                              f"{counters.recv_calls:>8}", file=out, flush=True)
+                    os.remove(path)
+        finally:
+            bench_server.shutdown()
+            server_thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Measure update_slave hot reloads while clients keep sending slave actions.
+
+A copy of slave.py in a temporary directory is updated repeatedly, to a new patch version each time,
+while worker connections send list_directory requests back to back. Reports the update round trip,
+how many requests failed, and the request latency around the swaps.
+
+Run from the repository root:
+    python -m benchmarks.bench_hot_reload --updates 20 --clients 8
+"""
+import os
+import re
+import sys
+import time
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+
+import client
+import server
+from socket_utils import Connection
+
+
+def connect(port):
+    connection = Connection(socket.create_connection(("127.0.0.1", port)))
+    client.negotiate_protocol(connection)
+    return connection
+
+
+def with_patch_version(source, patch):
+    return re.sub(rb"SLAVE_PATCH_VERSION = \d+", b"SLAVE_PATCH_VERSION = %d" % patch, source)
+
+
+def load(port, directory, stop, results):
+    connection = connect(port)
+    try:
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                response = client.send_action(connection, "list_directory", {"directory": directory})
+                success = response.success
+            except Exception:
+                success = False
+            results.append((time.perf_counter() - started, success))
+    finally:
+        connection.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--interval", type=float, default=0.1, help="Seconds between updates")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    with open(os.path.join(os.path.dirname(os.path.abspath(server.__file__)), "slave.py"), "rb") as f:
+        source = f.read()
+    # The servers and clients log every message, keep that out of the results
+    with tempfile.TemporaryDirectory() as directory, \
+            open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        server.SLAVE_FILE_NAME = os.path.join(directory, "slave.py")
+        with open(server.SLAVE_FILE_NAME, "wb") as f:
+            f.write(source)
+        bench_server = server.Server(host="127.0.0.1", port=0, workers=args.clients + 4)
+        bench_server.bind()
+        server_thread = threading.Thread(target=bench_server.serve_forever, daemon=True)
+        server_thread.start()
+
+        stop = threading.Event()
+        results = []
+        workers = [threading.Thread(target=load, args=(bench_server.port, directory, stop, results))
+                   for _ in range(args.clients)]
+        updater = connect(bench_server.port)
+        update_times, failed_updates = [], 0
+        try:
+            for worker in workers:
+                worker.start()
+            time.sleep(args.interval)
+            for update in range(args.updates):
+                content = with_patch_version(source, update + 1)
+                started = time.perf_counter()
+                response = client.send_action(updater, "update_slave", {
+                    "file_data": content, "checksum": hashlib.md5(content).hexdigest()})
+                update_times.append(time.perf_counter() - started)
+                if not response.success or not response.message.endswith(f".{update + 1}"):
+                    failed_updates += 1
+                time.sleep(args.interval)
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+            updater.close()
+            bench_server.shutdown()
+            server_thread.join()
+
+    latencies = [latency for latency, _ in results]
+    failures = sum(1 for _, success in results if not success)
+    print(f"updates        {len(update_times)} ({failed_updates} failed)", file=out)
+    print(f"reload ms      p50 {percentile(update_times, 0.5) * 1000:.1f}  max {max(update_times) * 1000:.1f}",
+          file=out)
+    print(f"requests       {len(results)} ({failures} failed)", file=out)
+    print(f"request ms     p50 {percentile(latencies, 0.5) * 1000:.2f}  p99 {percentile(latencies, 0.99) * 1000:.2f}"
+          f"  max {max(latencies) * 1000:.2f}", file=out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+Load test the server the way operators use it: the server runs in its own process on an ephemeral port,
+concurrent client processes send it a mix of actions back to back for a fixed time, and every scenario
+reports throughput, p50/p99 latency and the peak RSS of the server and of the largest client.
+
+Actions:
+    control   check_slave without a checksum, a small request and response
+    list      list_directory of a directory of --list-entries files
+    download  download_file of a --file-sizes file, written to disk
+    upload    upload_file of a --file-sizes file
+    command   run_command of "echo ok"
+
+A mix is one action, weighted actions such as control=8,download=1 or "mixed" for MIXED_WEIGHTS.
+Scenarios are every mix with every client count, and mixes with transfers once per file size.
+Results are saved with --output as JSON, and --compare prints the change against an earlier run.
+
+Run from the repository root:
+    python -m benchmarks.bench_load --clients 1 8 --mixes control list download upload --file-sizes 1K 1M 100M \\
+        --duration 10 --output before.json
+    python -m benchmarks.bench_load ... --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import resource
+import threading
+import subprocess
+import multiprocessing
+
+import client
+import server
+from socket_utils import Connection
+from benchmarks.bench_file_transfer import parse_size, make_file
+from benchmarks.bench_hot_reload import percentile
+
+ACTIONS = ("control", "list", "download", "upload", "command")
+TRANSFER_ACTIONS = ("download", "upload")
+MIXED_WEIGHTS = {"control": 4, "list": 2, "download": 1, "upload": 1, "command": 1}
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_START_TIMEOUT = 30
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes.
+    """
+    # Linux's ru_maxrss carries over the RSS of the parent at fork across exec, VmHWM is this program's own
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maximum = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maximum if sys.platform == "darwin" else maximum * 1024  # Bytes on macOS, KiB elsewhere
+
+
+def parse_mix(text):
+    if text == "mixed":
+        return dict(MIXED_WEIGHTS)
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"Unknown action {name}, expected one of {', '.join(ACTIONS)}")
+        weights[name] = int(weight or 1)
+    return weights
+
+
+# Server process
+
+def serve(args):
+    """
+    Run a server on an ephemeral port until stdin closes, reporting the port when listening
+    and the peak RSS when stopped, one JSON line each on stdout.
+    """
+    bench_server = server.Server(host="127.0.0.1", port=0, mode=args.mode, workers=args.workers,
+                                 max_connections=args.workers)
+    bench_server.bind()
+
+    def stop_on_eof():
+        sys.stdin.read()
+        bench_server.shutdown()
+
+    threading.Thread(target=stop_on_eof, daemon=True).start()
+    print(json.dumps({"port": bench_server.port}), flush=True)
+    bench_server.serve_forever()
+    print(json.dumps({"peak_rss": peak_rss()}), flush=True)
+
+
+def start_server(mode, workers):
+    process = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_load", "--serve", "--mode", mode,
+                                "--workers", str(workers)],
+                               cwd=REPOSITORY_ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    started = json.loads(process.stdout.readline() or "{}")
+    if "port" not in started:
+        process.kill()
+        raise RuntimeError("Server process failed to start")
+    return process, started["port"]
+
+
+def stop_server(process):
+    process.stdin.close()  # The server's signal to stop
+    try:
+        process.wait(timeout=SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        return None
+    stopped = process.stdout.read().strip()
+    return json.loads(stopped.splitlines()[-1]).get("peak_rss") if stopped else None
+
+
+def connect(port):
+    connection = Connection(socket.create_connection(("127.0.0.1", port)))
+    client.negotiate_protocol(connection)
+    return connection
+
+
+def server_stats(port):
+    """
+    The server's own per-action p50 and p99 for every request phase, from get_stats.
+    """
+    connection = connect(port)
+    try:
+        response = client.send_action(connection, "get_stats")
+    finally:
+        connection.close()
+    if not response.success:
+        return None
+    return {action: {phase: {"p50": histogram["p50"], "p99": histogram["p99"]}
+                     for phase, histogram in stats["latency"].items()}
+            for action, stats in response.message["actions"].items()}
+
+
+# Client processes
+
+def make_operations(connection, workload, index):
+    download_path = os.path.join(workload["directory"], "downloads", f"client-{index}.bin")
+    upload_path = os.path.join(workload["directory"], "uploads", f"client-{index}.bin")
+    payload = workload["payload"]
+
+    def download():
+        return client.download_file(connection, payload, download_path)
+
+    def upload():
+        return client.upload_file(connection, payload, upload_path)
+
+    return {
+        "control": lambda: client.send_action(connection, "check_slave"),
+        "list": lambda: client.send_action(connection, "list_directory", {"directory": workload["listing"]}),
+        "download": download,
+        "upload": upload,
+        "command": lambda: client.send_action(connection, "run_command", {"command": "echo ok"}),
+    }
+
+
+def run_client(workload, index, barrier, results):
+    """
+    Send the mix's actions back to back for the workload's duration, once every client is ready,
+    and put the (action, seconds, success) of each request on results along with this process's peak RSS.
+    """
+    try:
+        results.put(_run_client(workload, index, barrier))
+    except Exception as e:
+        barrier.abort()  # Releases the other clients instead of leaving them waiting for this one
+        results.put({"error": f"Client {index}: {e!r}"})
+
+
+def _run_client(workload, index, barrier):
+    rng = random.Random(workload["seed"] + index)
+    names, weights = zip(*workload["mix"].items())
+    connection = connect(workload["port"])
+    try:
+        operations = make_operations(connection, workload, index)
+        for _ in range(workload["warmup"]):
+            operations[rng.choices(names, weights)[0]]()
+        barrier.wait()
+        records = []
+        started = time.perf_counter()
+        deadline = started + workload["duration"]
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            request_started = time.perf_counter()
+            try:
+                success = operations[name]().success
+            except Exception:
+                success = False
+            records.append((name, time.perf_counter() - request_started, success))
+        elapsed = time.perf_counter() - started
+    finally:
+        connection.close()
+    return {"records": records, "elapsed": elapsed, "peak_rss": peak_rss()}
+
+
+def latency_summary(latencies):
+    return {"count": len(latencies), "p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+            "max": max(latencies)}
+
+
+def run_scenario(args, name, mix, clients, file_size, payload, listing, directory):
+    process, port = start_server(args.mode, max(server.DEFAULT_WORKERS, clients + 4))
+    context = multiprocessing.get_context("spawn")  # Clients start clean, their RSS is their own
+    barrier = context.Barrier(clients)
+    results = context.Queue()
+    workload = {"port": port, "mix": mix, "seed": args.seed, "duration": args.duration, "warmup": args.warmup,
+                "payload": payload, "listing": listing, "directory": directory}
+    workers = [context.Process(target=run_client, args=(workload, index, barrier, results))
+               for index in range(clients)]
+    try:
+        for worker in workers:
+            worker.start()
+        reports = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        stats = server_stats(port)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.kill()
+        server_peak_rss = stop_server(process)
+    errors = [report["error"] for report in reports if "error" in report]
+    if errors:
+        raise RuntimeError("; ".join(errors))
+
+    records = [record for report in reports for record in report["records"]]
+    elapsed = max(report["elapsed"] for report in reports)
+    transfers = sum(1 for action, _, success in records if action in TRANSFER_ACTIONS and success)
+    by_action = {}
+    for action, latency, _ in records:
+        by_action.setdefault(action, []).append(latency)
+    return {
+        "name": name,
+        "mix": mix,
+        "clients": clients,
+        "file_size": file_size,
+        "requests": len(records),
+        "failures": sum(1 for _, _, success in records if not success),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": len(records) / elapsed,
+        "transfer_bytes_per_second": transfers * (file_size or 0) / elapsed,
+        "latency": latency_summary([latency for _, latency, _ in records]),
+        "actions": {action: latency_summary(latencies) for action, latencies in sorted(by_action.items())},
+        "client_peak_rss": max(report["peak_rss"] for report in reports),
+        "server_peak_rss": server_peak_rss,
+        "server_stats": stats,
+    }
+
+
+def scenarios(args):
+    for mix_text in args.mixes:
+        mix = parse_mix(mix_text)
+        sizes = args.file_sizes if any(action in TRANSFER_ACTIONS for action in mix) else [None]
+        for clients in args.clients:
+            for size_text in sizes:
+                name = f"{mix_text} clients={clients}" + (f" size={size_text}" if size_text else "")
+                yield name, mix, clients, size_text
+
+
+def print_result(result, previous=None):
+    latency = result["latency"]
+    line = (f"{result['name']:<40} {result['requests_per_second']:>10.1f} {latency['p50'] * 1000:>9.2f} "
+            f"{latency['p99'] * 1000:>9.2f} {result['transfer_bytes_per_second'] / 1024 ** 2:>8.1f} "
+            f"{result['server_peak_rss'] / 1024 ** 2 if result['server_peak_rss'] else 0:>9.1f} "
+            f"{result['client_peak_rss'] / 1024 ** 2:>9.1f} {result['failures']:>6}")
+    if previous:
+        change = result["requests_per_second"] / previous["requests_per_second"] - 1
+        p99_change = latency["p99"] / previous["latency"]["p99"] - 1
+        line += f"   req/s {change:+.1%} p99 {p99_change:+.1%}"
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--mixes", nargs="+", default=["control", "list", "download", "upload", "command", "mixed"],
+                        help=f"Actions ({', '.join(ACTIONS)}), weighted as name=weight,..., or mixed")
+    parser.add_argument("--file-sizes", nargs="+", default=["1K", "1M"])
+    parser.add_argument("--list-entries", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=5, help="Seconds each scenario runs")
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured requests per client first")
+    parser.add_argument("--mode", choices=server.CONCURRENCY_MODES, default="thread")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workers", type=int, default=server.DEFAULT_WORKERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args)
+    for mix_text in args.mixes:
+        try:
+            parse_mix(mix_text)
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {result["name"]: result for result in json.load(f)["scenarios"]}
+    run = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("output", "compare", "serve", "workers")},
+        "scenarios": [],
+    }
+    print(f"{'scenario':<40} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'MB/s':>8} "
+          f"{'srv MiB':>9} {'cli MiB':>9} {'failed':>6}")
+    with tempfile.TemporaryDirectory() as directory:
+        for subdirectory in ("downloads", "uploads", "listing"):
+            os.makedirs(os.path.join(directory, subdirectory))
+        listing = os.path.join(directory, "listing")
+        for index in range(args.list_entries):
+            open(os.path.join(listing, f"entry-{index}.txt"), "w").close()
+        payloads = {}
+        for name, mix, clients, size_text in scenarios(args):
+            file_size = parse_size(size_text) if size_text else None
+            if size_text and size_text not in payloads:
+                payloads[size_text] = make_file(directory, file_size)
+            result = run_scenario(args, name, mix, clients, file_size, payloads.get(size_text), listing, directory)
+            run["scenarios"].append(result)
+            print_result(result, previous.get(name))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Compare sending every frame of a mostly static screen as a whole PNG with sending only the tiles that changed,
+on synthetic frames so it runs without a display: a desktop-like noisy background with a small moving
+window and a blinking cursor. The tile diff itself is tested in tests/test_screen.py.
+
+Run from the repository root:
+    python -m benchmarks.bench_screen --frames 30 --width 1920 --height 1080
+"""
+import os
+import time
+import argparse
+
+import screen
+from screen import Frame
+
+
+def make_frames(count, width, height):
+    background = bytearray(os.urandom(width * height // 16) * 16 * 4)[:width * height * 4]
+    stride = width * 4
+    for index in range(count):
+        pixels = bytearray(background)
+        # A 200x150 window moving 8 pixels right per frame
+        left = (index * 8) % (width - 200)
+        for row in range(300, 450):
+            pixels[row * stride + left * 4:row * stride + (left + 200) * 4] = b"\xee\xee\xee\xff" * 200
+        if index % 2:
+            for row in range(600, 620):
+                pixels[row * stride + 800 * 4:row * stride + 802 * 4] = b"\0\0\0\xff" * 2
+        yield Frame(width, height, bytes(pixels))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--tile-size", type=int, default=screen.DEFAULT_TILE_SIZE)
+    args = parser.parse_args()
+
+    frames = list(make_frames(args.frames, args.width, args.height))
+    print(f"{'mode':>6} {'ms/frame':>9} {'KB/frame':>9}")
+    started = time.perf_counter()
+    sent = sum(len(screen.encode(frame)) for frame in frames)
+    elapsed = time.perf_counter() - started
+    print(f"{'full':>6} {elapsed / len(frames) * 1000:>9.1f} {sent / len(frames) / 1024:>9.1f}", flush=True)
+
+    started = time.perf_counter()
+    sent = 0
+    previous = None
+    for frame in frames:
+        for x, y, width, height in screen.changed_tiles(previous, frame, args.tile_size):
+            sent += len(screen.encode(frame.crop(x, y, width, height)))
+        previous = frame
+    elapsed = time.perf_counter() - started
+    print(f"{'tiles':>6} {elapsed / len(frames) * 1000:>9.1f} {sent / len(frames) / 1024:>9.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
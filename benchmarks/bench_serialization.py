@@ -0,0 +1,85 @@
+"""
+Measure encode + decode throughput of message headers, for a small control message and a large
+list_directory result, with every codec installed:
+
+    before   the old send path: to_json(), parsed again to stamp the protocol version and dumped again,
+             decoded with str.decode() and json.loads()
+    json     stdlib json, compact separators
+    orjson   the same JSON with orjson (if installed)
+    msgpack  binary encoding (if installed)
+
+Run from the repository root:
+    python -m benchmarks.bench_serialization --entries 10000
+"""
+import json
+import time
+import argparse
+
+import serialization
+from data.data_classes import CustomJSONEncoder, Request, Response
+
+PROTOCOL_VERSION = "2.0.0"
+
+
+class _BeforeCodec:
+    def encode(self, message):
+        message_dict = json.loads(json.dumps(message, cls=CustomJSONEncoder))
+        message_dict["protocol_version"] = PROTOCOL_VERSION
+        return json.dumps(message_dict, cls=CustomJSONEncoder).encode()
+
+    def decode(self, data):
+        return json.loads(data.decode())
+
+
+def codecs():
+    available = {"before": _BeforeCodec(), "json": serialization._JsonCodec()}
+    if serialization.orjson:
+        available["orjson"] = serialization._OrjsonCodec()
+    if serialization.msgpack:
+        available["msgpack"] = serialization._MsgpackCodec()
+    return available
+
+
+def messages(entries):
+    return {
+        "request": (Request(client_version="1.0.0", action="check_slave",
+                            params={"checksum": "d5267a70620dda25b7b64a47b42cc435"}), Request.from_json),
+        "response": (Response(success=True, message="Slave checksum matches", slave_version="1.0.0",
+                              server_version="1.0.0"), Response.from_json),
+        f"listing {entries}": (Response(success=True, message=[f"file-{index:06d}.txt" for index in range(entries)],
+                                        slave_version="1.0.0", server_version="1.0.0"), Response.from_json),
+    }
+
+
+def measure(codec, message, parse, min_seconds):
+    """
+    Encode as send_message does and decode as receive_message plus from_json do, until min_seconds pass.
+    """
+    count = 0
+    started = time.perf_counter()
+    while True:
+        message_dict = message.to_dict()
+        message_dict["protocol_version"] = PROTOCOL_VERSION
+        data = codec.encode(message_dict)
+        parse(codec.decode(data))
+        count += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return count / elapsed, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=10000, help="File names in the large listing")
+    parser.add_argument("--seconds", type=float, default=1.0, help="Minimum time per measurement")
+    args = parser.parse_args()
+
+    print(f"{'message':>15} {'codec':>8} {'msgs/s':>11} {'MB/s':>8} {'bytes':>9}")
+    for name, (message, parse) in messages(args.entries).items():
+        for codec_name, codec in codecs().items():
+            rate, size = measure(codec, message, parse, args.seconds)
+            print(f"{name:>15} {codec_name:>8} {rate:>11.0f} {rate * size / 1024 ** 2:>8.1f} {size:>9}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compare fetching a directory of many small files over loopback:
+
+    per-file  walk_directory, then one download_file request per file
+    tree      download_tree, one tar stream extracted while it is received
+    single    download_file of one file as large as all the small files together
+
+Every mode writes what it receives to disk. Run from the repository root:
+    python -m benchmarks.bench_tree_transfer --files 5000 --file-size 4K
+"""
+import os
+import sys
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+
+import client
+import server
+from socket_utils import Connection
+from benchmarks.bench_file_transfer import parse_size
+
+FILES_PER_DIRECTORY = 100
+
+
+def make_tree(directory, files, file_size):
+    for index in range(files):
+        subdirectory = os.path.join(directory, f"d{index // FILES_PER_DIRECTORY}")
+        os.makedirs(subdirectory, exist_ok=True)
+        with open(os.path.join(subdirectory, f"f{index}.bin"), "wb") as f:
+            f.write(os.urandom(file_size))
+
+
+def per_file(connection, source, destination):
+    entries = []
+    client.send_action(connection, "walk_directory", {"directory": source},
+                       on_partial=lambda response: entries.extend(response.message))
+    for entry in entries:
+        path = os.path.join(destination, entry["path"])
+        if entry["type"] == "dir":
+            os.makedirs(path, exist_ok=True)
+        elif entry["type"] == "file":
+            client.download_file(connection, os.path.join(source, entry["path"]), path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--file-size", default="4K")
+    args = parser.parse_args()
+
+    file_size = parse_size(args.file_size)
+    out = sys.stdout
+    bench_server = server.Server(host="127.0.0.1", port=0)
+    bench_server.bind()
+    server_thread = threading.Thread(target=bench_server.serve_forever, daemon=True)
+
+    print(f"{args.files} files of {args.file_size}")
+    print(f"{'mode':>9} {'seconds':>9} {'MB/s':>9}")
+    # The server and client log every message, keep that out of the results
+    with tempfile.TemporaryDirectory() as directory, \
+            open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        server_thread.start()
+        source = os.path.join(directory, "source")
+        make_tree(source, args.files, file_size)
+        single = os.path.join(directory, "source.bin")
+        with open(single, "wb") as f:
+            f.write(os.urandom(args.files * file_size))
+        connection = Connection(socket.create_connection(("127.0.0.1", bench_server.port)))
+        try:
+            client.negotiate_protocol(connection)
+            modes = {
+                "per-file": lambda destination: per_file(connection, source, destination),
+                "tree": lambda destination: client.download_tree(connection, source, destination),
+                "single": lambda destination: client.download_file(connection, single, destination + ".bin"),
+            }
+            for mode, run in modes.items():
+                destination = os.path.join(directory, mode)
+                started = time.perf_counter()
+                run(destination)
+                elapsed = time.perf_counter() - started
+                print(f"{mode:>9} {elapsed:>9.2f} {args.files * file_size / elapsed / 1024 ** 2:>9.1f}",
+                      file=out, flush=True)
+                shutil.rmtree(destination, ignore_errors=True)
+        finally:
+            connection.close()
+            bench_server.shutdown()
+            server_thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,369 @@
+import os
+import sys
 import socket
 import json
-from socket_utils import receive_message, send_message, PROTOCOL_VERSION
-from data.data_classes import Request, Response, ParamTypes, Action, Param
+import itertools
+import tempfile
+import threading
+from concurrent.futures import Future
+import log
+from log import get_logger, Payload
+from socket_utils import receive_message, send_message, Connection, negotiation_params, protocol_major
+from archive import tree_stream, TreeExtractor
+from delta import file_signature, make_file_delta, apply_file_delta
+from transfer_cache import HashingWriter, write_atomically, DELTA_MIN_SIZE, DELTA_MAX_RATIO
+from data.data_classes import Request, Response, ParamTypes, Action, Param, FileSource, StreamSource, file_bytes
 
 DEFAULT_HOST = "localhost"
 DEFAULT_PORT = 12345
 CLIENT_VERSION = "1.0.0"
+DEFAULT_MAX_IN_FLIGHT = 32
+
+logger = get_logger("client")
 
 def initialize_client(host, port):
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client.connect((host, port))
-    print("Connected to server")
+    logger.info("Connected to %s:%s", host, port)
+    client = Connection(client)
+    negotiate_protocol(client)
     return client
 
-def send_action(client, action, params=None):
-    message = Request(client_version=CLIENT_VERSION, protocol_version=PROTOCOL_VERSION, action=action, params=params or {})
-    send_message(client, message.to_json())
-    response = receive_message(client)
-    response = Response.from_json(response)
+def negotiate_protocol(client):
+    """
+    Ask the server for the newest protocol version and the frame size both sides support.
+    Servers without the "negotiate" action keep talking the legacy protocol.
+    """
+    response = send_action(client, "negotiate", negotiation_params())
+    if response.success:
+        client.apply_settings(response.message)
+    else:
+        logger.warning("Protocol negotiation failed: %s", response.message)
+    logger.info("Using protocol version %s, frame size %s", client.protocol_version, client.frame_size)
+
+def send_action(client, action, params=None, blob_sink=None, on_partial=None):
+    """
+    Perform an action and return its response.
+    Streaming actions send partial responses first, each is passed to on_partial as it arrives.
+    """
+    send_request(client, action, params)
+    return receive_response(client, blob_sink, on_partial)
+
+def send_request(client, action, params=None):
+    send_message(client, Request(client_version=CLIENT_VERSION, action=action, params=params or {}))
+
+def receive_response(client, blob_sink=None, on_partial=None):
+    """
+    Receive the response to the request sent last, passing partial responses to on_partial.
+    """
+    while True:
+        response = receive_message(client, blob_sink=blob_sink)
+        response = Response.from_json(response)
+        if not response.partial:
+            return response
+        if on_partial:
+            on_partial(response)
+
+def print_partial_response(response):
+    """
+    Print streamed command output as it arrives, stderr output to stderr.
+    Pages of entries, such as those of walk_directory, are printed one entry per line.
+    Screen frames are summarized.
+    """
+    if response.stream == "frames":
+        tiles = response.message["tiles"]
+        print(f"Frame {response.message['frame']}: {len(tiles)} changed tiles, "
+              f"{sum(len(tile['data']) for tile in tiles)} bytes", flush=True)
+        return
+    if isinstance(response.message, list):
+        for entry in response.message:
+            print(entry, flush=True)
+        return
+    print(response.message, end="", file=sys.stderr if response.stream == "stderr" else sys.stdout, flush=True)
+
+class Pipeline:
+    """
+    Send many requests on one connection without waiting for each response.
+
+    Every request gets a request ID, the server performs them concurrently and responds as each
+    finishes, so responses may arrive out of order and are matched back by ID. submit() returns
+    a Future resolving to the final Response, and blocks while max_in_flight requests are unanswered.
+    Partial responses of streaming actions are passed to the request's on_partial callback.
+    Responses are read by a background thread that only runs while requests are pending.
+    Do not use send_action on the same connection while requests are pending.
+    """
+    def __init__(self, client, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.client = client
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._reader_running = False
+
+    def submit(self, action, params=None, blob_sink=None, on_partial=None):
+        self._slots.acquire()
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, blob_sink, on_partial)
+            if not self._reader_running:
+                self._reader_running = True
+                threading.Thread(target=self._read_responses, daemon=True).start()
+        message = Request(client_version=CLIENT_VERSION, action=action, params=params or {}, request_id=request_id)
+        try:
+            send_message(self.client, message)
+        except Exception as e:
+            self._resolve(request_id, exception=e)
+        return future
+
+    def map(self, actions):
+        """
+        Perform (action, params) pairs and return their responses in the same order.
+        """
+        futures = [self.submit(action, params) for action, params in actions]
+        return [future.result() for future in futures]
+
+    def _blob_sink(self, field, header):
+        with self._lock:
+            _, blob_sink, _ = self._pending.get(header.get("request_id"), (None, None, None))
+        return blob_sink(field, header) if blob_sink else None
+
+    def _resolve(self, request_id, response=None, exception=None):
+        with self._lock:
+            future, _, _ = self._pending.pop(request_id, (None, None, None))
+        if not future:
+            return
+        self._slots.release()
+        if exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+
+    def _read_responses(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._reader_running = False
+                    return
+            try:
+                response = Response.from_json(receive_message(self.client, blob_sink=self._blob_sink))
+            except Exception as e:
+                with self._lock:
+                    request_ids = list(self._pending)
+                for request_id in request_ids:
+                    self._resolve(request_id, exception=e)
+                continue
+            if response.request_id is None:
+                logger.warning("Unexpected response without request ID: %s", Payload(response.message))
+                continue
+            if response.partial:
+                with self._lock:
+                    _, _, on_partial = self._pending.get(response.request_id, (None, None, None))
+                if on_partial:
+                    on_partial(response)
+                continue
+            self._resolve(response.request_id, response=response)
+
+def send_batch(client, entries, parallel=1, stop_on_error=False):
+    """
+    Perform many actions in one round trip. entries are (action, params) pairs.
+    Returns the batch Response, whose message is the list of one Response per entry.
+    """
+    actions = [{"action": action, "params": params or {}} for action, params in entries]
+    response = send_action(client, "batch", {
+        "actions": actions,
+        "parallel": str(parallel),
+        "stop_on_error": str(stop_on_error).lower(),
+    })
+    if isinstance(response.message, list):
+        response.message = [Response.from_json(dict(result)) for result in response.message]
     return response
 
+def open_destination(destination_path, offset=0):
+    """
+    Open the local file a file-type response is written to.
+    When resuming, the first offset bytes already received are kept.
+    """
+    if offset and os.path.exists(destination_path):
+        f = open(destination_path, "r+b")
+        f.seek(offset)
+        f.truncate()
+        return f
+    return open(destination_path, "wb")
+
+def download_file(client, file_path, destination_path, resume=False, cache=None):
+    """
+    Download a file straight to disk, optionally resuming a partial earlier download.
+    With a TransferCache, contents the destination or the cache already have are not sent again,
+    and large files that changed only as a delta against the version the client has.
+    """
+    if cache and not resume and protocol_major(client.protocol_version) >= 2:
+        return download_cached(client, file_path, destination_path, cache)
+    offset = os.path.getsize(destination_path) if resume and os.path.exists(destination_path) else 0
+    response = send_action(client, "download_file", {"file_path": file_path, "offset": str(offset)},
+                           blob_sink=lambda field, header: open_destination(destination_path, offset))
+    if response.success:
+        save_response_file(response.message, destination_path, offset)
+    return response
+
+def transfer_name(client, path):
+    """
+    What a remote file is remembered as in a TransferCache.
+    """
+    host, port = client.socket.getpeername()[:2]
+    return f"{host}:{port}:{path}"
+
+def download_cached(client, file_path, destination_path, cache):
+    """
+    download_file with a TransferCache: tell the agent the digests of the versions at hand, the destination's
+    and the one last downloaded from this path, and send the signature of one large enough for a delta.
+    """
+    name = transfer_name(client, file_path)
+    versions = {}  # Digest -> local file with those contents
+    if os.path.isfile(destination_path):
+        versions[cache.digest(destination_path)] = destination_path
+    last_digest = cache.recall(name)
+    if last_digest and last_digest not in versions and cache.has(last_digest):
+        versions[last_digest] = cache.path(last_digest)
+    params = {"file_path": file_path, "have": ",".join(versions)}
+    base = next((path for path in versions.values() if os.path.getsize(path) >= DELTA_MIN_SIZE), None)
+    if base:
+        params["signature"] = file_signature(base)
+
+    def blob_sink(field, header):
+        return open_destination(destination_path) if field == "message.file" else tempfile.TemporaryFile()
+
+    response = send_action(client, "download_file", params, blob_sink=blob_sink)
+    if not response.success or not isinstance(response.message, dict):
+        return response
+    message = response.message
+    digest = message.get("cached") or message.get("digest")
+    try:
+        if "cached" in message:
+            if versions[digest] != destination_path and not cache.restore(digest, destination_path):
+                # Evicted since it was offered
+                cache.remember(name, None)
+                return download_cached(client, file_path, destination_path, cache)
+            response.message = f"{destination_path} is up to date"
+        elif "delta" in message:
+            with message["delta"] as delta:
+                delta.seek(0)
+
+                def write(f):
+                    writer = HashingWriter(f)
+                    apply_file_delta(base, delta, writer)
+                    if writer.hexdigest() != digest:
+                        raise ValueError("Patched file does not match its digest")
+
+                write_atomically(destination_path, write)
+            response.message = f"File patched at {destination_path}"
+        else:
+            message["file"].close()
+            response.message = f"File saved successfully to {destination_path}"
+            if cache.digest(destination_path) != digest:
+                return response  # Changed while it was sent
+    except (ValueError, KeyError) as e:
+        logger.warning("Cached download of %s failed, downloading it whole: %s", file_path, e)
+        return download_file(client, file_path, destination_path)
+    cache.add(destination_path, digest)
+    cache.remember(name, digest)
+    logger.info(response.message)
+    return response
+
+def upload_file(client, file_path, destination_path, offset=0, cache=None):
+    """
+    Upload a local file, streamed from disk, optionally resuming at the given byte offset.
+    With a TransferCache contents the agent already has are not sent again, and large files it has another
+    version of only as a delta against that.
+    """
+    if cache and not offset and protocol_major(client.protocol_version) >= 2:
+        return upload_cached(client, file_path, destination_path, cache)
+    return send_action(client, "upload_file", {
+        "file_data": FileSource(file_path, offset),
+        "destination_path": destination_path,
+        "offset": str(offset),
+    })
+
+def upload_cached(client, file_path, destination_path, cache):
+    """
+    upload_file with a TransferCache: offer the digest first, then a delta if the agent sends a signature
+    of the destination's current contents, and the whole file if neither works out.
+    """
+    digest = cache.digest(file_path)
+    response = send_action(client, "upload_cached", {"destination_path": destination_path, "digest": digest})
+    if response.success:
+        response.message = f"{destination_path} is up to date"
+        return response
+    offer = response.message if isinstance(response.message, dict) else {}
+    if offer.get("signature"):
+        with tempfile.TemporaryFile() as delta:
+            make_file_delta(file_path, file_bytes(offer["signature"]), delta)
+            if delta.tell() < os.path.getsize(file_path) * DELTA_MAX_RATIO:
+                delta.seek(0)
+                response = send_action(client, "upload_delta", {
+                    "delta": StreamSource(delta),
+                    "destination_path": destination_path,
+                    "base": offer["base"],
+                    "digest": digest,
+                })
+                if response.success:
+                    return response
+                logger.warning("Delta upload of %s failed, uploading it whole: %s", file_path, response.message)
+    return send_action(client, "upload_file", {
+        "file_data": FileSource(file_path),
+        "destination_path": destination_path,
+        "offset": "0",
+        "digest": digest,
+    })
+
+def download_tree(client, directory, destination, compress=False):
+    """
+    Download a remote directory tree, extracting it into destination while it is received.
+    """
+    extractors = []
+
+    def blob_sink(field, header):
+        extractors.append(TreeExtractor(destination))
+        return extractors[-1]
+
+    response = send_action(client, "download_tree", {"directory": directory, "compress": str(compress).lower()},
+                           blob_sink=blob_sink)
+    if extractors:
+        count = extractors[0].finish()
+        response.message = f"Extracted {count} entries to {destination}"
+    return response
+
+def upload_tree(client, directory, destination, compress=False):
+    """
+    Upload a local directory tree as a tar archive streamed while it is being written.
+    compress compresses it on the way if the connection negotiated a compression.
+    """
+    return send_action(client, "upload_tree", {
+        "archive": StreamSource(tree_stream(directory), compress),
+        "destination": destination,
+    })
+
+def compression_report(client, counters_before):
+    """
+    Describe how much compression saved since the counters_before snapshot, None if nothing was compressed.
+    """
+    counters = client.counters.to_dict()
+    delta = {key: counters[key] - counters_before[key] for key in counters}
+    compressed = delta["compressed_bytes_sent"] + delta["compressed_bytes_received"]
+    if not compressed:
+        return None
+    uncompressed = delta["uncompressed_bytes_sent"] + delta["uncompressed_bytes_received"]
+    milliseconds = (delta["compression_seconds"] + delta["decompression_seconds"]) * 1000
+    return (f"Compression ({client.compression}): {uncompressed} -> {compressed} bytes, "
+            f"ratio {uncompressed / compressed:.1f}x, {milliseconds:.1f} ms")
+
 def fetch_actions(client):
     """
     Fetch the list of actions from the server and parse them into Action objects.
     """
     response = send_action(client, "get_actions")
     if not response.success:
-        print("Failed to fetch actions from server")
+        logger.error("Failed to fetch actions from server: %s", response.message)
         return []
 
     actions_data = response.message  # List of action dictionaries
@@ -40,32 +377,43 @@ def get_interactive_params(action):
     """
     params = {}
     for param in action.params:
+        if param.name == "stream":
+            # Output of streaming actions is printed as it arrives
+            params[param.name] = "true"
+            continue
+        optional = "" if param.required else " (optional)"
         if param.type == ParamTypes.FILE:
-            # For file input, read the file's content
-            file_path = input(f"Enter file path for {param.name}: ").strip()
-            try:
-                with open(file_path, "rb") as file:
-                    params[param.name] = file.read().decode("latin-1")
-            except Exception as e:
-                print(f"Error reading file {file_path}: {e}")
+            # For file input, stream the file's content from disk
+            file_path = input(f"Enter file path for {param.name}{optional}: ").strip()
+            if not file_path and not param.required:
                 continue
+            if not os.path.isfile(file_path):
+                print(f"Error reading file {file_path}: not a file")
+                continue
+            params[param.name] = FileSource(file_path)
         else:
-            value = input(f"Enter value for {param.name}: ").strip()
-            params[param.name] = value
+            value = input(f"Enter value for {param.name}{optional}: ").strip()
+            if value or param.required:
+                params[param.name] = value
+    if params.get("offset") and isinstance(params.get("file_data"), FileSource):
+        params["file_data"].offset = int(params["offset"])
     return params
 
 
-def handle_response_file(response_message):
+def save_response_file(response_message, destination_path, offset=0):
     """
-    Handle file-type response by saving it to a user-specified path.
+    Finish saving a file-type response. Streamed responses are already on disk,
+    responses received in memory (protocol version 1) are written out now.
     """
-    destination_path = input("Enter destination path to save the file: ").strip()
     try:
-        with open(destination_path, "wb") as file:
-            file.write(response_message.encode("latin-1"))
-        print(f"File saved successfully to {destination_path}")
+        if hasattr(response_message, "close"):
+            response_message.close()
+        else:
+            with open_destination(destination_path, offset) as file:
+                file.write(response_message)
+        logger.info("File saved successfully to %s", destination_path)
     except Exception as e:
-        print(f"Error saving file to {destination_path}: {e}")
+        logger.error("Error saving file to %s: %s", destination_path, e)
 
 def interactive_menu(client, actions):
     """
@@ -86,22 +434,33 @@ def interactive_menu(client, actions):
             continue
 
         params = get_interactive_params(action)
-        response = send_action(client, action.name, params)
+        blob_sink = None
+        if action.response_type == ParamTypes.FILE:
+            # Ask for the destination up front so the file can be written while it arrives
+            destination_path = input("Enter destination path to save the file: ").strip()
+            offset = int(params.get("offset") or 0)
+            blob_sink = lambda field, header: open_destination(destination_path, offset)
+        counters_before = client.counters.to_dict()
+        response = send_action(client, action.name, params, blob_sink=blob_sink, on_partial=print_partial_response)
 
         print(f"Success: {response.success}")
         if response.success:
             if action.response_type == ParamTypes.FILE:
-                handle_response_file(response.message)
+                save_response_file(response.message, destination_path, offset)
             else:
                 print(f"Message: {response.message}")
         else:
             print(f"Error: {response.message}")
+        report = compression_report(client, counters_before)
+        if report:
+            print(report)
         print(f"Slave version: {response.slave_version}")
         print(f"Server version: {response.server_version}")
 
 
 
 if __name__ == "__main__":
+    log.configure_logging()
     host = input(f"Enter host (default: {DEFAULT_HOST}): ").strip() or DEFAULT_HOST
     port = int(input(f"Enter port (default: {DEFAULT_PORT}): ").strip() or DEFAULT_PORT)
     client = initialize_client(host, port)
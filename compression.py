@@ -0,0 +1,163 @@
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+COMPRESSION_THRESHOLD = 1024  # Payloads smaller than this are always sent raw
+SAMPLE_SIZE = 64 * 1024
+MAX_SAMPLE_RATIO = 0.9  # Payloads whose sample does not shrink below this ratio are sent raw
+
+# Magic numbers of formats that are already compressed
+COMPRESSED_SIGNATURES = (
+    b"\x89PNG",  # PNG
+    b"\xff\xd8\xff",  # JPEG
+    b"GIF8",  # GIF
+    b"PK\x03\x04",  # ZIP, JAR, DOCX...
+    b"\x1f\x8b",  # GZIP
+    b"\x28\xb5\x2f\xfd",  # ZSTD
+    b"\x04\x22\x4d\x18",  # LZ4
+    b"BZh",  # BZIP2
+    b"\xfd7zXZ",  # XZ
+    b"7z\xbc\xaf",  # 7Z
+)
+
+
+class _ZlibCodec:
+    name = "zlib"
+
+    def compressor(self):
+        return zlib.compressobj(6)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class _ZstdCodec:
+    name = "zstd"
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=3).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class _Lz4Compressor:
+    def __init__(self):
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._started = False
+
+    def compress(self, data):
+        header = b""
+        if not self._started:
+            header = self._compressor.begin()
+            self._started = True
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header = b"" if self._started else self._compressor.begin()
+        return header + self._compressor.flush()
+
+
+class _Lz4Decompressor:
+    def __init__(self):
+        self._decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+class _Lz4Codec:
+    name = "lz4"
+
+    def compressor(self):
+        return _Lz4Compressor()
+
+    def decompressor(self):
+        return _Lz4Decompressor()
+
+
+# In order of preference, only the ones whose module is installed
+CODECS = {codec.name: codec for codec in (
+    _ZstdCodec() if zstandard else None,
+    _Lz4Codec() if lz4 else None,
+    _ZlibCodec(),
+) if codec}
+
+
+def get_codec(name):
+    codec = CODECS.get(name)
+    if not codec:
+        raise ValueError(f"Unsupported compression: {name}")
+    return codec
+
+
+def available_compressions():
+    return list(CODECS)
+
+
+def choose_compression(offered):
+    """
+    Pick the preferred compression out of a comma separated list offered by the peer, None if there is no common one.
+    """
+    offered = {name.strip() for name in offered.split(",")}
+    return next((name for name in CODECS if name in offered), None)
+
+
+def compress(name, data):
+    compressor = get_codec(name).compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(name, data):
+    decompressor = get_codec(name).decompressor()
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def is_worth_compressing(sample, total_size):
+    """
+    Decide from the start of a payload whether compressing all of it pays off.
+    Small payloads, known compressed formats and data whose sample does not shrink are sent raw.
+    """
+    if total_size < COMPRESSION_THRESHOLD:
+        return False
+    if sample.startswith(COMPRESSED_SIGNATURES):
+        return False
+    sample = sample[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * MAX_SAMPLE_RATIO
+
+
+class DecompressingWriter:
+    """
+    File-like sink decompressing everything written to it into another file.
+    """
+    def __init__(self, name, destination):
+        self._decompressor = get_codec(name).decompressor()
+        self.destination = destination
+        self.written = 0
+        self.seconds = 0.0
+
+    def _write(self, function, *data):
+        started = time.perf_counter()
+        output = function(*data)
+        self.seconds += time.perf_counter() - started
+        self.written += len(output)
+        self.destination.write(output)
+
+    def write(self, data):
+        self._write(self._decompressor.decompress, data)
+
+    def finish(self):
+        self._write(self._decompressor.flush)
+        return self.destination
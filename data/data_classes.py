@@ -1,27 +1,114 @@
 from dataclasses import dataclass
 from enum import Enum
 import json
+import shutil
+import functools
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Enum):
             return obj.value
+        if isinstance(obj, (bytes, bytearray)):
+            # Protocol version 1 carries file contents as latin-1 text
+            return obj.decode("latin-1")
+        if isinstance(obj, (FileSource, StreamSource)):
+            return obj.read().decode("latin-1")
         return super().default(obj)
 
+DEFAULT_ACTION_CLASS = "default"  # How actions not declaring a class are scheduled, see executor.py
+
 class ParamTypes(Enum):
     FILE = "file"
     STRING = "string"
 
 
-@dataclass
+def file_bytes(value):
+    """
+    Return the contents of a file-typed value as bytes.
+    Version 1 peers send them as latin-1 text, version 2 peers as raw bytes,
+    and large version 2 payloads may arrive spooled to a temporary file.
+    """
+    if isinstance(value, str):
+        return value.encode("latin-1")
+    if hasattr(value, "read"):
+        value.seek(0)
+        return value.read()
+    return value
+
+
+def parse_flag(value):
+    """
+    Whether a string param is set to true, such as "1", "true" or "yes".
+    """
+    return str(value).strip().lower() in ("1", "true", "yes", "y")
+
+
+def write_file_value(value, destination):
+    """
+    Write a file-typed value to an open binary file without loading spooled payloads into memory.
+    """
+    if hasattr(value, "read"):
+        value.seek(0)
+        shutil.copyfileobj(value, destination)
+    else:
+        destination.write(file_bytes(value))
+
+
+@dataclass(slots=True)
+class FileSource:
+    """
+    File contents to send, streamed from disk in blocks instead of being read into memory.
+    """
+    path: str
+    offset: int = 0
+
+    def open(self):
+        f = open(self.path, "rb")
+        f.seek(self.offset)
+        return f
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+
+@dataclass(slots=True)
+class StreamSource:
+    """
+    File contents of unknown length read from a stream, such as an archive written while it is sent.
+    The stream is closed once sent. compressible lets it be compressed on the way, since it cannot be sampled.
+    """
+    stream: object
+    compressible: bool = False
+
+    def read(self):
+        with self.stream:
+            return self.stream.read()
+
+
+# Fields newer than protocol version 1, left out of messages while unset so older peers,
+# which reject unknown fields, keep working
+OPTIONAL_FIELDS = ("request_id", "stream", "partial")
+
+
+def _without_unset(obj, optional_fields):
+    return {name: value for name in obj.__slots__
+            if (value := getattr(obj, name)) is not None or name not in optional_fields}
+
+
+@dataclass(slots=True)
 class Request:
     client_version: str
     action: str
     params: dict
     protocol_version: str = None
+    request_id: int = None  # Set by pipelining clients, echoed in the response
 
     def to_json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict(), cls=CustomJSONEncoder)
+
+    def to_dict(self):
+        return _without_unset(self, OPTIONAL_FIELDS)
 
     @staticmethod
     def from_json(json_str):
@@ -31,7 +118,7 @@ class Request:
         elif isinstance(json_str, dict):
             return Request(**json_str)
 
-@dataclass
+@dataclass(slots=True)
 class Response:
     success: bool
     message: str
@@ -39,39 +126,52 @@ class Response:
     slave_version: str = None
     server_version: str = None
     protocol_version: str = None
+    request_id: int = None
+    stream: str = None  # Output stream ("stdout" or "stderr") of a partial response
+    partial: bool = None  # Set on the incremental responses sent before a streaming action's final response
 
     def to_json(self):
-        return json.dumps(self.__dict__, cls=CustomJSONEncoder)
+        return json.dumps(self.to_dict(), cls=CustomJSONEncoder)
+
+    def to_dict(self):
+        data = _without_unset(self, OPTIONAL_FIELDS)
+        data['type'] = self.type.value
+        return data
 
     @staticmethod
     def from_json(json_str):
         if isinstance(json_str, str):
             data = json.loads(json_str)
-            data['type'] = ParamTypes(data['type']) if 'type' in data else ParamTypes.STRING
-            return Response(**data)
         elif isinstance(json_str, dict):
             data = json_str
-            data['type'] = ParamTypes(data['type']) if 'type' in data else ParamTypes.STRING
-            return Response(**data)
+        else:
+            return None
+        response_type = ParamTypes(data['type']) if 'type' in data else ParamTypes.STRING
+        message = data.get('message')
+        if response_type == ParamTypes.FILE and data.get('success') and isinstance(message, str):
+            message = file_bytes(message)
+        return Response(**{**data, 'type': response_type, 'message': message})
 
-@dataclass
+@dataclass(slots=True)
 class Param:
     name: str
     type: ParamTypes = ParamTypes.STRING
+    required: bool = True
 
     def to_dict(self):
-        return {"name": self.name, "type": self.type.value}
+        return {"name": self.name, "type": self.type.value, "required": self.required}
 
     @staticmethod
     def from_dict(data):
-        return Param(name=data['name'], type=ParamTypes(data['type']))
+        return Param(name=data['name'], type=ParamTypes(data['type']), required=data.get('required', True))
 
-@dataclass
+@dataclass(slots=True)
 class Action:
     name: str
     params: list  # List of Param objects
     response_type: ParamTypes = ParamTypes.STRING
     function: callable = None
+    action_class: str = DEFAULT_ACTION_CLASS  # Scheduling class, such as control or bulk, not sent to clients
 
     def to_dict(self):
         return {
@@ -87,3 +187,43 @@ class Action:
             params=[Param.from_dict(param) for param in data['params']],
             response_type=ParamTypes(data['response_type']),
         )
+
+class ActionRegistry:
+    """
+    Actions indexed by name, in the order they were registered.
+    Functions are registered with the action() decorator, which also stamps the action's response type
+    on every Response the function returns, so the functions do not have to look it up themselves.
+    """
+    def __init__(self):
+        self._actions = {}
+
+    def register(self, action):
+        if action.name in self._actions:
+            raise ValueError(f"Action {action.name} is already registered")
+        self._actions[action.name] = action
+        return action
+
+    def action(self, name=None, params=(), response_type=ParamTypes.STRING, action_class=DEFAULT_ACTION_CLASS):
+        def decorator(function):
+            @functools.wraps(function)
+            def perform(action_params):
+                result = function(action_params)
+                if isinstance(result, Response):
+                    result.type = response_type
+                return result
+            self.register(Action(name=name or function.__name__, params=list(params),
+                                 response_type=response_type, function=perform, action_class=action_class))
+            return perform
+        return decorator
+
+    def get(self, name):
+        return self._actions.get(name)
+
+    def __contains__(self, name):
+        return name in self._actions
+
+    def __iter__(self):
+        return iter(self._actions.values())
+
+    def __len__(self):
+        return len(self._actions)
@@ -0,0 +1,224 @@
+import io
+import os
+import math
+import mmap
+import zlib
+import struct
+import hashlib
+
+DELTA_MAGIC = b"SDLT1"
+COPY = b"C"  # Followed by offset and length of a range of the old file
+INSERT = b"I"  # Followed by a length and that many new bytes
+COPY_OP = struct.Struct(">QQ")
+INSERT_OP = struct.Struct(">I")
+
+SIGNATURE_MAGIC = b"SSIG1"
+SIGNATURE_HEADER = struct.Struct(">IQ")  # Block size, size of the file
+SIGNATURE_BLOCK = struct.Struct(">I16s")  # Adler-32 and MD5 of a block
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+MAX_INSERT_SIZE = 1024 * 1024
+# Blocks rolled through byte by byte without a match before only block boundaries are tried:
+# enough to find the old blocks again after edits, without a Python step per byte of long new stretches
+ROLL_LIMIT_BLOCKS = 4
+COPY_READ_SIZE = 1024 * 1024
+ADLER_MODULUS = 65521
+
+
+def block_size_for(size):
+    # As rsync does, about the square root of the file size, so signatures stay small for large files
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, int(math.sqrt(size)) & ~7))
+
+
+def file_signature(path, block_size=None):
+    """
+    The Adler-32 and MD5 of every block of a file, for the other side to build a delta of its version against.
+    """
+    size = os.path.getsize(path)
+    block_size = block_size or block_size_for(size)
+    with open(path, "rb") as f:
+        return _signature(iter(lambda: f.read(block_size), b""), block_size, size)
+
+
+def data_signature(data, block_size=None):
+    """
+    The signature of bytes in memory, as file_signature makes of a file.
+    """
+    block_size = block_size or block_size_for(len(data))
+    view = memoryview(data)
+    return _signature((view[start:start + block_size] for start in range(0, len(data), block_size)),
+                      block_size, len(data))
+
+
+def _signature(blocks, block_size, size):
+    parts = [SIGNATURE_MAGIC, SIGNATURE_HEADER.pack(block_size, size)]
+    for block in blocks:
+        parts.append(SIGNATURE_BLOCK.pack(zlib.adler32(block), hashlib.md5(block).digest()))
+    return b"".join(parts)
+
+
+def _parse_signature(signature):
+    """
+    Return the block size, {Adler-32: {MD5: block index}} of the full blocks, and the length and MD5 of a
+    shorter last block, if any.
+    """
+    if not signature.startswith(SIGNATURE_MAGIC):
+        raise ValueError("Not a file signature")
+    try:
+        block_size, size = SIGNATURE_HEADER.unpack_from(signature, len(SIGNATURE_MAGIC))
+    except struct.error:
+        raise ValueError("Truncated signature")
+    position = len(SIGNATURE_MAGIC) + SIGNATURE_HEADER.size
+    count = -(-size // block_size) if block_size else 0
+    if not block_size or len(signature) != position + count * SIGNATURE_BLOCK.size:
+        raise ValueError("Malformed signature")
+    blocks = {}
+    tail = None
+    for index, (weak, strong) in enumerate(SIGNATURE_BLOCK.iter_unpack(signature[position:])):
+        length = min(block_size, size - index * block_size)
+        if length == block_size:
+            blocks.setdefault(weak, {}).setdefault(strong, index)
+        else:
+            tail = (index, length, strong)
+    return block_size, blocks, tail
+
+
+class _DeltaWriter:
+    """
+    Writes delta operations, merging copies of consecutive ranges.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.copy = None
+        output.write(DELTA_MAGIC)
+
+    def insert(self, data):
+        if not data:
+            return
+        self.flush()
+        for start in range(0, len(data), MAX_INSERT_SIZE):
+            chunk = data[start:start + MAX_INSERT_SIZE]
+            self.output.write(INSERT + INSERT_OP.pack(len(chunk)))
+            self.output.write(chunk)
+
+    def copy_range(self, offset, length):
+        if self.copy and self.copy[0] + self.copy[1] == offset:
+            self.copy = (self.copy[0], self.copy[1] + length)
+            return
+        self.flush()
+        self.copy = (offset, length)
+
+    def flush(self):
+        if self.copy:
+            self.output.write(COPY + COPY_OP.pack(*self.copy))
+            self.copy = None
+
+
+def make_file_delta(path, signature, output):
+    """
+    Write a delta rebuilding the file at path from the file signature describes to output, rsync style:
+    a rolling checksum finds the old blocks at any offset, the rest is inserted.
+    Raises ValueError if the signature is malformed.
+    """
+    block_size, blocks, tail = _parse_signature(signature)
+    writer = _DeltaWriter(output)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            writer.flush()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            _match_blocks(data, size, block_size, blocks, tail, writer)
+    writer.flush()
+
+
+def make_data_delta(data, signature):
+    """
+    The delta make_file_delta would write for bytes in memory, as bytes.
+    Raises ValueError if the signature is malformed.
+    """
+    block_size, blocks, tail = _parse_signature(signature)
+    output = io.BytesIO()
+    writer = _DeltaWriter(output)
+    if data:
+        _match_blocks(data, len(data), block_size, blocks, tail, writer)
+    writer.flush()
+    return output.getvalue()
+
+
+def _match_blocks(data, size, block_size, blocks, tail, writer):
+    position = literal_start = 0
+    weak = None
+    rolled = 0
+    while position + block_size <= size:
+        if weak is None:
+            weak = zlib.adler32(data[position:position + block_size])
+            a, b = weak & 0xffff, weak >> 16
+        candidates = blocks.get(weak)
+        if candidates:
+            index = candidates.get(hashlib.md5(data[position:position + block_size]).digest())
+            if index is not None:
+                writer.insert(data[literal_start:position])
+                writer.copy_range(index * block_size, block_size)
+                position += block_size
+                literal_start = position
+                weak = None
+                rolled = 0
+                continue
+        if rolled >= ROLL_LIMIT_BLOCKS * block_size:
+            # A long new stretch: only try where the next block would start
+            position += block_size
+            weak = None
+            continue
+        if position + block_size == size:
+            break
+        # Roll the Adler-32 one byte on: drop the first byte of the window, add the one after it
+        removed, added = data[position], data[position + block_size]
+        a = (a - removed + added) % ADLER_MODULUS
+        b = (b - block_size * removed + a - 1) % ADLER_MODULUS
+        weak = (b << 16) | a
+        position += 1
+        rolled += 1
+    if tail and size - literal_start >= tail[1]:
+        start = size - tail[1]
+        if hashlib.md5(data[start:size]).digest() == tail[2]:
+            writer.insert(data[literal_start:start])
+            writer.copy_range(tail[0] * block_size, tail[1])
+            literal_start = size
+    writer.insert(data[literal_start:size])
+
+
+def apply_file_delta(base_path, delta, output):
+    """
+    Write the file a delta made by make_file_delta rebuilds from the file at base_path to output,
+    reading the delta from a binary file object. Raises ValueError if it is malformed or does not fit the base.
+    """
+    if delta.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise ValueError("Not a file delta")
+    with open(base_path, "rb") as base:
+        base_size = os.fstat(base.fileno()).st_size
+        while op := delta.read(1):
+            if op == COPY:
+                offset, length = _read_op(delta, COPY_OP)
+                if offset + length > base_size:
+                    raise ValueError("Delta copies past the end of the base file")
+                base.seek(offset)
+                while length:
+                    chunk = base.read(min(length, COPY_READ_SIZE))
+                    output.write(chunk)
+                    length -= len(chunk)
+            elif op == INSERT:
+                (length,) = _read_op(delta, INSERT_OP)
+                data = delta.read(length)
+                if len(data) != length:
+                    raise ValueError("Truncated delta")
+                output.write(data)
+            else:
+                raise ValueError(f"Unknown delta operation {op!r}")
+
+
+def _read_op(delta, op_struct):
+    data = delta.read(op_struct.size)
+    if len(data) != op_struct.size:
+        raise ValueError("Truncated delta")
+    return op_struct.unpack(data)
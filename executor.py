@@ -0,0 +1,417 @@
+import os
+import time
+import inspect
+import itertools
+import threading
+import multiprocessing
+import concurrent.futures
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+
+from log import get_logger
+from data.data_classes import Response, ParamTypes, DEFAULT_ACTION_CLASS
+
+logger = get_logger(__name__)
+
+
+@dataclass(slots=True)
+class ActionClass:
+    """
+    How the actions of a class are run: at most workers of them at once, started ahead of classes with a
+    higher priority number, and given up on after timeout seconds (None waits as long as they take).
+    A timeout stops the wait, the work only stops where the action registered on_cancel or runs in a process:
+    other thread actions keep running and holding a worker of their class until they finish.
+    process classes run in worker processes, for CPU-bound actions whose params and responses can be pickled:
+    actions taking file params or streaming their output cannot run in them, see process_problem.
+    """
+    name: str
+    priority: int = 1
+    workers: int = 8
+    timeout: float = None
+    process: bool = False
+
+
+DEFAULT_ACTION_CLASSES = {action_class.name: action_class for action_class in (
+    ActionClass("control", priority=0, workers=4, timeout=30),
+    ActionClass(DEFAULT_ACTION_CLASS, priority=1, workers=16, timeout=300),
+    ActionClass("command", priority=1, workers=8, timeout=3600),
+    ActionClass("cpu", priority=1, workers=os.cpu_count() or 1, timeout=120, process=True),
+    # Transfers take as long as the data takes, the connection paces them
+    ActionClass("bulk", priority=2, workers=8),
+)}
+DEFAULT_MAX_WORKERS = 32
+# Threads kept free for the top priority classes are at most this fraction of all threads, so the other classes
+# still run side by side in a small pool
+MAX_RESERVED_FRACTION = 0.5
+
+_current = threading.local()
+
+
+class _Task:
+    __slots__ = ("action_class", "function", "args", "kwargs", "sequence", "future", "cancelled", "_callbacks",
+                 "_lock")
+
+    def __init__(self, action_class, function, args, kwargs, sequence):
+        self.action_class = action_class
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.sequence = sequence
+        self.future = concurrent.futures.Future()
+        self.cancelled = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        _current.task = self
+        try:
+            result = self.function(*self.args, **self.kwargs)
+        except BaseException as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+        finally:
+            _current.task = None
+
+    def cancel(self):
+        """
+        Drop the task if it has not started, otherwise flag it cancelled and run its on_cancel callbacks.
+        """
+        if self.future.cancel():
+            return
+        with self._lock:
+            self.cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.exception("Cancelling a %s action failed: %s", self.action_class, e)
+
+
+def on_cancel(callback):
+    """
+    Have callback called if the action running in this thread is cancelled, such as when it times out,
+    to stop whatever it is waiting for. Returns False outside of an executor, where nothing gets cancelled.
+    """
+    task = getattr(_current, "task", None)
+    if task is None:
+        return False
+    with task._lock:
+        if not task.cancelled.is_set():
+            task._callbacks.append(callback)
+            return True
+    callback()
+    return True
+
+
+def cancelled():
+    """
+    Whether the action running in this thread was cancelled, for long loops to check.
+    """
+    task = getattr(_current, "task", None)
+    return task is not None and task.cancelled.is_set()
+
+
+def top_priority_workers(classes):
+    """
+    How many actions the classes of the top priority run at once, the threads a PriorityExecutor would keep for them.
+    """
+    top = min(action_class.priority for action_class in classes.values())
+    return sum(action_class.workers for action_class in classes.values() if action_class.priority == top)
+
+
+class PriorityExecutor(concurrent.futures.Executor):
+    """
+    Thread pool running tasks by action class. Queued tasks start by priority, oldest first, and each class
+    runs at most its workers at once. Other classes leave enough threads for the classes of the top priority
+    to run their full workers, so control actions never wait behind transfers. At most MAX_RESERVED_FRACTION
+    of max_workers is kept free that way, see reserved_workers.
+    """
+    def __init__(self, classes=None, max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="action"):
+        self.classes = dict(classes or DEFAULT_ACTION_CLASSES)
+        self.max_workers = max_workers
+        self._thread_name_prefix = thread_name_prefix
+        self._condition = threading.Condition()
+        self._queues = {}  # Class name -> deque of queued tasks
+        self._running = {}  # Class name -> tasks running
+        self._threads = []
+        self._idle = 0
+        self._sequence = itertools.count()
+        self._shutdown = False
+
+    def action_class(self, name):
+        return self.classes.get(name) or self.classes[DEFAULT_ACTION_CLASS]
+
+    def schedule_task(self, class_name, function, *args, **kwargs):
+        name = self.action_class(class_name).name
+        task = _Task(name, function, args, kwargs, next(self._sequence))
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Cannot schedule new tasks after shutdown")
+            self._queues.setdefault(name, deque()).append(task)
+            queued = sum(len(tasks) for tasks in self._queues.values())
+            if queued > self._idle and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name=f"{self._thread_name_prefix}_{len(self._threads)}")
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+        return task
+
+    def schedule(self, class_name, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) as an action of the named class, returning its Future.
+        """
+        return self.schedule_task(class_name, function, *args, **kwargs).future
+
+    def submit(self, function, *args, **kwargs):
+        return self.schedule(DEFAULT_ACTION_CLASS, function, *args, **kwargs)
+
+    def reserved_workers(self):
+        """
+        The threads kept free for the classes of the top priority while none of them run.
+        """
+        return min(top_priority_workers(self.classes), int(self.max_workers * MAX_RESERVED_FRACTION))
+
+    def _can_start(self, action_class, busy):
+        if self._running.get(action_class.name, 0) >= action_class.workers:
+            return False
+        top = min(other.priority for other in self.classes.values())
+        if action_class.priority == top:
+            return True
+        free = sum(max(0, other.workers - self._running.get(other.name, 0)) for other in self.classes.values()
+                   if other.priority == top)
+        return busy + 1 + min(free, self.reserved_workers()) <= self.max_workers
+
+    def _next_task(self):
+        # Called with the condition held
+        busy = sum(self._running.values())
+        chosen = None
+        for name, tasks in self._queues.items():
+            while tasks and tasks[0].future.cancelled():
+                tasks.popleft()
+            if not tasks:
+                continue
+            action_class = self.action_class(name)
+            key = (action_class.priority, tasks[0].sequence)
+            if (chosen is None or key < chosen[0]) and self._can_start(action_class, busy):
+                chosen = (key, name)
+        if chosen is None:
+            return None
+        name = chosen[1]
+        self._running[name] = self._running.get(name, 0) + 1
+        return self._queues[name].popleft()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while (task := self._next_task()) is None:
+                    if self._shutdown and not any(self._queues.values()):
+                        return
+                    self._idle += 1
+                    self._condition.wait()
+                    self._idle -= 1
+            try:
+                task.run()
+            finally:
+                with self._condition:
+                    self._running[task.action_class] -= 1
+                    self._condition.notify_all()
+
+    def queue_depths(self):
+        """
+        Tasks queued and running per class.
+        """
+        with self._condition:
+            return {name: {"queued": sum(1 for task in self._queues.get(name, ()) if not task.future.cancelled()),
+                           "running": self._running.get(name, 0)}
+                    for name in self.classes}
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._condition:
+            self._shutdown = True
+            if cancel_futures:
+                for tasks in self._queues.values():
+                    for task in tasks:
+                        task.future.cancel()
+            self._condition.notify_all()
+        if wait:
+            for thread in list(self._threads):
+                thread.join()
+
+
+def _profiled(profile, function, *args):
+    if profile is None:
+        return function(*args)
+    try:
+        profile.enable()
+    except ValueError:  # Profilers that see every thread are active already
+        return function(*args)
+    try:
+        return function(*args)
+    finally:
+        profile.disable()
+
+
+def process_problem(action):
+    """
+    Why an Action cannot run in a worker process, None if it can. Its params and response are pickled,
+    which the spooled files of file params cannot be.
+    """
+    if any(param.type == ParamTypes.FILE for param in action.params):
+        return f"Action {action.name} takes files, which cannot be sent to a worker process"
+    return None
+
+
+def _run_in_process(name, function, params):
+    result = function(params)
+    if inspect.isgenerator(result):
+        result.close()
+        return Response(success=False, message=f"Action {name} streams its output, which a worker process cannot")
+    return result
+
+
+def _kill_pool(pool):
+    # ProcessPoolExecutor cannot cancel a call once it runs, so the pool's processes are killed instead
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ActionExecutor:
+    """
+    Runs action functions by their class, on a PriorityExecutor's threads or in worker processes,
+    and waits for them up to the class's timeout. An action that times out is cancelled: dropped if it
+    has not started, otherwise its on_cancel callbacks run, or its worker processes are killed. A thread
+    action without on_cancel keeps its worker until it returns, it is counted as abandoned until then.
+
+    Streaming actions return their generator right away, their output is produced and paced while it is sent.
+    Actions can be moved to another class by name through assignments.
+    """
+    def __init__(self, classes=None, max_workers=DEFAULT_MAX_WORKERS, assignments=None):
+        self.assignments = dict(assignments or {})
+        self._threads = PriorityExecutor(classes, max_workers, "action")
+        self._pools = {}  # Class name -> ProcessPoolExecutor, started on first use
+        self._lock = threading.Lock()
+        self._timed_out = {}
+        self._abandoned = {}  # Class name -> actions still running after they timed out
+
+    @property
+    def classes(self):
+        return self._threads.classes
+
+    def configure(self, classes=None, max_workers=None, assignments=None):
+        """
+        Change the classes, the total number of threads or the class of actions by name, before serving.
+        """
+        if classes is not None:
+            self._threads.classes = dict(classes)
+        if max_workers is not None:
+            self._threads.max_workers = max_workers
+        if assignments is not None:
+            self.assignments = dict(assignments)
+
+    def class_of(self, name, declared=DEFAULT_ACTION_CLASS):
+        """
+        The class an action runs in, the one it was assigned or else the one it was declared with.
+        """
+        return self._threads.action_class(self.assignments.get(name, declared))
+
+    def run(self, action, params, profile=None):
+        """
+        Perform an Action with params and return its result, or a failure response once its class's timeout
+        has passed. Exceptions raised by the action are raised here. profile, a cProfile.Profile the caller
+        runs under, is enabled on the thread running the action too.
+        """
+        action_class = self.class_of(action.name, action.action_class)
+        if action_class.process and (problem := process_problem(action)):
+            return Response(success=False, message=f"{problem}, it cannot run in the {action_class.name} class")
+        task = self._threads.schedule_task(action_class.name, self._call, action_class, action, params, profile)
+        try:
+            return task.future.result(timeout=action_class.timeout)
+        except concurrent.futures.TimeoutError:
+            task.cancel()
+            with self._lock:
+                self._timed_out[action_class.name] = self._timed_out.get(action_class.name, 0) + 1
+            logger.warning("Action %s timed out after %s seconds", action.name, action_class.timeout)
+            if not task.future.done():
+                self._abandon(action, action_class, task)
+            return Response(success=False, message=f"Action {action.name} timed out after "
+                                                   f"{action_class.timeout:g} seconds")
+
+    def _abandon(self, action, action_class, task):
+        # The caller has its answer, the action still holds a worker until it returns
+        timed_out_at = time.monotonic()
+        with self._lock:
+            self._abandoned[action_class.name] = self._abandoned.get(action_class.name, 0) + 1
+
+        def finished(_):
+            with self._lock:
+                self._abandoned[action_class.name] -= 1
+            logger.warning("Action %s finished %.1f seconds after it timed out", action.name,
+                           time.monotonic() - timed_out_at)
+        task.future.add_done_callback(finished)
+
+    def _call(self, action_class, action, params, profile=None):
+        if not action_class.process:
+            return _profiled(profile, action.function, params)
+        pool = self._process_pool(action_class)
+        future = pool.submit(_run_in_process, action.name, action.function, params)
+        on_cancel(lambda: self._kill_processes(action_class.name, pool))
+        return future.result()
+
+    def _process_pool(self, action_class):
+        with self._lock:
+            pool = self._pools.get(action_class.name)
+            if pool is None:
+                # Started fresh rather than forked from this multithreaded process, they import slave.py themselves
+                pool = self._pools[action_class.name] = ProcessPoolExecutor(
+                    max_workers=action_class.workers, mp_context=multiprocessing.get_context("spawn"))
+            return pool
+
+    def _kill_processes(self, class_name, pool):
+        with self._lock:
+            if self._pools.get(class_name) is pool:
+                del self._pools[class_name]
+        _kill_pool(pool)
+
+    def reload(self):
+        """
+        Retire the worker processes after the slave was updated, later calls start new ones that import it.
+        Calls running meanwhile finish on the old processes.
+        """
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.shutdown(wait=False)
+
+    def stats(self):
+        """
+        Per class: the actions queued and running, its settings, how many timed out and how many of those
+        are still running.
+        """
+        depths = self._threads.queue_depths()
+        with self._lock:
+            timed_out = dict(self._timed_out)
+            abandoned = dict(self._abandoned)
+        return {name: {**depths[name], "workers": action_class.workers, "priority": action_class.priority,
+                       "timeout": action_class.timeout, "process": action_class.process,
+                       "timed_out": timed_out.get(name, 0), "abandoned": abandoned.get(name, 0)}
+                for name, action_class in self.classes.items()}
+
+    def shutdown(self, wait=True):
+        """
+        Stop the threads and worker processes, after the actions running finish with wait. The executor stays
+        usable: later actions start new ones, as when a server is started again in the same process.
+        """
+        threads = self._threads
+        self._threads = PriorityExecutor(threads.classes, threads.max_workers, "action")
+        threads.shutdown(wait=wait, cancel_futures=True)
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.shutdown(wait=wait)
@@ -0,0 +1,160 @@
+import sys
+import json
+import queue
+import atexit
+import reprlib
+import logging
+import logging.handlers
+
+DEFAULT_LEVEL = "INFO"
+LOG_FORMATS = ("text", "json")
+MAX_PAYLOAD_LENGTH = 200  # Characters of a logged message, params or response before it is cut off
+LOG_QUEUE_SIZE = 10000  # Records waiting to be written, further ones are dropped instead of blocking a request
+# Attributes every LogRecord has, anything else was passed as extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_settings = {"log_payloads": False, "max_payload_length": MAX_PAYLOAD_LENGTH}
+_listener = None
+
+
+def get_logger(name):
+    return logging.getLogger(name)
+
+
+class _PayloadRepr(reprlib.Repr):
+    """
+    Bounded repr of messages: nested containers and strings are cut short without formatting all of them,
+    file contents are only described by their size unless payload bodies are logged.
+    """
+    def __init__(self, log_payloads, max_length):
+        super().__init__()
+        self.log_payloads = log_payloads
+        self.maxstring = self.maxother = max_length
+        self.maxlevel = 4
+        self.maxdict = self.maxlist = self.maxtuple = 20
+
+    def repr_bytes(self, value, level):
+        if not self.log_payloads:
+            return f"<{len(value)} bytes>"
+        return repr(value[:self.maxstring]) + ("..." if len(value) > self.maxstring else "")
+
+    repr_bytearray = repr_bytes
+
+    def repr_FileSource(self, value, level):
+        return f"<file {value.path}>"
+
+    def repr_StreamSource(self, value, level):
+        return "<stream>"
+
+    def repr_SpooledTemporaryFile(self, value, level):
+        return "<uploaded file>"
+
+    def repr_Request(self, value, level):
+        return self.repr1(value.to_dict(), level)
+
+    repr_Response = repr_Request
+
+
+class Payload:
+    """
+    A message, params or response to log, rendered only if the record is written, bounded in length.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = _PayloadRepr(_settings["log_payloads"], _settings["max_payload_length"]).repr(self.value)
+        limit = _settings["max_payload_length"]
+        return text if len(text) <= limit else text[:limit] + "..."
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    One line per record: time, level, logger and message followed by the record's extra fields as key=value,
+    or the same as a JSON object.
+    """
+    def __init__(self, log_format="text"):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.log_format = log_format
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+        if self.log_format == "json":
+            entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                     "message": record.getMessage(), **fields}
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            if record.exc_text:
+                entry["exception"] = record.exc_text
+            return json.dumps(entry, default=str)
+        line = super().format(record)
+        if fields:
+            first_line, _, rest = line.partition("\n")
+            line = first_line + " " + " ".join(f"{key}={value}" for key, value in fields.items())
+            line += "\n" + rest if rest else ""
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without ever waiting for it: when the queue is full they are dropped
+    and counted. Messages and fields are rendered here, so the writer does not see objects changed meanwhile.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        for key, value in vars(record).items():
+            if isinstance(value, Payload):
+                setattr(record, key, str(value))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for the writer to make room, the queue may be full when logging stops
+        self.queue.put(self._sentinel)
+
+
+def configure_logging(level=DEFAULT_LEVEL, log_format="text", log_payloads=False,
+                      max_payload_length=MAX_PAYLOAD_LENGTH, path=None):
+    """
+    Send log records through a queue to a background thread writing them to stderr, or the file at path,
+    so the threads logging never wait for the terminal or the disk. Payload bodies such as file contents are
+    only logged with log_payloads, and every payload is cut off after max_payload_length characters.
+    """
+    global _listener
+    stop_logging()
+    _settings.update(log_payloads=log_payloads, max_payload_length=max_payload_length)
+    output = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    output.setFormatter(StructuredFormatter(log_format))
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    _listener = _QueueListener(log_queue, output)
+    _listener.start()
+    return _listener
+
+
+@atexit.register
+def stop_logging():
+    """
+    Write what is still queued and stop the writer thread.
+    """
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,363 @@
+import io
+import os
+import time
+import heapq
+import pstats
+import random
+import bisect
+import cProfile
+import tempfile
+import itertools
+import threading
+import weakref
+
+# Upper bounds in seconds of the latency histogram buckets, a last one counts everything slower
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Where a request's time goes: reading it, decoding its header, waiting for a worker (pipelined requests),
+# performing the action (streamed partial responses included) and sending the final response.
+# total runs from taking the received request up to the response being sent.
+PHASES = ("receive", "decode", "queue", "action", "send", "total")
+METRIC_PREFIX = "remote_admin"
+DEFAULT_PROFILE_SAMPLE_RATE = 0.1
+PROFILE_LINES = 30  # Functions listed per recorded profile, by cumulative time
+# Actions tracked separately, requests for further names, such as mistyped ones, are counted together
+MAX_TRACKED_ACTIONS = 256
+OTHER_ACTIONS = "other"
+
+
+class Histogram:
+    """
+    Counts of observed durations per LATENCY_BUCKETS bucket, with their sum and maximum.
+    Not locked itself, Metrics updates it under its lock.
+    """
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Estimate of the q quantile, interpolated within the bucket it falls in and at most the maximum seen.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower, below = 0.0, 0
+        for bound, cumulative in zip(LATENCY_BUCKETS, itertools.accumulate(self.counts)):
+            if cumulative >= rank and cumulative > below:
+                return min(lower + (bound - lower) * (rank - below) / (cumulative - below), self.max)
+            lower, below = bound, cumulative
+        return self.max
+
+    def cumulative_counts(self):
+        return list(zip((*LATENCY_BUCKETS, "+Inf"), itertools.accumulate(self.counts)))
+
+    def to_dict(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6),
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+                "buckets": {str(bound): count for bound, count in self.cumulative_counts()}}
+
+
+class ActionStats:
+    __slots__ = ("requests", "failures", "errors", "bytes_received", "bytes_sent", "phases", "profiles")
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0  # Responded with success false
+        self.errors = 0  # Raised instead of responding
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.phases = {phase: Histogram() for phase in PHASES}
+        self.profiles = []  # Heap of (seconds, sequence, finished, cProfile.Profile), slowest kept
+
+    def to_dict(self):
+        return {"requests": self.requests, "failures": self.failures, "errors": self.errors,
+                "bytes_received": self.bytes_received, "bytes_sent": self.bytes_sent,
+                "latency": {phase: histogram.to_dict() for phase, histogram in self.phases.items() if histogram.count}}
+
+
+_profiling = threading.local()
+
+
+def _render_profile(profile):
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    return output.getvalue()
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Counters, gauges and per-action latency histograms of a server, read through snapshot() or prometheus_text().
+
+    With profile_slowest set, a sample_rate fraction of requests is run under cProfile and the profiles of the
+    slowest profile_slowest of them are kept per action, to find hot spots in a running server.
+    """
+    def __init__(self, profile_slowest=0, sample_rate=DEFAULT_PROFILE_SAMPLE_RATE):
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self.profile_slowest = profile_slowest
+        self.sample_rate = sample_rate
+        self._sources = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            connections = list(getattr(self, "_connections", ()))
+            self.started = time.time()
+            self._actions = {}
+            # Open connections and their byte counters when they were opened, or at the reset
+            self._connections = weakref.WeakKeyDictionary()
+            for connection in connections:
+                self._connections[connection] = self._counted(connection)
+            self.connections_total = 0
+            self.connections_rejected = 0
+            self.connection_errors = 0
+            self.requests_in_flight = getattr(self, "requests_in_flight", 0)  # A gauge, kept
+            # Traffic of connections closed since, live ones are added from their counters when read
+            self._closed_bytes_received = 0
+            self._closed_bytes_sent = 0
+
+    def add_source(self, name, collect, label):
+        """
+        Report what collect() returns, {key: {field: number}}, as name in snapshots and as one gauge per field
+        labelled with label="key" in the Prometheus text, such as an executor's queue depth per class.
+        """
+        self._sources[name] = (collect, label)
+
+    def _action(self, name):
+        stats = self._actions.get(name)
+        if stats is None and len(self._actions) >= MAX_TRACKED_ACTIONS:
+            name = OTHER_ACTIONS
+            stats = self._actions.get(name)
+        if stats is None:
+            stats = self._actions[name] = ActionStats()
+        return stats
+
+    # Connections
+
+    def connection_opened(self, connection):
+        with self._lock:
+            self._connections[connection] = self._counted(connection)
+            self.connections_total += 1
+
+    def connection_closed(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                received, sent = self._connection_bytes(connection)
+                del self._connections[connection]
+                self._closed_bytes_received += received
+                self._closed_bytes_sent += sent
+
+    def connection_rejected(self):
+        with self._lock:
+            self.connections_rejected += 1
+
+    def connection_error(self):
+        with self._lock:
+            self.connection_errors += 1
+
+    @staticmethod
+    def _counted(connection):
+        return connection.counters.bytes_received, connection.counters.bytes_sent
+
+    def _connection_bytes(self, connection):
+        # Called with the lock held
+        received, sent = self._connections[connection]
+        return connection.counters.bytes_received - received, connection.counters.bytes_sent - sent
+
+    # Requests
+
+    def request_received(self, action, receive_seconds, decode_seconds, size):
+        with self._lock:
+            stats = self._action(action)
+            stats.bytes_received += size
+            stats.phases["receive"].observe(receive_seconds)
+            stats.phases["decode"].observe(decode_seconds)
+
+    def request_started(self):
+        with self._lock:
+            self.requests_in_flight += 1
+
+    def request_finished(self, action, phases, success=True, error=False, size=0, profile=None):
+        """
+        Record a performed request: the seconds of each of its phases, whether its response was a success
+        or it raised instead, the bytes of its responses and the profile it was run under, if sampled.
+        """
+        with self._lock:
+            self.requests_in_flight -= 1
+            stats = self._action(action)
+            stats.requests += 1
+            stats.failures += not success and not error
+            stats.errors += error
+            stats.bytes_sent += size
+            for phase, seconds in phases.items():
+                stats.phases[phase].observe(seconds)
+            if profile is not None and self.profile_slowest:
+                entry = (phases.get("total", 0.0), next(self._sequence), time.time(), profile)
+                if len(stats.profiles) < self.profile_slowest:
+                    heapq.heappush(stats.profiles, entry)
+                else:
+                    heapq.heappushpop(stats.profiles, entry)
+
+    # Profiling
+
+    def configure_profiling(self, slowest, sample_rate=None):
+        """
+        Keep the profiles of the slowest requests per action, 0 to stop profiling and drop those kept.
+        """
+        with self._lock:
+            self.profile_slowest = slowest
+            if sample_rate is not None:
+                self.sample_rate = sample_rate
+            for stats in self._actions.values():
+                stats.profiles = heapq.nlargest(slowest, stats.profiles) if slowest else []
+                heapq.heapify(stats.profiles)
+
+    def start_profile(self):
+        """
+        A running cProfile.Profile if this request is sampled for profiling, None otherwise.
+        """
+        if not self.profile_slowest or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Another profiler is active in this thread
+            return None
+        _profiling.profile = profile
+        return profile
+
+    @staticmethod
+    def stop_profile(profile):
+        profile.disable()
+        _profiling.profile = None
+
+    @staticmethod
+    def active_profile():
+        """
+        The profile the request handled by this thread runs under, None if it is not profiled.
+        """
+        return getattr(_profiling, "profile", None)
+
+    def profiles(self):
+        with self._lock:
+            kept = {action: sorted(stats.profiles, reverse=True) for action, stats in self._actions.items()
+                    if stats.profiles}
+        return {action: [{"seconds": round(seconds, 6), "finished": finished, "profile": _render_profile(profile)}
+                         for seconds, _, finished, profile in entries]
+                for action, entries in kept.items()}
+
+    # Reading
+
+    def snapshot(self):
+        with self._lock:
+            received, sent = self._closed_bytes_received, self._closed_bytes_sent
+            connections = list(self._connections)
+            for connection in connections:
+                connection_received, connection_sent = self._connection_bytes(connection)
+                received += connection_received
+                sent += connection_sent
+            snapshot = {
+                "uptime": round(time.time() - self.started, 3),
+                "connections_active": len(connections),
+                "connections_total": self.connections_total,
+                "connections_rejected": self.connections_rejected,
+                "connection_errors": self.connection_errors,
+                "requests_in_flight": self.requests_in_flight,
+                "bytes_received": received,
+                "bytes_sent": sent,
+                "profiling": {"slowest": self.profile_slowest, "sample_rate": self.sample_rate},
+                "actions": {action: stats.to_dict() for action, stats in sorted(self._actions.items())},
+            }
+        for name, (collect, _) in self._sources.items():
+            snapshot[name] = collect()
+        return snapshot
+
+    def prometheus_text(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        with self._lock:
+            actions = {action: (stats.requests, stats.failures, stats.errors, stats.bytes_received, stats.bytes_sent,
+                                {phase: (histogram.cumulative_counts(), histogram.sum, histogram.count)
+                                 for phase, histogram in stats.phases.items() if histogram.count})
+                       for action, stats in sorted(self._actions.items())}
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{key}="{_label(label)}"' for key, label in labels.items())
+                lines.append(f"{METRIC_PREFIX}_{name}{suffix}{{{label_text}}} {value}" if label_text
+                             else f"{METRIC_PREFIX}_{name}{suffix} {value}")
+
+        metric("uptime_seconds", "gauge", "Seconds since the metrics were started or reset.",
+               [("", {}, snapshot["uptime"])])
+        metric("connections_active", "gauge", "Client connections open.",
+               [("", {}, snapshot["connections_active"])])
+        metric("connections_total", "counter", "Client connections accepted.",
+               [("", {}, snapshot["connections_total"])])
+        metric("connections_rejected_total", "counter", "Client connections rejected over the connection limit.",
+               [("", {}, snapshot["connections_rejected"])])
+        metric("connection_errors_total", "counter", "Client connections ended by an error.",
+               [("", {}, snapshot["connection_errors"])])
+        metric("requests_in_flight", "gauge", "Requests being performed.",
+               [("", {}, snapshot["requests_in_flight"])])
+        metric("received_bytes_total", "counter", "Bytes received from clients.",
+               [("", {}, snapshot["bytes_received"])])
+        metric("sent_bytes_total", "counter", "Bytes sent to clients.", [("", {}, snapshot["bytes_sent"])])
+        for name, index, help_text in (("requests_total", 0, "Requests performed."),
+                                       ("request_failures_total", 1, "Requests responded to with success false."),
+                                       ("request_errors_total", 2, "Requests that raised instead of responding."),
+                                       ("request_received_bytes_total", 3, "Bytes read receiving requests."),
+                                       ("response_sent_bytes_total", 4, "Bytes of responses sent.")):
+            metric(name, "counter", help_text,
+                   [("", {"action": action}, values[index]) for action, values in actions.items()])
+        samples = []
+        for action, values in actions.items():
+            for phase, (buckets, total, count) in values[5].items():
+                labels = {"action": action, "phase": phase}
+                samples.extend(("_bucket", {**labels, "le": bound}, cumulative) for bound, cumulative in buckets)
+                samples.append(("_sum", labels, round(total, 6)))
+                samples.append(("_count", labels, count))
+        metric("request_phase_seconds", "histogram", "Seconds requests spent per phase.", samples)
+        for name, (_, label) in self._sources.items():
+            values = snapshot[name]
+            fields = dict.fromkeys(field for entry in values.values() for field, value in entry.items()
+                                   if isinstance(value, (int, float)))
+            for field in fields:
+                metric(f"{name}_{field}", "gauge", f"The {name}'s {field.replace('_', ' ')} per {label}.",
+                       [("", {label: key}, int(entry[field]) if isinstance(entry[field], bool) else entry[field])
+                        for key, entry in values.items() if isinstance(entry.get(field), (int, float))])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self, path):
+        """
+        Replace the file at path with the current metrics, for a textfile collector to pick up.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.prometheus_text())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
@@ -0,0 +1,175 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+
+from data.data_classes import FileSource, StreamSource
+
+DEFAULT_BUDGET = 64 * 1024 * 1024  # Bytes of encoded responses kept
+MAX_ENTRY_FRACTION = 8  # A single response may take up at most this fraction of the budget
+MAX_INVALIDATIONS = 256  # Recent invalidations remembered to reject responses computed before them
+COUNTERS = ("hits", "misses", "stores", "invalidated", "evicted", "expired")
+
+
+def binary_size(value):
+    """
+    Bytes of file contents and binary values anywhere in a response message, None if a stream of unknown size.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, FileSource):
+        return max(os.path.getsize(value.path) - value.offset, 0)
+    if isinstance(value, StreamSource):
+        return None
+    items = value.values() if isinstance(value, dict) else value if isinstance(value, list) else ()
+    total = 0
+    for item in items:
+        size = binary_size(item)
+        if size is None:
+            return None
+        total += size
+    return total
+
+
+def _normalize(path):
+    return os.path.join(os.path.abspath(path), "")
+
+
+def _overlaps(path, other):
+    # The same path, or one inside the other: a write to a file changes its directory's listing
+    return path.startswith(other) or other.startswith(path)
+
+
+class _Entry:
+    __slots__ = ("action", "value", "size", "path", "expires")
+
+    def __init__(self, action, value, size, path, expires):
+        self.action = action
+        self.value = value
+        self.size = size
+        self.path = path
+        self.expires = expires
+
+
+class ResponseCache:
+    """
+    Responses of read-only actions, kept encoded so a repeated request is answered without performing the action
+    or encoding its response again. Keys are built by the caller from the action, its params and whatever else the
+    encoding depends on.
+
+    Entries expire ttl seconds after they were stored, and the least recently used are evicted once they take up
+    more than budget bytes. An entry may name the path its response was read from: invalidating a path drops the
+    entries of that path, of the paths below it and of the directories containing it. A ttl of 0 disables the cache.
+    """
+    def __init__(self, ttl=0, budget=DEFAULT_BUDGET):
+        self.ttl = ttl
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Key -> _Entry, least recently used first
+        self._size = 0
+        self._generation = 0  # Counts invalidations
+        self._invalidations = deque(maxlen=MAX_INVALIDATIONS)  # (generation, paths or None for everything)
+        self._counters = {}  # Action -> {counter: count}
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.budget > 0
+
+    @property
+    def max_entry_size(self):
+        return self.budget // MAX_ENTRY_FRACTION
+
+    def configure(self, ttl=None, budget=None):
+        with self._lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if budget is not None:
+                self.budget = budget
+            self._evict()
+
+    def _count(self, action, counter, count=1):
+        counters = self._counters.get(action)
+        if counters is None:
+            counters = self._counters[action] = dict.fromkeys(COUNTERS, 0)
+        counters[counter] += count
+
+    def get(self, action, key):
+        """
+        Return the value stored for key and None, or on a miss None and the token to store the response under.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key, "expired")
+                entry = None
+            if entry is None:
+                self._count(action, "misses")
+                return None, self._generation
+            self._entries.move_to_end(key)
+            self._count(action, "hits")
+            return entry.value, None
+
+    def put(self, action, key, value, size, path=None, token=None):
+        """
+        Store value, taking up size bytes, unless a path it depends on was invalidated since get() handed out
+        token, since it may have been computed from what was there before. Returns whether it was stored.
+        """
+        if not self.enabled or size > self.max_entry_size:
+            return False
+        normalized = _normalize(path) if path else None
+        with self._lock:
+            if token is not None and self._invalidated_since(token, normalized):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(action, value, size, normalized, time.monotonic() + self.ttl)
+            self._size += size
+            self._count(action, "stores")
+            self._evict()
+            return True
+
+    def _invalidated_since(self, token, path):
+        if token == self._generation:
+            return False
+        if not self._invalidations or self._invalidations[0][0] > token + 1:
+            return True  # Older invalidations were forgotten
+        for generation, paths in self._invalidations:
+            if generation > token and (paths is None or (path and any(_overlaps(path, p) for p in paths))):
+                return True
+        return False
+
+    def _remove(self, key, counter=None):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        if counter:
+            self._count(entry.action, counter)
+
+    def _evict(self):
+        while self._entries and self._size > self.budget:
+            self._remove(next(iter(self._entries)), "evicted")
+
+    def invalidate(self, paths=None):
+        """
+        Drop the entries depending on any of paths, or every entry when paths is None.
+        """
+        normalized = [_normalize(path) for path in paths] if paths is not None else None
+        with self._lock:
+            self._generation += 1
+            self._invalidations.append((self._generation, normalized))
+            for key, entry in list(self._entries.items()):
+                if normalized is None or (entry.path and any(_overlaps(entry.path, path) for path in normalized)):
+                    self._remove(key, "invalidated")
+
+    def clear(self):
+        self.invalidate(None)
+
+    def stats(self):
+        """
+        Per action: hits, misses, stores, entries dropped by invalidation, eviction or expiry, and the entries kept.
+        """
+        with self._lock:
+            stats = {action: dict(counters, entries=0, bytes=0) for action, counters in self._counters.items()}
+            for entry in self._entries.values():
+                stats[entry.action]["entries"] += 1
+                stats[entry.action]["bytes"] += entry.size
+            return stats
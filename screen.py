@@ -0,0 +1,230 @@
+import io
+import os
+import sys
+import zlib
+import struct
+import subprocess
+from array import array
+from operator import itemgetter
+from dataclasses import dataclass
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+try:
+    from PIL import Image, ImageGrab
+except ImportError:
+    Image = ImageGrab = None
+
+FORMATS = ("png", "jpeg", "webp")  # Formats other than PNG need Pillow
+DEFAULT_TILE_SIZE = 64
+PNG_COMPRESSION_LEVEL = 6
+CAPTURE_TIMEOUT = 10  # Seconds an external capture command may take
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class CaptureError(RuntimeError):
+    pass
+
+
+@dataclass(slots=True)
+class Frame:
+    """
+    An image as 8 bit RGBA pixels, row by row, for cropping, scaling and diffing without any imaging library.
+    """
+    width: int
+    height: int
+    pixels: bytes
+
+    @classmethod
+    def from_rgb(cls, width, height, rgb):
+        pixels = bytearray(b"\xff" * (width * height * 4))
+        for channel in range(3):
+            pixels[channel::4] = rgb[channel::3]
+        return cls(width, height, bytes(pixels))
+
+    @classmethod
+    def from_bgra(cls, width, height, bgra):
+        pixels = bytearray(bgra)
+        pixels[0::4], pixels[2::4] = bgra[2::4], bgra[0::4]
+        return cls(width, height, bytes(pixels))
+
+    def crop(self, x, y, width, height):
+        """
+        The part of the frame within the rectangle, clipped to the frame. Raises ValueError if nothing is left.
+        """
+        x, y = max(x, 0), max(y, 0)
+        width, height = min(width, self.width - x), min(height, self.height - y)
+        if width <= 0 or height <= 0:
+            raise ValueError("Region is outside of the screen")
+        if (x, y, width, height) == (0, 0, self.width, self.height):
+            return self
+        stride = self.width * 4
+        rows = (self.pixels[row * stride + x * 4:row * stride + (x + width) * 4] for row in range(y, y + height))
+        return Frame(width, height, b"".join(rows))
+
+    def scaled(self, factor):
+        """
+        The frame resized by factor: resampled by Pillow if installed, nearest neighbour otherwise.
+        """
+        width, height = max(1, round(self.width * factor)), max(1, round(self.height * factor))
+        if (width, height) == (self.width, self.height):
+            return self
+        if Image:
+            image = Image.frombytes("RGBA", (self.width, self.height), self.pixels)
+            return Frame(width, height, image.resize((width, height), Image.BILINEAR).tobytes())
+        pixels = memoryview(self.pixels).cast("I")  # One item per pixel
+        pick_columns = itemgetter(*[column * self.width // width for column in range(width)])
+        scaled = array("I")
+        previous_row = line = None
+        for row in (row * self.height // height for row in range(height)):
+            if row != previous_row:
+                picked = pick_columns(pixels[row * self.width:(row + 1) * self.width])
+                line = array("I", picked if width > 1 else (picked,))
+                previous_row = row
+            scaled.extend(line)
+        return Frame(width, height, scaled.tobytes())
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def encode_png(frame, level=PNG_COMPRESSION_LEVEL):
+    """
+    Encode a frame as an RGBA PNG with zlib alone, for when Pillow is not installed.
+    """
+    stride = frame.width * 4
+    # Every row starts with its filter type, 0 (none)
+    rows = b"".join(b"\0" + frame.pixels[offset:offset + stride] for offset in range(0, len(frame.pixels), stride))
+    header = struct.pack(">IIBBBBB", frame.width, frame.height, 8, 6, 0, 0, 0)
+    return (PNG_SIGNATURE + _png_chunk(b"IHDR", header) + _png_chunk(b"IDAT", zlib.compress(rows, level))
+            + _png_chunk(b"IEND", b""))
+
+
+def encode(frame, image_format="png", quality=None):
+    """
+    Encode a frame as png, jpeg or webp. quality (1-100) applies to the lossy formats.
+    Raises ValueError for formats that cannot be written here.
+    """
+    if image_format not in FORMATS:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    if not Image:
+        if image_format != "png":
+            raise ValueError(f"Encoding {image_format} needs Pillow")
+        return encode_png(frame)
+    image = Image.frombytes("RGBA", (frame.width, frame.height), frame.pixels)
+    options = {}
+    if image_format == "jpeg":
+        image = image.convert("RGB")
+    if image_format != "png" and quality:
+        options["quality"] = quality
+    output = io.BytesIO()
+    image.save(output, format=image_format.upper(), **options)
+    return output.getvalue()
+
+
+def _parse_ppm(data):
+    """
+    Decode a binary PPM (P6) with 8 bit channels, as ImageMagick writes them.
+    """
+    fields = []
+    position = 0
+    while len(fields) < 4:
+        while position < len(data) and data[position:position + 1].isspace():
+            position += 1
+        if data[position:position + 1] == b"#":
+            position = data.index(b"\n", position)
+            continue
+        end = position
+        while end < len(data) and not data[end:end + 1].isspace():
+            end += 1
+        if end == position:
+            raise CaptureError("Truncated screenshot")
+        fields.append(data[position:end])
+        position = end
+    magic, width, height, maximum = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+    rgb = data[position + 1:position + 1 + width * height * 3]
+    if magic != b"P6" or maximum != 255 or len(rgb) != width * height * 3:
+        raise CaptureError("Unexpected screenshot format")
+    return Frame.from_rgb(width, height, rgb)
+
+
+def _capture_with_import():
+    try:
+        result = subprocess.run(["import", "-silent", "-window", "root", "-depth", "8", "ppm:-"],
+                                capture_output=True, timeout=CAPTURE_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise CaptureError(f"Screen capture failed: {e}")
+    if result.returncode:
+        raise CaptureError(f"Screen capture failed: {result.stderr.decode(errors='replace').strip()}")
+    return _parse_ppm(result.stdout)
+
+
+def capture(region=None):
+    """
+    Capture the screen, or the (x, y, width, height) region of it, as a Frame: in-process with mss or Pillow
+    when installed, otherwise piped raw from ImageMagick's import. Raises CaptureError if none of them can.
+    """
+    if mss:
+        try:
+            with mss.mss() as grabber:
+                if region:
+                    area = dict(zip(("left", "top", "width", "height"), region))
+                else:
+                    area = grabber.monitors[0]  # All screens together
+                shot = grabber.grab(area)
+        except Exception as e:  # ScreenShotError without a display, among others
+            raise CaptureError(f"Screen capture failed: {e}")
+        return Frame.from_bgra(shot.width, shot.height, shot.bgra)
+    if ImageGrab:
+        try:
+            bbox = (region[0], region[1], region[0] + region[2], region[1] + region[3]) if region else None
+            image = ImageGrab.grab(bbox=bbox, all_screens=True).convert("RGBA")
+        except OSError as e:
+            raise CaptureError(f"Screen capture failed: {e}")
+        return Frame(image.width, image.height, image.tobytes())
+    if sys.platform == "darwin" or os.name == "nt":
+        raise CaptureError("In-process capture needs mss or Pillow")
+    frame = _capture_with_import()
+    return frame.crop(*region) if region else frame
+
+
+def changed_tiles(previous, current, tile_size=DEFAULT_TILE_SIZE):
+    """
+    The (x, y, width, height) rectangles of current that differ from previous, on a grid of tile_size squares,
+    with neighbouring changed tiles of a row merged. The whole frame when there is no previous frame of its size.
+    """
+    if previous is None or (previous.width, previous.height) != (current.width, current.height):
+        return [(0, 0, current.width, current.height)]
+    stride = current.width * 4
+    columns = range(0, current.width, tile_size)
+    rectangles = []
+    for top in range(0, current.height, tile_size):
+        bottom = min(top + tile_size, current.height)
+        band = slice(top * stride, bottom * stride)
+        if previous.pixels[band] == current.pixels[band]:
+            continue
+        changed = [False] * len(columns)
+        for row_start in range(band.start, band.stop, stride):
+            old_row = previous.pixels[row_start:row_start + stride]
+            new_row = current.pixels[row_start:row_start + stride]
+            if old_row == new_row:
+                continue
+            for index, left in enumerate(columns):
+                tile = slice(left * 4, (left + tile_size) * 4)
+                if not changed[index] and old_row[tile] != new_row[tile]:
+                    changed[index] = True
+        index = 0
+        while index < len(columns):
+            if not changed[index]:
+                index += 1
+                continue
+            first = index
+            while index < len(columns) and changed[index]:
+                index += 1
+            left, right = columns[first], min(columns[index - 1] + tile_size, current.width)
+            rectangles.append((left, top, right - left, bottom - top))
+    return rectangles
@@ -0,0 +1,145 @@
+import json
+import struct
+from enum import Enum
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from data.data_classes import CustomJSONEncoder
+
+DEFAULT_CODEC = "json"  # Spoken by every peer, and by all peers before negotiation
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _extend_json(encode, encoded, fields):
+    # A JSON object is extended by writing the fields in front of its first member
+    extra = encode(fields)
+    if len(extra) <= 2:
+        return encoded
+    if len(encoded) <= 2:
+        return extra
+    return extra[:-1] + b"," + encoded[1:]
+
+
+class _JsonCodec:
+    name = "json"
+
+    def __init__(self):
+        self._encoder = CustomJSONEncoder(separators=(",", ":"))
+
+    def encode(self, message):
+        return self._encoder.encode(message).encode()
+
+    def extend(self, encoded, fields):
+        """
+        Add fields to an encoded message without decoding it.
+        """
+        return _extend_json(self.encode, encoded, fields)
+
+    def decode(self, data):
+        try:
+            return json.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise DecodeError(f"Invalid JSON received: {e}")
+
+
+def _orjson_default(obj):
+    # Enums are handled by orjson itself, FileSource and bytes the same way as for stdlib json
+    return CustomJSONEncoder().default(obj)
+
+
+class _OrjsonCodec:
+    """
+    The same JSON on the wire as _JsonCodec, encoded and decoded faster.
+    """
+    name = "json"
+
+    def encode(self, message):
+        return orjson.dumps(message, default=_orjson_default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS)
+
+    def extend(self, encoded, fields):
+        return _extend_json(self.encode, encoded, fields)
+
+    def decode(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise DecodeError(f"Invalid JSON received: {e}")
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f"Cannot serialize {type(obj).__name__}")
+
+
+class _MsgpackCodec:
+    """
+    Binary encoding, smaller than JSON and carrying bytes without any text conversion.
+    """
+    name = "msgpack"
+
+    def encode(self, message):
+        return msgpack.packb(message, default=_msgpack_default, use_bin_type=True)
+
+    def extend(self, encoded, fields):
+        # The map's entry count is in its first bytes, the added entries can follow the existing ones
+        first = encoded[0]
+        if first & 0xf0 == 0x80:
+            count, start = first & 0x0f, 1
+        elif first == 0xde:
+            count, start = struct.unpack_from(">H", encoded, 1)[0], 3
+        else:
+            count, start = struct.unpack_from(">I", encoded, 1)[0], 5
+        count += len(fields)
+        if count < 16:
+            prefix = bytes([0x80 | count])
+        elif count < 0x10000:
+            prefix = b"\xde" + struct.pack(">H", count)
+        else:
+            prefix = b"\xdf" + struct.pack(">I", count)
+        return prefix + encoded[start:] + b"".join(self.encode(key) + self.encode(value)
+                                                   for key, value in fields.items())
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise DecodeError(f"Invalid msgpack received: {e}")
+
+
+# In order of preference, only the ones whose module is installed
+CODECS = {codec.name: codec for codec in (
+    _MsgpackCodec() if msgpack else None,
+    _OrjsonCodec() if orjson else _JsonCodec(),
+) if codec}
+
+
+def get_codec(name):
+    codec = CODECS.get(name)
+    if not codec:
+        raise ValueError(f"Unsupported codec: {name}")
+    return codec
+
+
+def available_codecs():
+    return list(CODECS)
+
+
+def choose_codec(offered):
+    """
+    Pick the preferred codec out of a comma separated list offered by the peer, JSON if there is no better common one.
+    """
+    offered = {name.strip() for name in offered.split(",")}
+    return next((name for name in CODECS if name in offered), DEFAULT_CODEC)
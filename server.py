@@ -1,76 +1,392 @@
 
+import io
 import os
+import sys
+import time
+import types
+import shutil
 import socket
-import threading
+import select
+import signal
 import json
-from socket_utils import receive_message, send_message, PROTOCOL_VERSION
+import math
+import asyncio
+import inspect
+import argparse
+import tempfile
+import threading
+from contextlib import contextmanager, ExitStack
+from dataclasses import replace
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from socket_utils import receive_message, send_message, encode_message, choose_settings, Connection
 import slave
 import hashlib
-import traceback
-from data.data_classes import Request, Response, Action, Param, ParamTypes
+import log
+from log import get_logger, Payload
+from metrics import Metrics, DEFAULT_PROFILE_SAMPLE_RATE
+from executor import (ActionExecutor, PriorityExecutor, DEFAULT_MAX_WORKERS, MAX_RESERVED_FRACTION, process_problem,
+                      top_priority_workers)
+from response_cache import ResponseCache, binary_size, DEFAULT_BUDGET as DEFAULT_CACHE_BUDGET
+from delta import apply_file_delta
+from data.data_classes import (Request, Response, ActionRegistry, Param, ParamTypes, file_bytes, parse_flag,
+                               DEFAULT_ACTION_CLASS)
 
 SLAVE_FILE_NAME = "slave.py"
-update_lock = threading.Lock()
+SLAVE_INTERFACE = ("ACTIONS", "SLAVE_VERSION", "SLAVE_MAJOR_VERSION")  # Required of an updated slave.py
+CHECKSUM_ALGORITHMS = ("md5", "sha256")
+CHECKSUM_READ_SIZE = 1024 * 1024
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 12345
+DEFAULT_WORKERS = 16
+DEFAULT_MAX_CONNECTIONS = 64
+LISTEN_BACKLOG = 128
+MAX_PIPELINED_REQUESTS = 32  # Requests of one connection processed concurrently
+SPOOL_MAX_SIZE = 1024 * 1024  # Binary request fields larger than this are spooled to disk
+MAX_BATCH_PARALLELISM = 16
+UNBATCHABLE_ACTIONS = ("batch", "negotiate")  # negotiate changes the connection, batches do not nest
+POLL_INTERVAL = 0.5  # Seconds between checks of the shutdown flag while idle
+CONCURRENCY_MODES = ("thread", "asyncio")
+STATS_FORMATS = ("json", "prometheus")
+DEFAULT_STATS_INTERVAL = 15  # Seconds between rewrites of the --stats-file
+MAX_PROFILE_SLOWEST = 100
+# Read-only actions whose responses are cached with --cache-ttl, and the param naming the path each one reads
+CACHEABLE_ACTIONS = {"get_actions": None, "list_directory": "directory", "download_file": "file_path"}
+# Actions writing files, and the params naming the paths they change, which invalidate the cached responses
+INVALIDATING_ACTIONS = {
+    "upload_file": ("destination_path",),
+    "upload_cached": ("destination_path",),
+    "upload_delta": ("destination_path",),
+    "upload_tree": ("destination",),
+    "rm_file": ("file",),
+    "copy_file": ("source", "destination", "pairs"),
+    "move_file": ("source", "destination", "pairs"),
+}
+
+
+class ReadWriteLock:
+    """
+    Lock allowing many concurrent readers or a single writer.
+    Slave actions hold it for reading, updating the slave file holds it for writing.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+
+    @contextmanager
+    def read_locked(self):
+        with self._condition:
+            while self._writer:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write_locked(self):
+        with self._condition:
+            while self._writer:
+                self._condition.wait()
+            self._writer = True
+            while self._readers:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+update_lock = ReadWriteLock()
 
 SERVER_MAJOR_VERSION = 1
 SERVER_MINOR_VERSION = 0
 SERVER_PATCH_VERSION = 0
 SERVER_VERSION = f"{SERVER_MAJOR_VERSION}.{SERVER_MINOR_VERSION}.{SERVER_PATCH_VERSION}"
 
-def check_slave(checksum):
-    # Calculate checksum of the slave file
-    hasher = hashlib.md5()
-    with open(SLAVE_FILE_NAME, "rb") as f:
-        hasher.update(f.read())
-    current_checksum = hasher.hexdigest()
-    print(f"Current checksum: {current_checksum}, Provided checksum: {checksum}")
-    return current_checksum == checksum
+# Server actions, filled by the @ACTIONS.action decorators below. Other actions are looked up in slave.ACTIONS.
+ACTIONS = ActionRegistry()
+logger = get_logger("server")
+
+class SlaveDigests:
+    """
+    Digests of the slave file, kept in memory and recomputed only once its path, inode, size or
+    modification time changes, so polling check_slave does not reread the file every time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._digests = None
+
+    @staticmethod
+    def _file_key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def compute(chunks):
+        hashers = {name: hashlib.new(name) for name in CHECKSUM_ALGORITHMS}
+        for chunk in chunks:
+            for hasher in hashers.values():
+                hasher.update(chunk)
+        return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+    def get(self, path):
+        with self._lock:
+            key = self._file_key(path)
+            if key != self._key:
+                with open(path, "rb") as f:
+                    digests = self.compute(iter(lambda: f.read(CHECKSUM_READ_SIZE), b""))
+                # Not cached if the file changed while it was being read
+                self._key = key if self._file_key(path) == key else None
+                self._digests = digests
+            return self._digests
+
+    def set(self, path, content):
+        """
+        Record the digests of content just written to path, sparing the next get() from rereading it.
+        """
+        with self._lock:
+            self._digests = self.compute([content])
+            self._key = self._file_key(path)
+
+    def invalidate(self):
+        with self._lock:
+            self._key = None
+
+
+slave_digests = SlaveDigests()
+metrics = Metrics()
+# Runs slave actions by class, with their timeouts, the server's own actions run inline
+action_executor = ActionExecutor()
+metrics.add_source("executor", action_executor.stats, label="action_class")
+# Encoded responses of CACHEABLE_ACTIONS, disabled until given a TTL
+response_cache = ResponseCache()
+metrics.add_source("response_cache", response_cache.stats, label="action")
+
+def parse_checksum_algorithm(params):
+    algorithm = (params.get("algorithm") or "md5").lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError(f"Unsupported checksum algorithm {algorithm}, expected one of {', '.join(CHECKSUM_ALGORITHMS)}")
+    return algorithm
+
+def check_slave(checksum, algorithm="md5"):
+    # Callers must hold update_lock
+    current_checksum = slave_digests.get(SLAVE_FILE_NAME)[algorithm]
+    logger.debug("Checking slave checksum", extra={"current": current_checksum, "provided": checksum})
+    return current_checksum == checksum.lower()
 
+@ACTIONS.action(name="check_slave", action_class="control", params=[
+    Param(name="checksum", type=ParamTypes.STRING, required=False),
+    Param(name="algorithm", type=ParamTypes.STRING, required=False)
+])
 def check_slave_action(params):
+    """
+    Compare the slave file against a checksum, responding with its digests and version either way
+    so a poller learns what the agent runs in one round trip. Without a checksum it only reports them.
+    """
     checksum = params.get("checksum")
-    if not checksum:
-        return Response(success=False, message="No checksum provided")
-    if check_slave(checksum):
-        return Response(success=True, message="Slave checksum matches")
-    else:
-        return Response(success=False, message="Slave checksum mismatch")
+    try:
+        algorithm = parse_checksum_algorithm(params)
+    except ValueError as e:
+        return Response(success=False, message=str(e))
+    with update_lock.read_locked():
+        digests = slave_digests.get(SLAVE_FILE_NAME)
+        matches = check_slave(checksum, algorithm) if checksum else None
+        version = slave.SLAVE_VERSION
+    message = {"matches": matches, **digests, "slave_version": version}
+    return Response(success=matches is not False, message=message)
+
+def load_slave(source):
+    """
+    Execute a slave.py source as a new slave module, leaving the current one untouched.
+    Raises ImportError if it fails to import, exits while importing, or does not define what the server uses.
+    """
+    module = types.ModuleType(slave.__name__)
+    module.__file__ = os.path.abspath(SLAVE_FILE_NAME)
+    try:
+        exec(compile(source, module.__file__, "exec"), module.__dict__)
+    except Exception:
+        raise
+    except BaseException as e:
+        # SystemExit or KeyboardInterrupt raised by the new slave must not end the thread running the update
+        raise ImportError(f"Slave raised {type(e).__name__} while importing: {e}") from e
+    missing = [name for name in SLAVE_INTERFACE if not hasattr(module, name)]
+    if missing:
+        raise ImportError(f"Slave does not define {', '.join(missing)}")
+    return module
+
+def swap_slave(module):
+    # Callers must hold update_lock for writing
+    global slave
+    slave = module
+    sys.modules[module.__name__] = module
+
+def apply_slave_delta(delta_content, base_checksum, algorithm):
+    """
+    Rebuild an updated slave.py from a delta against the current one.
+    Raises ValueError if the current file is not the one the delta was made from.
+    """
+    updated = io.BytesIO()
+    with update_lock.read_locked():
+        if slave_digests.get(SLAVE_FILE_NAME)[algorithm] != (base_checksum or "").lower():
+            raise ValueError("the current slave does not match the delta's base checksum")
+        apply_file_delta(SLAVE_FILE_NAME, io.BytesIO(delta_content), updated)
+    return updated.getvalue()
 
+@ACTIONS.action(params=[
+    Param(name="file_data", type=ParamTypes.FILE, required=False),
+    Param(name="checksum", type=ParamTypes.STRING),
+    Param(name="algorithm", type=ParamTypes.STRING, required=False),
+    Param(name="delta", type=ParamTypes.FILE, required=False),
+    Param(name="base_checksum", type=ParamTypes.STRING, required=False)
+])
 def update_slave(params):
-    update_content = params.get("file_data")
+    """
+    Replace slave.py and switch to it without a restart.
+    The new source is either sent whole as file_data, or as a delta against the current file
+    identified by base_checksum. It is checked against the checksum and imported first, so a broken update
+    leaves the current slave in place. It is then renamed over slave.py and swapped in under the write lock,
+    which waits for the slave actions in flight to finish on the old module.
+    """
     updated_checksum = params.get("checksum")
+    try:
+        algorithm = parse_checksum_algorithm(params)
+    except ValueError as e:
+        return Response(success=False, message=str(e))
+    if params.get("delta"):
+        try:
+            update_content = apply_slave_delta(file_bytes(params["delta"]), params.get("base_checksum"), algorithm)
+        except ValueError as e:
+            return Response(success=False, message=f"Slave delta update failed, send the full file: {e}")
+    else:
+        update_content = file_bytes(params.get("file_data"))
     if not update_content:
         return Response(success=False, message="No file data provided")
+    if hashlib.new(algorithm, update_content).hexdigest() != (updated_checksum or "").lower():
+        return Response(success=False, message="Slave update failed: checksum mismatch")
+    started = time.perf_counter()
+    try:
+        new_slave = load_slave(update_content)
+    except Exception as e:
+        logger.exception("Slave update failed, keeping the current slave: %s", e)
+        return Response(success=False, message=f"Slave update failed: {e}")
+
+    slave_path = os.path.abspath(SLAVE_FILE_NAME)
     backup_file = f"{SLAVE_FILE_NAME}.bak"
-    with update_lock:
-        try:
-            if os.path.exists(backup_file):
-                os.remove(backup_file)
-            with open(SLAVE_FILE_NAME, "r") as f:
-                old_content = f.read()
-            with open(backup_file, "w") as f:
-                f.write(old_content)
-
-            with open(SLAVE_FILE_NAME, "w") as f:
-                f.write(update_content)
-
-            if check_slave(checksum=updated_checksum):
-                return Response(success=True, message="Slave updated successfully")
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(slave_path), prefix=".slave-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(update_content)
+            f.flush()
+            os.fsync(f.fileno())
+        with update_lock.write_locked():
+            if os.path.exists(slave_path):
+                shutil.copy2(slave_path, backup_file)
+                # mkstemp creates files only the owner can read, keep the permissions of the slave replaced
+                shutil.copymode(slave_path, temp_path)
             else:
-                raise Exception("Slave update check failed")
-        except Exception as e:
-            print(f"Slave update failed: {e}")
-            with open(SLAVE_FILE_NAME, "w") as f:
-                f.write(old_content)
-            return json.dumps({"success": False, "message": f"Slave update failed: {e}"})
+                os.chmod(temp_path, 0o644)
+            slave_digests.invalidate()
+            os.replace(temp_path, slave_path)
+            slave_digests.set(slave_path, update_content)
+            swap_slave(new_slave)
+            action_executor.reload()
+            response_cache.clear()
+    except Exception as e:
+        logger.exception("Slave update failed: %s", e)
+        return Response(success=False, message=f"Slave update failed: {e}")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    logger.info("Slave reloaded", extra={"version": new_slave.SLAVE_VERSION,
+                                         "milliseconds": round((time.perf_counter() - started) * 1000, 1)})
+    return Response(success=True, message=f"Slave updated successfully to version {new_slave.SLAVE_VERSION}")
 
-def perform_slave_action(request):
+def perform_action(action_name, params):
     """
-    Perform an action defined in slave.py's ACTIONS.
+    Perform a server action, or otherwise an action defined in slave.py's ACTIONS.
     """
-    action_name = request.action
-    params = request.params or {}
+    action = find_action(action_name)
+    if action:
+        logger.debug("Performing action %s", action.name, extra={"params": Payload(params)})
+        return action.function(params)
+    locked = ExitStack()
+    locked.enter_context(update_lock.read_locked())
+    try:
+        result = _perform_slave_action(action_name, params)
+    except BaseException:
+        locked.close()
+        raise
+    if inspect.isgenerator(result):
+        result = held_until_done(result, locked)
+    else:
+        locked.close()
+    if action_name in INVALIDATING_ACTIONS:
+        return invalidate_after(result, touched_paths(action_name, params))
+    return result
 
-    slave_action = next((action for action in slave.ACTIONS if action.name == action_name), None)
+def held_until_done(results, locked):
+    """
+    Keep the read lock of a streaming action until its output is exhausted or closed, so the slave is not
+    swapped under it. The returned generator has already entered the lock, closing it or dropping it releases it.
+    """
+    def hold():
+        with locked:
+            yield None
+            yield from results
+    held = hold()
+    next(held)
+    return held
+
+def touched_paths(action_name, params):
+    """
+    The paths an action in INVALIDATING_ACTIONS writes to, None when they cannot be told from its params.
+    """
+    paths = []
+    for name in INVALIDATING_ACTIONS[action_name]:
+        value = params.get(name)
+        if name == "pairs" and value:
+            try:
+                pairs = json.loads(value) if isinstance(value, str) else value
+                for pair in pairs:
+                    paths.extend(pair.values() if isinstance(pair, dict) else pair)
+            except (TypeError, ValueError):
+                return None
+        elif value:
+            paths.append(value)
+    if not all(isinstance(path, str) for path in paths):
+        return None
+    return paths
+
+def invalidate_after(result, paths):
+    """
+    Drop the cached responses depending on paths once the action that wrote to them has finished,
+    after the last partial response of a streaming action.
+    """
+    if not response_cache.enabled:
+        return result
+    if inspect.isgenerator(result):
+        return _invalidating(result, paths)
+    response_cache.invalidate(paths)
+    return result
+
+def _invalidating(results, paths):
+    try:
+        yield from results
+    finally:
+        response_cache.invalidate(paths)
+
+def _perform_slave_action(action_name, params):
+    slave_action = slave.ACTIONS.get(action_name)
 
     if not slave_action:
         return Response(success=False, message=f"Invalid action: {action_name}")
@@ -78,120 +394,721 @@ def perform_slave_action(request):
     # Validate required parameters
     missing_params = [
         param.name for param in slave_action.params
-        if param.name not in params or (param.type == ParamTypes.FILE and not params[param.name])
+        if param.required and (param.name not in params or (param.type == ParamTypes.FILE and not params[param.name]))
     ]
     if missing_params:
         return Response(success=False, message=f"Missing required parameters: {', '.join(missing_params)}")
 
+    params = dict(params)
+    for param in slave_action.params:
+        if param.type == ParamTypes.FILE and isinstance(params.get(param.name), str):
+            params[param.name] = file_bytes(params[param.name])
+
     try:
-        print(f"Performing slave action: {slave_action.name} with params: {params}")
-        result = slave_action.function(params)  # Call the action's function
+        logger.debug("Performing slave action %s", slave_action.name, extra={"params": Payload(params)})
+        return action_executor.run(slave_action, params, metrics.active_profile())
+    except Exception as e:
+        logger.exception("Error performing slave action %s: %s", action_name, e)
+        return Response(success=False, message=f"Error performing action: {e}")
+
+
+@ACTIONS.action(action_class="control", params=[
+    Param(name="protocol_versions", type=ParamTypes.STRING),
+    Param(name="frame_size", type=ParamTypes.STRING, required=False),
+    Param(name="compression", type=ParamTypes.STRING, required=False),
+    Param(name="codecs", type=ParamTypes.STRING, required=False)
+])
+def negotiate(params):
+    """
+    Agree on the newest protocol version and the frame size supported by both sides.
+    The connection switches to them once this response has been sent.
+    """
+    if not params.get("protocol_versions"):
+        return Response(success=False, message="No protocol versions provided")
+    return Response(success=True, message=choose_settings(params))
+
+def send_streamed_result(client, request, results, on_sent=None):
+    """
+    Send the partial responses of a streaming action as it produces them and return its final response.
+    Sending blocks while the client is not reading, which in turn pauses the action.
+    on_sent(size) is called with the bytes each partial response took.
+    """
+    while True:
+        try:
+            result = next(results)
+        except StopIteration:
+            return Response(success=False, message="Action ended without a final response")
+        except Exception as e:
+            logger.exception("Error performing streaming action %s: %s", request.action, e)
+            return Response(success=False, message=f"Error performing action: {e}")
+        if not result.partial:
+            return result
+        result.request_id = request.request_id
+        size = send_message(client, add_result_data(result))
+        if on_sent:
+            on_sent(size)
+
+def collect_streamed_result(results):
+    """
+    Run a streaming action to completion, gathering its partial output into the final response.
+    Used where partial responses cannot be sent, such as inside a batch.
+    """
+    output = {}
+    for result in results:
+        if result.partial and isinstance(result.message, list):
+            output.setdefault(result.stream, []).extend(result.message)
+        elif result.partial and isinstance(result.message, dict):
+            output.setdefault(result.stream, []).append(result.message)
+        elif result.partial:
+            output[result.stream] = output.get(result.stream, "") + result.message
+        elif isinstance(result.message, dict):
+            result.message = {**output, **result.message}
+            return result
+        else:
+            return result
+    return Response(success=False, message="Action ended without a final response")
+
+def perform_batch_entry(entry):
+    if not isinstance(entry, dict) or not entry.get("action"):
+        return Response(success=False, message="Invalid batch entry, expected {action, params}")
+    action_name = entry["action"]
+    if action_name in UNBATCHABLE_ACTIONS:
+        return Response(success=False, message=f"Action {action_name} cannot be used in a batch")
+    try:
+        result = perform_action(action_name, entry.get("params") or {})
+        if inspect.isgenerator(result):
+            result = collect_streamed_result(result)
         return result
     except Exception as e:
-        print(f"Error performing slave action {action_name}: {e}")
-        traceback.print_exc()
+        logger.exception("Error performing batch action %s: %s", action_name, e)
         return Response(success=False, message=f"Error performing action: {e}")
 
+@ACTIONS.action(params=[
+    Param(name="actions", type=ParamTypes.STRING),
+    Param(name="parallel", type=ParamTypes.STRING, required=False),
+    Param(name="stop_on_error", type=ParamTypes.STRING, required=False)
+])
+def batch(params):
+    """
+    Perform a list of {"action", "params"} entries in one request, responding with one result per entry.
+    Entries run in order, or up to "parallel" at a time. With "stop_on_error" the entries that
+    have not started by the time one fails are skipped. The batch succeeds if every entry did.
+    """
+    entries = params.get("actions")
+    if isinstance(entries, str):
+        try:
+            entries = json.loads(entries)
+        except ValueError:
+            return Response(success=False, message="Actions must be a JSON list of {action, params} entries")
+    if not isinstance(entries, list):
+        return Response(success=False, message="Actions must be a list of {action, params} entries")
+    try:
+        parallel = max(1, min(int(params.get("parallel") or 1), MAX_BATCH_PARALLELISM))
+    except ValueError:
+        return Response(success=False, message="Parallel must be a number")
+    stop_on_error = parse_flag(params.get("stop_on_error"))
+    failed = threading.Event()
+
+    def run_entry(entry):
+        if stop_on_error and failed.is_set():
+            return Response(success=False, message="Skipped after an earlier error")
+        result = perform_batch_entry(entry)
+        if not result.success:
+            failed.set()
+        return result
+
+    if parallel == 1:
+        results = [run_entry(entry) for entry in entries]
+    else:
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="batch") as executor:
+            results = list(executor.map(run_entry, entries))
+    return Response(success=not failed.is_set(), message=[result.to_dict() for result in results])
 
 def find_action(action_name):
     """
-    Find an Action object by its name from the ACTIONS list.
+    Find a server Action object by its name, None if there is no such server action.
+    """
+    return ACTIONS.get(action_name)
+
+def find_action_class(action_name):
+    """
+    The executor class a request for the action is scheduled in, server actions included.
     """
-    for action in ACTIONS:
-        if action.name == action_name:
-            return action
-    return None
+    action = find_action(action_name) or slave.ACTIONS.get(action_name)
+    return action_executor.class_of(action_name, action.action_class if action else DEFAULT_ACTION_CLASS)
 
+@ACTIONS.action(name="get_actions", action_class="control")
 def get_actions_with_params(_):
     """
     Provide a list of available actions and their parameter requirements to the client.
     """
-    actions_details = [
-        {
-            "name": action.name,
-            "params": [param.to_dict() for param in action.params],
-            "response_type": action.response_type.value
-        }
-        for action in ACTIONS
-    ]
-    slave_actions = [
-        {
-            "name": action.name,
-            "params": [param.to_dict() for param in action.params],
-            "response_type": action.response_type.value
-        }
-        for action in slave.ACTIONS
-    ]
-
-    actions_details.extend(slave_actions)
-
+    actions_details = [action.to_dict() for action in ACTIONS]
+    actions_details.extend(action.to_dict() for action in slave.ACTIONS)
     return Response(success=True, message=actions_details)
 
-ACTIONS = [
-    Action(name="update_slave", params=[
-        Param(name="file_data", type=ParamTypes.FILE),
-        Param(name="checksum", type=ParamTypes.STRING)
-    ], function=lambda params: update_slave(params)),
-
-    Action(name="get_actions", params=[], function=lambda params: get_actions_with_params(params)),
+@ACTIONS.action(action_class="control", params=[
+    Param(name="format", type=ParamTypes.STRING, required=False),
+    Param(name="profiles", type=ParamTypes.STRING, required=False),
+    Param(name="reset", type=ParamTypes.STRING, required=False)
+])
+def get_stats(params):
+    """
+    Report the server's metrics: connection and in-flight request gauges, bytes received and sent,
+    per action the request, failure and error counts with latency histograms of every phase of a request,
+    per executor class the actions queued, running and timed out, and per cached action the response cache's
+    hits, misses and size.
+    "format" is json (the default) or prometheus for the Prometheus text format. With "profiles" the profiles
+    recorded for the slowest requests are included, with "reset" the counters start over after this report.
+    """
+    stats_format = (params.get("format") or "json").lower()
+    if stats_format not in STATS_FORMATS:
+        return Response(success=False, message=f"Unsupported stats format {stats_format}, "
+                                               f"expected one of {', '.join(STATS_FORMATS)}")
+    if stats_format == "prometheus":
+        message = metrics.prometheus_text()
+    else:
+        message = metrics.snapshot()
+        if parse_flag(params.get("profiles")):
+            message["profiles"] = metrics.profiles()
+    if parse_flag(params.get("reset")):
+        metrics.reset()
+    return Response(success=True, message=message)
 
-    Action(name="check_slave", params=[
-        Param(name="checksum", type=ParamTypes.STRING)
-    ], function=lambda params: check_slave_action(params))
-]
+@ACTIONS.action(action_class="control", params=[
+    Param(name="slowest", type=ParamTypes.STRING),
+    Param(name="sample_rate", type=ParamTypes.STRING, required=False)
+])
+def profile_requests(params):
+    """
+    Run a "sample_rate" fraction of requests (0.1 by default) under cProfile and keep the profiles of the
+    "slowest" of them per action, read back through get_stats with profiles. 0 stops profiling.
+    """
+    try:
+        slowest = int(params.get("slowest"))
+        sample_rate = float(params["sample_rate"]) if params.get("sample_rate") not in (None, "") else None
+    except (TypeError, ValueError):
+        return Response(success=False, message="Slowest must be a number and sample_rate a fraction")
+    if not 0 <= slowest <= MAX_PROFILE_SLOWEST or (sample_rate is not None and not 0 < sample_rate <= 1):
+        return Response(success=False, message=f"Slowest must be between 0 and {MAX_PROFILE_SLOWEST}, "
+                                               f"sample_rate above 0 and at most 1")
+    metrics.configure_profiling(slowest, sample_rate)
+    return Response(success=True, message={"slowest": metrics.profile_slowest, "sample_rate": metrics.sample_rate})
 
 def add_result_data(result):
     if not result.slave_version:
         result.slave_version = slave.SLAVE_VERSION
-    if not result.protocol_version:
-        result.protocol_version = PROTOCOL_VERSION
     if not result.server_version:
         result.server_version = SERVER_VERSION
     return result
 
-def handle_client(client, address):
-    try:
-        while True:
-            message = receive_message(client)
-            request = Request.from_json(message)
-            if not request:
-                break
+def spool_blob(field, header):
+    """
+    Receive binary request fields into a temporary file that only stays in memory while small,
+    so large uploads do not have to fit in memory.
+    """
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
 
-            client_version = request.client_version
-            client_version_major = int(client_version.split(".")[0])
-            if client_version_major != slave.SLAVE_MAJOR_VERSION:
-                response = Response(success=False, message="Incompatible client version!")
-                send_message(client, response.to_json())
-                break
+def close_spooled_params(params):
+    values = params.values() if isinstance(params, dict) else params if isinstance(params, list) else []
+    for value in values:
+        if isinstance(value, tempfile.SpooledTemporaryFile):
+            value.close()
+        else:
+            close_spooled_params(value)
 
-            action_name = request.action
-            params = request.params or {}
+def receive_request(client):
+    """
+    Receive the next request from the client.
+    Returns None when the connection should be closed.
+    """
+    started = time.perf_counter()
+    bytes_received, decode_seconds = client.counters.bytes_received, client.counters.decode_seconds
+    message = receive_message(client, blob_sink=spool_blob)
+    request = Request.from_json(message)
+    if not request:
+        return None
+    decode_seconds = client.counters.decode_seconds - decode_seconds
+    metrics.request_received(request.action, time.perf_counter() - started - decode_seconds, decode_seconds,
+                             client.counters.bytes_received - bytes_received)
 
-            action = find_action(action_name)
-            if action:
-                print(f"Performing action: {action.name} with params: {params}")
-                result = action.function(params)
-            else:
-                print(f"Action {action_name} not found. Checking slave actions.")
-                result = perform_slave_action(request)
-            
+    client_version = request.client_version
+    client_version_major = int(client_version.split(".")[0])
+    if client_version_major != slave.SLAVE_MAJOR_VERSION:
+        close_spooled_params(request.params or {})
+        response = Response(success=False, message="Incompatible client version!", request_id=request.request_id)
+        send_message(client, response)
+        return None
+    return request
+
+def process_request(client, request, queued_at=None):
+    """
+    Perform a received request and send back the response, tagged with the request's ID.
+    queued_at is when a pipelined request was handed to the executor, to measure how long it waited.
+    """
+    started = time.perf_counter()
+    phases = {"queue": started - queued_at} if queued_at is not None else {}
+    sent = []
+    result = None  # Stays None when the response comes from the cache, which only keeps successful ones
+    failed = True
+    metrics.request_started()
+    profile = metrics.start_profile()
+    try:
+        action_name = request.action
+        key = cache_key(client, request)
+        encoded, token = response_cache.get(action_name, key) if key else (None, None)
+        try:
+            if encoded is None:
+                result = perform_action(action_name, request.params or {})
+                if inspect.isgenerator(result):
+                    result = send_streamed_result(client, request, result, on_sent=sent.append)
+        finally:
+            if profile:
+                metrics.stop_profile(profile)
+        phases["action"] = time.perf_counter() - started
+
+        if encoded is None:
             result = add_result_data(result)
+            if key and result.success:
+                encoded = cache_response(client, request, result, key, token)
+        if encoded is None:
+            result.request_id = request.request_id
+            message = result
+        elif request.request_id is not None:
+            message = encoded.with_fields({"request_id": request.request_id})
+        else:
+            message = encoded
+
+        sending = time.perf_counter()
+        sent.append(send_message(client, message))
+        phases["send"] = time.perf_counter() - sending
+        if action_name == "negotiate" and result.success:
+            client.apply_settings(result.message)
+        failed = False
+    finally:
+        phases["total"] = time.perf_counter() - (started if queued_at is None else queued_at)
+        metrics.request_finished(request.action, phases, success=not failed and (result is None or result.success),
+                                 error=failed, size=sum(sent), profile=profile)
+        close_spooled_params(request.params or {})
+
+def cache_key(client, request):
+    """
+    What the response to a request is cached under: the action and its params, and the connection's codec,
+    protocol version and compression its encoding depends on. None if it is not cached.
+    """
+    if not response_cache.enabled or request.action not in CACHEABLE_ACTIONS:
+        return None
+    try:
+        params = tuple(sorted((request.params or {}).items()))
+        hash(params)
+    except TypeError:
+        return None
+    return request.action, params, client.codec, client.protocol_version, client.compression
+
+def cache_response(client, request, result, key, token):
+    """
+    Encode a response for the cache and store it, returning it encoded. None if it is too large to keep,
+    the response is then sent as usual so files are not read into memory for nothing.
+    """
+    size = binary_size(result.message)
+    if size is None or size > response_cache.max_entry_size:
+        return None
+    encoded = encode_message(client, result, materialize=True)
+    path_param = CACHEABLE_ACTIONS[request.action]
+    path = (request.params or {}).get(path_param) if path_param else None
+    if path_param and not isinstance(path, str):
+        return None
+    response_cache.put(request.action, key, encoded, encoded.size, path, token)
+    return encoded
+
+def schedule_request(executor, request, function, *args):
+    # Requests for control actions are started ahead of queued transfers
+    if isinstance(executor, PriorityExecutor):
+        return executor.schedule(find_action_class(request.action).name, function, *args)
+    return executor.submit(function, *args)
+
+def process_pipelined_request(client, request, queued_at=None):
+    try:
+        process_request(client, request, queued_at)
+    except Exception as e:
+        log_connection_error(e, f"Error processing request {request.request_id}")
+
+def handle_request(client):
+    """
+    Receive a single request from the client, perform it and send back the response.
+    Returns False when the connection should be closed.
+    """
+    request = receive_request(client)
+    if not request:
+        return False
+    process_request(client, request)
+    return True
+
+def wait_for_request(client, stop_event):
+    """
+    Block until the client starts sending a request.
+    Returns False if the server is shutting down first, so idle connections are dropped
+    while connections in the middle of a request get to finish it.
+    """
+    while not stop_event.is_set():
+        if client.has_buffered_data():
+            return True
+        readable, _, _ = select.select([client], [], [], POLL_INTERVAL)
+        if readable:
+            return True
+    return False
+
+
+class PipelinedRequests:
+    """
+    Requests of one connection being processed concurrently, at most limit at a time.
+    Submitting blocks while the limit is reached, which stops reading further requests from the client.
+    """
+    def __init__(self, limit=MAX_PIPELINED_REQUESTS):
+        self._slots = threading.BoundedSemaphore(limit)
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def submit(self, executor, client, request):
+        self._slots.acquire()
+        future = schedule_request(executor, request, process_pipelined_request, client, request, time.perf_counter())
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
 
-            send_message(client, result.to_json())
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        self._slots.release()
+
+    def wait(self):
+        with self._lock:
+            futures = list(self._futures)
+        concurrent.futures.wait(futures)
+
+
+def log_connection_error(error, context):
+    # Clients going away are routine, anything else is logged with its traceback
+    if isinstance(error, ConnectionError):
+        logger.info("%s: %s", context, error)
+    else:
+        logger.exception("%s: %s", context, error)
+
+def handle_client(client, address, stop_event=None, executor=None):
+    """
+    Serve requests from one client until it disconnects or the server shuts down.
+    Requests carrying a request ID are performed concurrently on the executor when one is given,
+    and their responses are sent as soon as they are ready, possibly out of order.
+    """
+    stop_event = stop_event or threading.Event()
+    pipelined_requests = PipelinedRequests()
+    metrics.connection_opened(client)
+    try:
+        while wait_for_request(client, stop_event):
+            request = receive_request(client)
+            if not request:
+                break
+            if executor and request.request_id is not None:
+                pipelined_requests.submit(executor, client, request)
+            else:
+                process_request(client, request)
     except Exception as e:
-        print(f"Client connection error: {e}")
-        print(f"Traceback: {traceback.format_exc()}")
+        metrics.connection_error()
+        log_connection_error(e, f"Client connection error from {address}")
     finally:
+        pipelined_requests.wait()
+        metrics.connection_closed(client)
         client.close()
 
+def reject_client(client, address):
+    """
+    Tell a client over the connection limit that the server is busy and drop it.
+    """
+    logger.warning("Rejecting %s: too many connections", address)
+    metrics.connection_rejected()
+    try:
+        # Read the request first, closing with it unread would reset the connection
+        # before the client gets to read the response
+        client.socket.settimeout(POLL_INTERVAL)
+        try:
+            receive_message(client)
+        except (OSError, ValueError):
+            pass
+        response = add_result_data(Response(success=False, message="Server busy, too many connections"))
+        send_message(client, response)
+    except OSError:
+        pass
+    finally:
+        client.close()
+
+
+class Server:
+    """
+    Serve clients concurrently with a bounded pool of worker threads.
+
+    In "thread" mode every connection occupies a worker for its whole lifetime.
+    In "asyncio" mode idle connections wait on the event loop and only take a worker
+    while a request is being handled, so many mostly-idle operators can share a small pool.
+    In both modes pipelined requests (those with a request ID) run on a separate pool of workers,
+    which starts requests for control actions ahead of queued transfers.
+    Connections over max_connections are rejected, and shutdown() stops accepting,
+    drops idle connections and waits for in-flight requests to finish.
+    With a stats_file the metrics are written to it in the Prometheus text format every stats_interval seconds.
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, mode="thread",
+                 workers=DEFAULT_WORKERS, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 stats_file=None, stats_interval=DEFAULT_STATS_INTERVAL):
+        if mode not in CONCURRENCY_MODES:
+            raise ValueError(f"Unknown concurrency mode: {mode}")
+        self.host = host
+        self.port = port
+        self.mode = mode
+        self.workers = workers
+        self.max_connections = max_connections
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.stop_event = threading.Event()
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.executor = None
+        self.request_executor = None
+        self.socket = None
+
+    def bind(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(LISTEN_BACKLOG)
+        self.host, self.port = self.socket.getsockname()[:2]
+        return self.socket
+
+    def serve_forever(self):
+        if not self.socket:
+            self.bind()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="client")
+        self.request_executor = PriorityExecutor(action_executor.classes, self.workers, thread_name_prefix="request")
+        stats_writer = None
+        if self.stats_file:
+            stats_writer = threading.Thread(target=self._write_stats, name="stats", daemon=True)
+            stats_writer.start()
+        try:
+            if self.mode == "asyncio":
+                asyncio.run(self._serve_asyncio())
+            else:
+                self._serve_threaded()
+        finally:
+            self.stop_event.set()
+            self.socket.close()
+            # Drain: wait for in-flight requests before returning
+            self.executor.shutdown(wait=True)
+            self.request_executor.shutdown(wait=True)
+            # Only actions abandoned after timing out can still be running, they are not waited for
+            action_executor.shutdown(wait=False)
+            if stats_writer:
+                stats_writer.join()
+            logger.info("Server stopped")
+
+    def shutdown(self):
+        self.stop_event.set()
+
+    def _write_stats(self):
+        # Once more after stopping, so the file ends with the final counts
+        while True:
+            stopped = self.stop_event.wait(self.stats_interval)
+            try:
+                metrics.write_prometheus_file(self.stats_file)
+            except OSError as e:
+                logger.warning("Writing stats to %s failed: %s", self.stats_file, e)
+            if stopped:
+                return
+
+    def _serve_threaded(self):
+        self.socket.settimeout(POLL_INTERVAL)
+        while not self.stop_event.is_set():
+            try:
+                client, address = self.socket.accept()
+            except socket.timeout:
+                continue
+            client.settimeout(None)
+            client = Connection(client)
+            if not self.connection_slots.acquire(blocking=False):
+                reject_client(client, address)
+                continue
+            logger.info("Accepted connection from %s", address)
+            self.executor.submit(self._run_client, client, address)
+
+    def _run_client(self, client, address):
+        try:
+            handle_client(client, address, self.stop_event, self.request_executor)
+        finally:
+            self.connection_slots.release()
+
+    async def _serve_asyncio(self):
+        loop = asyncio.get_running_loop()
+        self.socket.setblocking(False)
+        tasks = set()
+        while not self.stop_event.is_set():
+            try:
+                client, address = await asyncio.wait_for(loop.sock_accept(self.socket), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            client.setblocking(True)
+            client = Connection(client)
+            if not self.connection_slots.acquire(blocking=False):
+                await loop.run_in_executor(None, reject_client, client, address)
+                continue
+            logger.info("Accepted connection from %s", address)
+            task = asyncio.create_task(self._serve_client_async(client, address))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def _serve_client_async(self, client, address):
+        loop = asyncio.get_running_loop()
+        pipelined_slots = asyncio.Semaphore(MAX_PIPELINED_REQUESTS)
+        pipelined = set()
+        metrics.connection_opened(client)
+        try:
+            while await self._wait_readable(loop, client):
+                request = await loop.run_in_executor(self.executor, receive_request, client)
+                if not request:
+                    break
+                if request.request_id is None:
+                    await loop.run_in_executor(self.executor, process_request, client, request)
+                    continue
+                await pipelined_slots.acquire()
+                future = asyncio.wrap_future(schedule_request(self.request_executor, request, process_pipelined_request,
+                                                              client, request, time.perf_counter()))
+                pipelined.add(future)
+                future.add_done_callback(lambda done: (pipelined.discard(done), pipelined_slots.release()))
+        except Exception as e:
+            metrics.connection_error()
+            log_connection_error(e, f"Client connection error from {address}")
+        finally:
+            if pipelined:
+                await asyncio.gather(*pipelined)
+            metrics.connection_closed(client)
+            client.close()
+            self.connection_slots.release()
+
+    async def _wait_readable(self, loop, client):
+        while not self.stop_event.is_set():
+            if client.has_buffered_data():
+                return True
+            readable = loop.create_future()
+            loop.add_reader(client.fileno(), lambda: readable.done() or readable.set_result(True))
+            try:
+                await asyncio.wait_for(readable, POLL_INTERVAL)
+                return True
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                loop.remove_reader(client.fileno())
+        return False
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Remote administration server")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--mode", choices=CONCURRENCY_MODES, default="thread",
+                        help="Concurrency model used to serve clients")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of worker threads handling requests")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="Maximum number of simultaneous client connections")
+    parser.add_argument("--log-level", default=log.DEFAULT_LEVEL,
+                        choices=("DEBUG", "INFO", "WARNING", "ERROR"), type=str.upper,
+                        help="DEBUG logs every message sent and received")
+    parser.add_argument("--log-format", choices=log.LOG_FORMATS, default="text")
+    parser.add_argument("--log-file", help="Write the log to this file instead of stderr")
+    parser.add_argument("--log-payloads", action="store_true",
+                        help="Include file contents and other binary payloads in logged messages")
+    parser.add_argument("--stats-file", help="Write the metrics to this file in the Prometheus text format")
+    parser.add_argument("--stats-interval", type=float, default=DEFAULT_STATS_INTERVAL,
+                        help="Seconds between writes of the stats file")
+    parser.add_argument("--profile-slowest", type=int, default=0,
+                        help="Keep cProfile profiles of this many of the slowest requests per action")
+    parser.add_argument("--profile-sample-rate", type=float, default=DEFAULT_PROFILE_SAMPLE_RATE,
+                        help="Fraction of requests run under the profiler")
+    parser.add_argument("--action-workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help="Threads running slave actions, shared by all action classes")
+    parser.add_argument("--action-class", action="append", default=[], metavar="ACTION=CLASS",
+                        help=f"Run an action in another class: {', '.join(action_executor.classes)}")
+    parser.add_argument("--class-timeout", action="append", default=[], metavar="CLASS=SECONDS",
+                        help="Seconds before actions of a class time out, 0 for no limit")
+    parser.add_argument("--class-workers", action="append", default=[], metavar="CLASS=COUNT",
+                        help="Actions of a class running at once")
+    parser.add_argument("--cache-ttl", type=float, default=0,
+                        help=f"Seconds the responses of {', '.join(CACHEABLE_ACTIONS)} are cached, 0 to disable")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_BUDGET // (1024 * 1024),
+                        help="Megabytes of responses cached")
+    args = parser.parse_args()
+    if args.workers < 1 or args.action_workers < 1:
+        parser.error("--workers and --action-workers must be at least 1")
+    try:
+        args.classes, args.assignments = executor_settings(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+def parse_settings(values, convert):
+    settings = {}
+    for value in values:
+        name, separator, setting = value.partition("=")
+        if not separator:
+            raise ValueError(f"Expected NAME=VALUE, got {value}")
+        settings[name] = convert(setting)
+    return settings
+
+def executor_settings(args):
+    """
+    The action classes and per-action class assignments given by the --action-class and --class-* options.
+    Raises ValueError for malformed options, unknown classes, or actions assigned to a class they cannot run in.
+    """
+    classes = {name: replace(action_class) for name, action_class in action_executor.classes.items()}
+    assignments = parse_settings(args.action_class, str)
+    timeouts = parse_settings(args.class_timeout, float)
+    workers = parse_settings(args.class_workers, int)
+    unknown = (set(assignments.values()) | set(timeouts) | set(workers)) - set(classes)
+    if unknown:
+        raise ValueError(f"Unknown action classes: {', '.join(sorted(unknown))}")
+    for name, timeout in timeouts.items():
+        classes[name].timeout = timeout or None
+    for name, count in workers.items():
+        classes[name].workers = count
+    for action_name, class_name in assignments.items():
+        action = slave.ACTIONS.get(action_name)
+        if classes[class_name].process and action and (problem := process_problem(action)):
+            raise ValueError(f"{problem}, it cannot run in the {class_name} class")
+    return classes, assignments
+
+def check_worker_counts(args):
+    """
+    Warn when a pool of threads is too small to keep the top priority classes' workers free for them,
+    control actions may then wait behind others.
+    """
+    reserved = top_priority_workers(args.classes)
+    for option, count in (("--workers", args.workers), ("--action-workers", args.action_workers)):
+        if int(count * MAX_RESERVED_FRACTION) < reserved:
+            logger.warning("%s %d keeps only %d threads free for the %d control actions that may run at once, "
+                           "use at least %d", option, count, int(count * MAX_RESERVED_FRACTION), reserved,
+                           math.ceil(reserved / MAX_RESERVED_FRACTION))
+
 def main():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(("0.0.0.0", 12345))
-    server.listen(5)
-    print("Server started")
-    while True:
-        client, address = server.accept()
-        handle_client(client, address)
+    args = parse_args()
+    log.configure_logging(args.log_level, args.log_format, args.log_payloads, path=args.log_file)
+    check_worker_counts(args)
+    metrics.configure_profiling(args.profile_slowest, args.profile_sample_rate)
+    action_executor.configure(args.classes, args.action_workers, args.assignments)
+    response_cache.configure(args.cache_ttl, args.cache_size * 1024 * 1024)
+    server = Server(host=args.host, port=args.port, mode=args.mode,
+                    workers=args.workers, max_connections=args.max_connections,
+                    stats_file=args.stats_file, stats_interval=args.stats_interval)
+    server.bind()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: server.shutdown())
+    logger.info("Server started on %s:%s (%s mode)", server.host, server.port, server.mode)
+    server.serve_forever()
 
 if __name__ == "__main__":
     main()
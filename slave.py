@@ -1,50 +1,378 @@
 
+import io
 import os
+import sys
 import json
+import errno
+import shutil
+import fnmatch
 import subprocess
 import argparse
-import inspect
-from data.data_classes import Response, ParamTypes, Action, Param
+import time
+import queue
+import codecs
+import signal
+import tarfile
+import tempfile
+import threading
+import concurrent.futures
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import screen
+from log import get_logger
+from executor import on_cancel
+from archive import tree_stream, extract_tree
+from delta import file_signature, make_file_delta, apply_file_delta
+from transfer_cache import TransferCache, HashingWriter, write_atomically, DELTA_MIN_SIZE, DELTA_MAX_RATIO
+from data.data_classes import (Response, ParamTypes, ActionRegistry, Param, FileSource, StreamSource,
+                               file_bytes, parse_flag, write_file_value)
 
 SLAVE_MAJOR_VERSION = 1
 SLAVE_MINOR_VERSION = 0
 SLAVE_PATCH_VERSION = 0
 SLAVE_VERSION = f"{SLAVE_MAJOR_VERSION}.{SLAVE_MINOR_VERSION}.{SLAVE_PATCH_VERSION}"
 
+STREAM_READ_SIZE = 64 * 1024
+STREAM_QUEUE_SIZE = 16  # Output chunks buffered per streaming command before the command is paused
+LISTING_PAGE_SIZE = 1000
+MAX_LISTING_PAGE_SIZE = 10000
+LISTING_WORKERS = 8  # Directories scanned in parallel per walk_directory request
+MAX_LISTING_ERRORS = 100
+COPY_CHUNK_SIZE = 64 * 1024 * 1024  # Bytes per in-kernel copy call, progress is reported in between
+COPY_BUFFER_SIZE = 1024 * 1024  # Bytes per read where the kernel cannot copy between the two files
+COPY_WORKERS = 4  # Pairs copied in parallel per copy_file/move_file request
+MAX_COPY_WORKERS = 16
+MAX_COPY_ERRORS = 10  # Failed entries of a directory copy described in its response
+PROGRESS_MIN_SIZE = 64 * 1024 * 1024  # Smaller files are copied without progress reports
+PROGRESS_INTERVAL = 0.5  # Seconds between progress reports of a file
+SCREEN_STREAM_DURATION = 10  # Seconds stream_screen runs for unless told otherwise
+MAX_SCREEN_STREAM_DURATION = 3600
+MAX_SCREEN_FPS = 30
+FULL_FRAME_RATIO = 0.5  # Frames changed over more than this share of their area are sent as one tile
+TRANSFER_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), "slave-transfer-cache")
+# copy_file_range and sendfile fail with these where they cannot copy between the two files
+UNSUPPORTED_COPY_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK}
+
+# Filled by the @ACTIONS.action decorators below
+ACTIONS = ActionRegistry()
+logger = get_logger(__name__)
+# Contents uploaded by clients that keep a transfer cache, and the digests of the files they download
+TRANSFER_CACHE = TransferCache(TRANSFER_CACHE_DIRECTORY)
+
 def format_message_response(is_success, message):
-    function_that_called = inspect.stack()[1].function
-    print(f"Function {function_that_called} called") # DEBUG
-    action = [action for action in ACTIONS if action.function.__name__ == function_that_called][0]
-    return Response(success=is_success, message=message, type=action.response_type, slave_version=SLAVE_VERSION)
+    # The response type is set by the action's registry entry
+    return Response(success=is_success, message=message, slave_version=SLAVE_VERSION)
 
-def take_screen_shot(_):
+def legacy_screen_shot():
+    """
+    Capture the screen to a PNG file with the platform's screenshot command, where it cannot be done in-process.
+    """
+    # One file per worker thread, so concurrent requests do not overwrite each other's capture
+    # before it has been sent. It is sent straight from disk and reused by the thread's next capture.
+    screenshot_path = os.path.join(tempfile.gettempdir(), f"screenshot-{os.getpid()}-{threading.get_ident()}.png")
+    if os.path.exists(screenshot_path):
+        os.remove(screenshot_path)
     if os.name == 'nt':  # Windows
         import pyautogui
         screenshot = pyautogui.screenshot()
-        screenshot.save("screenshot.png")
+        screenshot.save(screenshot_path)
     else:  # macOS and Linux
-        subprocess.run(["screencapture", "screenshot.png"] if os.name == 'posix' and os.uname().sysname == 'Darwin' else ["import", "-window", "root", "screenshot.png"])
-    with open("screenshot.png", "rb") as f:
-        image = f.read()
-    return format_message_response(True, image.decode("latin-1"))
+        subprocess.run(["screencapture", screenshot_path] if os.name == 'posix' and os.uname().sysname == 'Darwin' else ["import", "-window", "root", screenshot_path])
+    if not os.path.exists(screenshot_path):
+        return format_message_response(False, "Failed to take screenshot")
+    return format_message_response(True, FileSource(screenshot_path))
+
+def parse_screen_options(params):
+    """
+    The region (x, y, width, height), scale factor, image format and quality asked for, checked.
+    """
+    region = params.get("region")
+    if region:
+        region = tuple(int(value) for value in region.split(","))
+        if len(region) != 4 or region[2] <= 0 or region[3] <= 0:
+            raise ValueError("region must be x,y,width,height")
+    scale = float(params.get("scale") or 1)
+    if not 0 < scale <= 1:
+        raise ValueError("scale must be above 0 and at most 1")
+    image_format = (params.get("format") or "png").lower().replace("jpg", "jpeg")
+    if image_format not in screen.FORMATS:
+        raise ValueError(f"format must be one of {', '.join(screen.FORMATS)}")
+    quality = parse_count(params, "quality", None, 1, 100)
+    return region or None, scale, image_format, quality
+
+SCREEN_PARAMS = [
+    Param(name="region", type=ParamTypes.STRING, required=False),
+    Param(name="scale", type=ParamTypes.STRING, required=False),
+    Param(name="format", type=ParamTypes.STRING, required=False),
+    Param(name="quality", type=ParamTypes.STRING, required=False)
+]
+
+# Encoding is CPU-bound, a worker process keeps it off the server's threads
+@ACTIONS.action(action_class="cpu", params=SCREEN_PARAMS, response_type=ParamTypes.FILE)
+def take_screen_shot(params):
+    """
+    Capture the screen, or the x,y,width,height "region" of it, scaled down by "scale" and encoded as
+    "format" (png, jpeg or webp) at "quality", in memory. Where the screen cannot be captured in-process
+    the platform's screenshot command is used instead, which only takes full screen PNGs.
+    """
+    try:
+        region, scale, image_format, quality = parse_screen_options(params)
+    except ValueError as e:
+        return format_message_response(False, f"Invalid parameters: {e}")
+    try:
+        frame = screen.capture(region)
+    except screen.CaptureError as e:
+        logger.info("Falling back to the screenshot command: %s", e)
+        return legacy_screen_shot()
+    try:
+        return format_message_response(True, screen.encode(frame.scaled(scale), image_format, quality))
+    except ValueError as e:
+        return format_message_response(False, str(e))
+
+def screen_frames(region, scale, image_format, quality, tile_size, interval, duration):
+    """
+    Yield partial responses with the tiles of the screen that changed since the previous frame,
+    every interval seconds for duration seconds, then a final response with totals.
+    Frames are only sent when something changed; where most of it did, as one tile.
+    """
+    deadline = time.monotonic() + duration
+    previous = None
+    frames = frames_sent = tiles_sent = bytes_sent = 0
+    while True:
+        started = time.monotonic()
+        frame = screen.capture(region).scaled(scale)
+        tiles = screen.changed_tiles(previous, frame, tile_size)
+        if sum(width * height for _, _, width, height in tiles) > frame.width * frame.height * FULL_FRAME_RATIO:
+            tiles = [(0, 0, frame.width, frame.height)]
+        if tiles:
+            encoded = [{"x": x, "y": y, "width": width, "height": height,
+                        "data": screen.encode(frame.crop(x, y, width, height), image_format, quality)}
+                       for x, y, width, height in tiles]
+            frames_sent += 1
+            tiles_sent += len(encoded)
+            bytes_sent += sum(len(tile["data"]) for tile in encoded)
+            message = {"frame": frames, "width": frame.width, "height": frame.height, "tiles": encoded}
+            yield Response(success=True, message=message, stream="frames", partial=True, slave_version=SLAVE_VERSION)
+        previous = frame
+        frames += 1
+        if time.monotonic() + interval > deadline:
+            break
+        time.sleep(max(interval - (time.monotonic() - started), 0))
+    message = {"frames_captured": frames, "frames_sent": frames_sent, "tiles_sent": tiles_sent,
+               "bytes_sent": bytes_sent}
+    yield Response(success=True, message=message, slave_version=SLAVE_VERSION)
+
+@ACTIONS.action(action_class="bulk", params=SCREEN_PARAMS + [
+    Param(name="fps", type=ParamTypes.STRING, required=False),
+    Param(name="duration", type=ParamTypes.STRING, required=False),
+    Param(name="tile_size", type=ParamTypes.STRING, required=False)
+])
+def stream_screen(params):
+    """
+    Watch the screen at "fps" frames per second for "duration" seconds, streaming the first frame whole and then
+    only the tile_size squares that changed, merged into rectangles, each encoded as for take_screen_shot.
+    Every frame is {frame, width, height, tiles: [{x, y, width, height, data}]}, painted over the previous one.
+    """
+    try:
+        region, scale, image_format, quality = parse_screen_options(params)
+        fps = float(params.get("fps") or 1)
+        if not 0 < fps <= MAX_SCREEN_FPS:
+            raise ValueError(f"fps must be above 0 and at most {MAX_SCREEN_FPS}")
+        duration = float(params.get("duration") or SCREEN_STREAM_DURATION)
+        if not 0 < duration <= MAX_SCREEN_STREAM_DURATION:
+            raise ValueError(f"duration must be above 0 and at most {MAX_SCREEN_STREAM_DURATION}")
+        tile_size = parse_count(params, "tile_size", screen.DEFAULT_TILE_SIZE, 8, 1024)
+    except ValueError as e:
+        return format_message_response(False, f"Invalid parameters: {e}")
+    return screen_frames(region, scale, image_format, quality, tile_size, 1 / fps, duration)
+
+def parse_offset(params):
+    """
+    Byte offset to resume a partial transfer from, 0 when not given.
+    """
+    offset = params.get("offset")
+    if offset in (None, ""):
+        return 0
+    offset = int(offset)
+    if offset < 0:
+        raise ValueError("Offset must not be negative")
+    return offset
 
+@ACTIONS.action(action_class="bulk", params=[
+    Param(name="file_data", type=ParamTypes.FILE),
+    Param(name="destination_path", type=ParamTypes.STRING),
+    Param(name="offset", type=ParamTypes.STRING, required=False),
+    Param(name="digest", type=ParamTypes.STRING, required=False)
+])
 def upload_file(params):
+    """
+    Write an uploaded file, from offset on when resuming. Given the SHA-256 "digest" of the whole file, as
+    clients keeping a transfer cache send it, the result is checked against it and kept for upload_cached.
+    """
     file_data = params.get("file_data")
     destination_path = params.get("destination_path")
     if not file_data or not destination_path:
         return format_message_response(False, "Invalid parameters")
-    with open(destination_path, "wb") as f:
-        f.write(file_data.encode("latin-1"))
+    try:
+        offset = parse_offset(params)
+    except ValueError:
+        return format_message_response(False, "Invalid offset")
+    # Resuming keeps the first offset bytes already uploaded
+    with open(destination_path, "r+b" if offset and os.path.exists(destination_path) else "wb") as f:
+        f.seek(offset)
+        f.truncate()
+        write_file_value(file_data, f)
+    digest = params.get("digest")
+    if digest:
+        if TRANSFER_CACHE.digest(destination_path) != digest:
+            return format_message_response(False, f"File uploaded to {destination_path} does not match its digest")
+        TRANSFER_CACHE.add(destination_path, digest)
     return format_message_response(True, f"File uploaded to {destination_path}")
 
+@ACTIONS.action(action_class="bulk", params=[
+    Param(name="destination_path", type=ParamTypes.STRING),
+    Param(name="digest", type=ParamTypes.STRING)
+])
+def upload_cached(params):
+    """
+    Put the file with the given SHA-256 at destination_path without it being sent, if the destination
+    already has it or the transfer cache kept it from an earlier upload. Otherwise responds unsuccessfully
+    with {"missing": digest}, plus the "base" digest and "signature" of the destination's current contents
+    when those are large enough for upload_delta to be worth it.
+    """
+    destination_path = params.get("destination_path")
+    digest = params.get("digest")
+    if not destination_path or not digest:
+        return format_message_response(False, "Invalid parameters")
+    exists = os.path.isfile(destination_path)
+    if exists and TRANSFER_CACHE.digest(destination_path) == digest:
+        return format_message_response(True, {"cached": digest})
+    if TRANSFER_CACHE.restore(digest, destination_path):
+        return format_message_response(True, {"cached": digest})
+    message = {"missing": digest}
+    if exists and os.path.getsize(destination_path) >= DELTA_MIN_SIZE:
+        message["base"] = TRANSFER_CACHE.digest(destination_path)
+        message["signature"] = file_signature(destination_path)
+    return format_message_response(False, message)
+
+@ACTIONS.action(action_class="bulk", params=[
+    Param(name="delta", type=ParamTypes.FILE),
+    Param(name="destination_path", type=ParamTypes.STRING),
+    Param(name="base", type=ParamTypes.STRING),
+    Param(name="digest", type=ParamTypes.STRING)
+])
+def upload_delta(params):
+    """
+    Rebuild the file at destination_path from a delta against its current contents, whose SHA-256 is base,
+    as offered by upload_cached. The destination is only replaced if the result has the given digest.
+    """
+    delta = params.get("delta")
+    destination_path = params.get("destination_path")
+    base = params.get("base")
+    digest = params.get("digest")
+    if not delta or not destination_path or not base or not digest:
+        return format_message_response(False, "Invalid parameters")
+    if not os.path.isfile(destination_path) or TRANSFER_CACHE.digest(destination_path) != base:
+        return format_message_response(False, "Destination changed since its signature was made")
+    if hasattr(delta, "read"):
+        delta.seek(0)
+    else:
+        delta = io.BytesIO(file_bytes(delta))
+
+    def write(f):
+        writer = HashingWriter(f)
+        apply_file_delta(destination_path, delta, writer)
+        if writer.hexdigest() != digest:
+            raise ValueError("Patched file does not match its digest")
+
+    try:
+        write_atomically(destination_path, write)
+    except ValueError as e:
+        return format_message_response(False, f"Failed to apply delta: {e}")
+    TRANSFER_CACHE.add(destination_path, digest)
+    return format_message_response(True, f"File patched at {destination_path}")
+
+@ACTIONS.action(action_class="bulk", params=[
+    Param(name="file_path", type=ParamTypes.STRING),
+    Param(name="offset", type=ParamTypes.STRING, required=False),
+    Param(name="have", type=ParamTypes.STRING, required=False),
+    Param(name="signature", type=ParamTypes.FILE, required=False)
+], response_type=ParamTypes.FILE)
 def download_file(params):
+    """
+    Send a file, from offset on when resuming.
+    Clients keeping a transfer cache list the SHA-256 digests of the versions they have in "have", comma
+    separated, and may send the "signature" of one of them. They are answered with {"cached": digest}
+    when they have the current contents, {"digest", "delta"} with a delta against the signed version,
+    or {"digest", "file"}.
+    """
     file_name = params.get("file_path")
     if not file_name or not os.path.exists(file_name):
         return format_message_response(False, "File not found")
-    with open(file_name, "rb") as f:
-        file_data = f.read()
-    return format_message_response(True, file_data.decode("latin-1"))
+    if "have" in params:
+        return cached_download(file_name, params.get("have") or "", params.get("signature"))
+    try:
+        offset = parse_offset(params)
+    except ValueError:
+        return format_message_response(False, "Invalid offset")
+    return format_message_response(True, FileSource(file_name, offset))
+
+def cached_download(file_name, have, signature):
+    digest = TRANSFER_CACHE.digest(file_name)
+    if digest in have.split(","):
+        return format_message_response(True, {"cached": digest})
+    size = os.path.getsize(file_name)
+    if signature and size >= DELTA_MIN_SIZE:
+        delta = tempfile.TemporaryFile()
+        try:
+            make_file_delta(file_name, file_bytes(signature), delta)
+        except ValueError as e:
+            logger.warning("Ignoring the signature sent for %s: %s", file_name, e)
+        else:
+            if delta.tell() < size * DELTA_MAX_RATIO:
+                delta.seek(0)
+                return format_message_response(True, {"digest": digest, "delta": StreamSource(delta)})
+        delta.close()
+    return format_message_response(True, {"digest": digest, "file": FileSource(file_name)})
+
+@ACTIONS.action(action_class="bulk", params=[
+    Param(name="directory", type=ParamTypes.STRING),
+    Param(name="compress", type=ParamTypes.STRING, required=False)
+], response_type=ParamTypes.FILE)
+def download_tree(params):
+    """
+    Send a directory tree as a tar archive, streamed while it is being written.
+    With compress it is compressed on the way if the connection negotiated a compression.
+    """
+    directory = params.get("directory")
+    if not directory or not os.path.isdir(directory):
+        return format_message_response(False, "Invalid directory")
+    return format_message_response(True, StreamSource(tree_stream(directory), parse_flag(params.get("compress"))))
+
+@ACTIONS.action(action_class="bulk", params=[
+    Param(name="archive", type=ParamTypes.FILE),
+    Param(name="destination", type=ParamTypes.STRING)
+])
+def upload_tree(params):
+    """
+    Extract a tar archive, as sent by download_tree or the client's upload_tree, into a directory.
+    """
+    archive = params.get("archive")
+    destination = params.get("destination")
+    if not archive or not destination:
+        return format_message_response(False, "Invalid parameters")
+    if not hasattr(archive, "read"):
+        archive = io.BytesIO(archive)
+    archive.seek(0)
+    try:
+        count = extract_tree(archive, destination)
+    except (tarfile.TarError, OSError) as e:
+        return format_message_response(False, f"Extracting the archive failed: {e}")
+    return format_message_response(True, f"Extracted {count} entries to {destination}")
 
+@ACTIONS.action(action_class="control", params=[
+    Param(name="text", type=ParamTypes.STRING)
+])
 def set_clipboard(params):
     text = params.get("text")
     if not text:
@@ -53,11 +381,15 @@ def set_clipboard(params):
     process.communicate(text.encode("utf-8"))
     return format_message_response(True, "Clipboard set")
 
+@ACTIONS.action(action_class="control")
 def get_clipboard(_):
     process = subprocess.Popen("pbpaste", stdout=subprocess.PIPE)
     output, _ = process.communicate()
     return format_message_response(True, output.decode("utf-8"))
 
+@ACTIONS.action(params=[
+    Param(name="directory", type=ParamTypes.STRING)
+])
 def list_directory(params):
     directory = params.get("directory")
     if not directory or not os.path.exists(directory):
@@ -65,6 +397,128 @@ def list_directory(params):
     files = os.listdir(directory)
     return format_message_response(True, files)
 
+def parse_count(params, name, default=None, minimum=0, maximum=None):
+    value = params.get(name)
+    if value in (None, ""):
+        return default
+    value = int(value)
+    if value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return min(value, maximum) if maximum else value
+
+def parse_patterns(value):
+    return [pattern.strip() for pattern in (value or "").split(",") if pattern.strip()]
+
+def matches_any(patterns, relative_path, name):
+    return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def entry_type(entry):
+    # Answered from the directory listing itself on most platforms, without a stat call
+    if entry.is_symlink():
+        return "link"
+    if entry.is_dir(follow_symlinks=False):
+        return "dir"
+    if entry.is_file(follow_symlinks=False):
+        return "file"
+    return "other"
+
+def scan_directory(path, relative_path):
+    """
+    Entries of one directory as (path, path relative to the walk's root, name, type, size, mtime).
+    """
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # Removed while being listed
+            entries.append((entry.path, os.path.join(relative_path, entry.name), entry.name,
+                            entry_type(entry), stat.st_size, stat.st_mtime))
+    return entries
+
+def walk_tree(root, max_depth=None, pattern=None, include=(), exclude=(), page_size=LISTING_PAGE_SIZE):
+    """
+    Yield partial responses with pages of entries below root, then a final response with totals.
+    Directories are scanned LISTING_WORKERS at a time, so entries come in no particular order.
+    Excluded directories are not descended into, symlinked directories are not followed.
+    """
+    directories = deque([(root, "", 0)])
+    pending = {}
+    page = []
+    total = scanned = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=LISTING_WORKERS, thread_name_prefix="walk") as executor:
+        try:
+            while directories or pending:
+                # Only a few directories ahead of what has been sent, so a slow client bounds the memory used
+                while directories and len(pending) < LISTING_WORKERS * 2:
+                    path, relative_path, depth = directories.popleft()
+                    pending[executor.submit(scan_directory, path, relative_path)] = (relative_path, depth)
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    relative_path, depth = pending.pop(future)
+                    scanned += 1
+                    try:
+                        entries = future.result()
+                    except OSError as e:
+                        if len(errors) < MAX_LISTING_ERRORS:
+                            errors.append({"path": relative_path or ".", "error": str(e)})
+                        continue
+                    for path, entry_path, name, kind, size, mtime in entries:
+                        if exclude and matches_any(exclude, entry_path, name):
+                            continue
+                        if kind == "dir" and (max_depth is None or depth < max_depth):
+                            directories.append((path, entry_path, depth + 1))
+                        if pattern and not fnmatch.fnmatch(name, pattern):
+                            continue
+                        if include and not matches_any(include, entry_path, name):
+                            continue
+                        page.append({"path": entry_path, "type": kind, "size": size, "mtime": mtime})
+                        if len(page) >= page_size:
+                            total += len(page)
+                            yield Response(success=True, message=page, stream="entries", partial=True,
+                                           slave_version=SLAVE_VERSION)
+                            page = []
+        finally:
+            # Abandoned early (the client went away): skip the directories not scanned yet
+            for future in pending:
+                future.cancel()
+    if page:
+        total += len(page)
+        yield Response(success=True, message=page, stream="entries", partial=True, slave_version=SLAVE_VERSION)
+    message = {"total_entries": total, "directories_scanned": scanned, "errors": errors}
+    yield Response(success=True, message=message, slave_version=SLAVE_VERSION)
+
+@ACTIONS.action(params=[
+    Param(name="directory", type=ParamTypes.STRING),
+    Param(name="max_depth", type=ParamTypes.STRING, required=False),
+    Param(name="pattern", type=ParamTypes.STRING, required=False),
+    Param(name="include", type=ParamTypes.STRING, required=False),
+    Param(name="exclude", type=ParamTypes.STRING, required=False),
+    Param(name="page_size", type=ParamTypes.STRING, required=False)
+])
+def walk_directory(params):
+    """
+    Recursive listing with the path relative to directory, type, size and mtime of every entry,
+    streamed in pages. max_depth limits how many levels below directory are descended into,
+    pattern is a glob the entry names must match, include and exclude are comma separated globs
+    matched against the relative path or the name.
+    """
+    directory = params.get("directory")
+    if not directory or not os.path.isdir(directory):
+        return format_message_response(False, "Invalid directory")
+    try:
+        max_depth = parse_count(params, "max_depth")
+        page_size = parse_count(params, "page_size", LISTING_PAGE_SIZE, 1, MAX_LISTING_PAGE_SIZE)
+    except ValueError as e:
+        return format_message_response(False, f"Invalid parameters: {e}")
+    return walk_tree(directory, max_depth, params.get("pattern") or None, parse_patterns(params.get("include")),
+                     parse_patterns(params.get("exclude")), page_size)
+
+@ACTIONS.action(params=[
+    Param(name="file", type=ParamTypes.STRING)
+])
 def rm_file(params):
     file = params.get("file")
     if not file or not os.path.exists(file):
@@ -72,91 +526,323 @@ def rm_file(params):
     os.remove(file)
     return format_message_response(True, "File removed")
 
+def _copy_file_range(source_fd, destination_fd):
+    return os.copy_file_range(source_fd, destination_fd, COPY_CHUNK_SIZE)
+
+def _sendfile(source_fd, destination_fd):
+    return os.sendfile(destination_fd, source_fd, None, COPY_CHUNK_SIZE)
+
+def _read_write(source_fd, destination_fd):
+    data = memoryview(os.read(source_fd, COPY_BUFFER_SIZE))
+    written = 0
+    while written < len(data):
+        written += os.write(destination_fd, data[written:])
+    return len(data)
+
+# Fastest first: copy_file_range copies inside the kernel, sharing blocks on copy-on-write filesystems,
+# sendfile inside the kernel as well, and plain reads and writes work everywhere else
+COPY_METHODS = [method for method, available in (
+    (_copy_file_range, hasattr(os, "copy_file_range")),
+    (_sendfile, sys.platform.startswith("linux")),
+    (_read_write, True),
+) if available]
+
+def copy_data(source_fd, destination_fd, report=None):
+    """
+    Copy the rest of source_fd into destination_fd with the fastest method that works for the two files.
+    report(copied) is called after every chunk. Returns the number of bytes copied.
+    """
+    copied = 0
+    for method in COPY_METHODS:
+        try:
+            while True:
+                count = method(source_fd, destination_fd)
+                if not count:
+                    return copied
+                copied += count
+                if report:
+                    report(copied)
+        except OSError as e:
+            # Only fall back to the next method before anything has been copied with this one
+            if copied or e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+    return copied
+
+def copy_contents(source, destination, on_progress=None, copy_metadata=shutil.copymode):
+    """
+    Copy a file's contents and, by default, its permissions like cp does.
+    on_progress(source, copied, total) is called every PROGRESS_INTERVAL while files of at least
+    PROGRESS_MIN_SIZE are copied. Returns destination, so it can be used as shutil's copy_function.
+    """
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        raise shutil.SameFileError(f"{source} and {destination} are the same file")
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        total = os.fstat(source_file.fileno()).st_size
+        report = None
+        if on_progress and total >= PROGRESS_MIN_SIZE:
+            last_report = time.monotonic()
+
+            def report(copied):
+                nonlocal last_report
+                now = time.monotonic()
+                if copied >= total or now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    on_progress(source, copied, total)
+
+        copy_data(source_file.fileno(), destination_file.fileno(), report)
+    copy_metadata(source, destination)
+    return destination
+
+def copy_path(source, destination, on_progress=None):
+    """
+    Copy a file, or a directory recursively with symlinks copied as symlinks, the way cp -r does:
+    into destination if that is an existing directory. Returns the path copied to.
+    """
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(os.path.normpath(source)))
+    copy_function = lambda source_path, destination_path: copy_contents(source_path, destination_path, on_progress)
+    if not os.path.isdir(source):
+        return copy_function(source, destination)
+    real_source = os.path.realpath(source)
+    real_destination = os.path.realpath(destination)
+    if real_destination == real_source or real_destination.startswith(real_source + os.sep):
+        raise ValueError(f"Cannot copy {source} into itself")
+    return shutil.copytree(source, destination, symlinks=True, copy_function=copy_function, dirs_exist_ok=True)
+
+def move_path(source, destination, on_progress=None):
+    """
+    Move a file or directory the way mv does: renamed where possible, otherwise copied to the other
+    filesystem, keeping timestamps, and then removed. Returns the path moved to.
+    """
+    copy_function = lambda source_path, destination_path: copy_contents(source_path, destination_path, on_progress,
+                                                                       copy_metadata=shutil.copystat)
+    return shutil.move(source, destination, copy_function=copy_function)
+
+def describe_copy_error(error):
+    if isinstance(error, shutil.Error) and error.args and isinstance(error.args[0], list):
+        # copytree goes on past failing entries and raises them all together
+        failures = error.args[0]
+        details = "; ".join(f"{source}: {reason}" for source, _, reason in failures[:MAX_COPY_ERRORS])
+        return f"{len(failures)} entries failed: {details}"
+    return str(error)
+
+def parse_pairs(params):
+    """
+    The (source, destination) pairs to copy or move: "pairs", a JSON list of {source, destination}
+    objects or [source, destination] lists, or otherwise the single "source" and "destination".
+    """
+    pairs = params.get("pairs")
+    if pairs in (None, ""):
+        if not params.get("source") or not params.get("destination"):
+            raise ValueError("source and destination, or pairs, are required")
+        return [(params["source"], params["destination"])]
+    if isinstance(pairs, str):
+        pairs = json.loads(pairs)
+    if not isinstance(pairs, list) or not pairs:
+        raise ValueError("pairs must be a non-empty list")
+    parsed = []
+    for pair in pairs:
+        if isinstance(pair, dict):
+            pair = (pair.get("source"), pair.get("destination"))
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2 or not all(pair):
+            raise ValueError("Every pair needs a source and a destination")
+        parsed.append((pair[0], pair[1]))
+    return parsed
+
+# Present and past tense of the transfers, for their responses
+TRANSFER_VERBS = {copy_path: ("copy", "copied"), move_path: ("move", "moved")}
+
+def transfer_pair(transfer, source, destination, on_progress=None):
+    """
+    Copy or move one pair, describing the outcome instead of raising.
+    """
+    verb, past = TRANSFER_VERBS[transfer]
+    try:
+        target = transfer(source, destination, on_progress)
+    except (OSError, ValueError, shutil.Error) as e:
+        return {"source": source, "destination": destination, "success": False,
+                "message": f"Failed to {verb} {source}: {describe_copy_error(e)}"}
+    return {"source": source, "destination": target, "success": True, "message": f"{source} {past} to {target}"}
+
+def transfer_response(results, batch):
+    # A single pair answers with its message alone, as copy_file always has
+    success = all(result["success"] for result in results)
+    return format_message_response(success, results if batch else results[0]["message"])
+
+def stream_transfer_progress(transfer, pairs, parallel, batch):
+    """
+    Yield partial responses with pages of {source, copied, total} progress reports while the pairs
+    are transferred, then the final response.
+    """
+    updates = queue.Queue()
+    abandoned = threading.Event()
+
+    def on_progress(source, copied, total):
+        if abandoned.is_set():
+            raise InterruptedError("Abandoned by the client")
+        updates.put({"source": source, "copied": copied, "total": total})
+
+    def run(pair):
+        try:
+            return transfer_pair(transfer, *pair, on_progress)
+        finally:
+            updates.put(None)
+
+    executor = ThreadPoolExecutor(max_workers=min(parallel, len(pairs)), thread_name_prefix="transfer")
+    futures = [executor.submit(run, pair) for pair in pairs]
+    remaining = len(pairs)
+    try:
+        while remaining:
+            page = [updates.get()]
+            while not updates.empty():
+                page.append(updates.get_nowait())
+            remaining -= page.count(None)
+            page = [update for update in page if update]
+            if page:
+                yield Response(success=True, message=page, stream="progress", partial=True, slave_version=SLAVE_VERSION)
+        yield transfer_response([future.result() for future in futures], batch)
+    finally:
+        # Abandoned early (the client went away): stop the copies at their next progress report
+        abandoned.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def transfer_paths(params, transfer):
+    try:
+        pairs = parse_pairs(params)
+        parallel = parse_count(params, "parallel", COPY_WORKERS, 1, MAX_COPY_WORKERS)
+    except ValueError as e:
+        return format_message_response(False, f"Invalid parameters: {e}")
+    batch = params.get("pairs") not in (None, "")
+    if parse_flag(params.get("progress")):
+        return stream_transfer_progress(transfer, pairs, parallel, batch)
+    if len(pairs) == 1:
+        return transfer_response([transfer_pair(transfer, *pairs[0])], batch)
+    with ThreadPoolExecutor(max_workers=min(parallel, len(pairs)), thread_name_prefix="transfer") as executor:
+        results = list(executor.map(lambda pair: transfer_pair(transfer, *pair), pairs))
+    return transfer_response(results, batch)
+
+TRANSFER_PARAMS = [
+    Param(name="source", type=ParamTypes.STRING, required=False),
+    Param(name="destination", type=ParamTypes.STRING, required=False),
+    Param(name="pairs", type=ParamTypes.STRING, required=False),
+    Param(name="parallel", type=ParamTypes.STRING, required=False),
+    Param(name="progress", type=ParamTypes.STRING, required=False)
+]
+
+@ACTIONS.action(action_class="bulk", params=TRANSFER_PARAMS)
 def copy_file(params):
-    source = params.get("source")
-    destination = params.get("destination")
-    if not source or not destination or not os.path.exists(source):
-        return format_message_response(False, "Invalid source or destination")
-    os.system(f"cp {source} {destination}")
-    return format_message_response(True, "File copied")
+    """
+    Copy a file, or a directory recursively, from source to destination, or every pair in "pairs",
+    up to "parallel" pairs at a time. The data is copied inside the kernel where the platform allows.
+    With "progress" the copied bytes of large files are streamed while they are copied.
+    A batch responds with one {source, destination, success, message} result per pair.
+    """
+    return transfer_paths(params, copy_path)
+
+@ACTIONS.action(action_class="bulk", params=TRANSFER_PARAMS)
+def move_file(params):
+    """
+    Move a file or directory from source to destination, or every pair in "pairs", like copy_file does.
+    Moves within a filesystem are renames, moves across filesystems copy and then remove the source.
+    """
+    return transfer_paths(params, move_path)
+
+def parse_timeout(params):
+    timeout = params.get("timeout")
+    if timeout in (None, ""):
+        return None
+    timeout = float(timeout)
+    if timeout <= 0:
+        raise ValueError("Timeout must be positive")
+    return timeout
+
+def kill_process(process):
+    """
+    Kill a command started by run_command together with the processes it spawned,
+    which would otherwise keep its output pipes open.
+    """
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+            return
+        except ProcessLookupError:
+            pass
+    process.kill()
 
+def _pipe_reader(pipe, stream_name, chunks):
+    # The queue is bounded: when the client falls behind this blocks, the pipe fills up
+    # and the command itself waits, instead of its output piling up in memory
+    for chunk in iter(lambda: pipe.read1(STREAM_READ_SIZE), b""):
+        chunks.put((stream_name, chunk))
+    pipe.close()
+    chunks.put((stream_name, None))
+
+def stream_process_output(process, timeout=None):
+    """
+    Yield partial responses with the process's stdout and stderr as they are written,
+    then a final response with its exit code. The process is killed once the timeout passes.
+    """
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    for pipe, stream_name in ((process.stdout, "stdout"), (process.stderr, "stderr")):
+        threading.Thread(target=_pipe_reader, args=(pipe, stream_name, chunks), daemon=True).start()
+    decoders = {name: codecs.getincrementaldecoder("utf-8")(errors="replace") for name in ("stdout", "stderr")}
+    deadline = time.monotonic() + timeout if timeout else None
+    open_streams = 2
+    timed_out = False
+    try:
+        while open_streams:
+            try:
+                wait = max(deadline - time.monotonic(), 0) if deadline and not timed_out else None
+                stream_name, chunk = chunks.get(timeout=wait)
+            except queue.Empty:
+                timed_out = True
+                kill_process(process)
+                continue
+            if chunk is None:
+                open_streams -= 1
+                text = decoders[stream_name].decode(b"", final=True)
+            else:
+                text = decoders[stream_name].decode(chunk)
+            if text:
+                yield Response(success=True, message=text, stream=stream_name, partial=True, slave_version=SLAVE_VERSION)
+        exit_code = process.wait()
+        message = {"exit_code": exit_code, "timed_out": timed_out}
+        yield Response(success=not timed_out, message=message, slave_version=SLAVE_VERSION)
+    finally:
+        # Abandoned early (the client went away): stop the command and unblock the reader threads
+        if process.poll() is None:
+            kill_process(process)
+        while open_streams:
+            if chunks.get()[1] is None:
+                open_streams -= 1
+
+@ACTIONS.action(action_class="command", params=[
+    Param(name="command", type=ParamTypes.STRING),
+    Param(name="stream", type=ParamTypes.STRING, required=False),
+    Param(name="timeout", type=ParamTypes.STRING, required=False)
+])
 def run_command(params):
     command = params.get("command")
     if not command:
         return format_message_response(False, "Invalid command")
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
+    try:
+        timeout = parse_timeout(params)
+    except ValueError:
+        return format_message_response(False, "Invalid timeout")
+    # Its own process group, so a timeout can kill everything the shell started
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               start_new_session=os.name == 'posix')
+    if parse_flag(params.get("stream")):
+        return stream_process_output(process, timeout)
+    # Killed when the executor gives up on the command, instead of leaving it running
+    on_cancel(lambda: kill_process(process))
+    try:
+        output, error = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process(process)
+        output, error = process.communicate()
+        return format_message_response(False, f"Command timed out after {timeout} seconds\n"
+                                              + output.decode("utf-8") + error.decode("utf-8"))
     return format_message_response(True, output.decode("utf-8") + error.decode("utf-8"))
-
-ACTIONS = [
-    Action(
-        name="take_screen_shot",
-        params=[],
-        response_type=ParamTypes.FILE,
-        function=take_screen_shot
-    ),
-    Action(
-        name="upload_file",
-        params=[
-            Param(name="file_data", type=ParamTypes.FILE),
-            Param(name="destination_path", type=ParamTypes.STRING)
-        ],
-        response_type=ParamTypes.STRING,
-        function=upload_file
-    ),
-    Action(
-        name="download_file",
-        params=[
-            Param(name="file_path", type=ParamTypes.STRING)
-        ],
-        response_type=ParamTypes.FILE,
-        function=download_file
-    ),
-    Action(
-        name="set_clipboard",
-        params=[
-            Param(name="text", type=ParamTypes.STRING)
-        ],
-        response_type=ParamTypes.STRING,
-        function=set_clipboard
-    ),
-    Action(
-        name="get_clipboard",
-        params=[],
-        response_type=ParamTypes.STRING,
-        function=get_clipboard
-    ),
-    Action(
-        name="list_directory",
-        params=[
-            Param(name="directory", type=ParamTypes.STRING)
-        ],
-        response_type=ParamTypes.STRING,
-        function=list_directory
-    ),
-    Action(
-        name="rm_file",
-        params=[
-            Param(name="file", type=ParamTypes.STRING)
-        ],
-        response_type=ParamTypes.STRING,
-        function=rm_file
-    ),
-    Action(
-        name="copy_file",
-        params=[
-            Param(name="source", type=ParamTypes.STRING),
-            Param(name="destination", type=ParamTypes.STRING)
-        ],
-        response_type=ParamTypes.STRING,
-        function=copy_file
-    ),
-    Action(
-        name="run_command",
-        params=[
-            Param(name="command", type=ParamTypes.STRING)
-        ],
-        response_type=ParamTypes.STRING,
-        function=run_command
-    )
-]
\ No newline at end of file
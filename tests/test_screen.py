@@ -0,0 +1,61 @@
+"""
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import unittest
+from unittest import mock
+
+import screen
+from screen import Frame
+
+
+def blank(width, height):
+    return Frame(width, height, b"\0\0\0\xff" * width * height)
+
+
+def painted(frame, x, y):
+    pixels = bytearray(frame.pixels)
+    offset = (y * frame.width + x) * 4
+    pixels[offset:offset + 4] = b"\x12\x34\x56\xff"
+    return Frame(frame.width, frame.height, bytes(pixels))
+
+
+class ChangedTilesTest(unittest.TestCase):
+    def setUp(self):
+        self.frame = blank(200, 128)
+
+    def test_first_frame(self):
+        self.assertEqual(screen.changed_tiles(None, self.frame, 64), [(0, 0, 200, 128)])
+
+    def test_unchanged_frame(self):
+        self.assertEqual(screen.changed_tiles(self.frame, blank(200, 128), 64), [])
+
+    def test_one_changed_tile(self):
+        self.assertEqual(screen.changed_tiles(self.frame, painted(self.frame, 70, 10), 64), [(64, 0, 64, 64)])
+
+    def test_partial_edge_tile(self):
+        self.assertEqual(screen.changed_tiles(self.frame, painted(self.frame, 199, 127), 64), [(192, 64, 8, 64)])
+
+    def test_neighbouring_tiles_merged(self):
+        current = painted(painted(self.frame, 1, 70), 64, 70)
+        self.assertEqual(screen.changed_tiles(self.frame, current, 64), [(0, 64, 128, 64)])
+
+    def test_separate_tiles(self):
+        current = painted(painted(self.frame, 1, 1), 130, 1)
+        self.assertEqual(screen.changed_tiles(self.frame, current, 64), [(0, 0, 64, 64), (128, 0, 64, 64)])
+
+    def test_size_change(self):
+        self.assertEqual(screen.changed_tiles(self.frame, blank(100, 50), 64), [(0, 0, 100, 50)])
+
+
+class CaptureTest(unittest.TestCase):
+    def test_mss_failure_is_a_capture_error(self):
+        failing = mock.Mock()
+        failing.mss.side_effect = RuntimeError("$DISPLAY not set")
+        with mock.patch.object(screen, "mss", failing):
+            with self.assertRaises(screen.CaptureError):
+                screen.capture()
+
+
+if __name__ == "__main__":
+    unittest.main()
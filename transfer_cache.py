@@ -0,0 +1,199 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_BUDGET = 1024 ** 3  # Bytes of file contents kept in a cache's directory
+MAX_INDEXED_FILES = 10000  # Digests of local files remembered, least recently used forgotten first
+MAX_NAMES = 10000
+HASH_READ_SIZE = 1024 * 1024
+# Files modified this recently are hashed again on every use: another write within the same mtime tick
+# would not change their size or mtime
+RACY_NANOSECONDS = 2 * 10 ** 9
+DELTA_MIN_SIZE = 1024 * 1024  # Smaller files are sent whole when they changed
+DELTA_MAX_RATIO = 0.9  # Deltas this large compared to the file are not worth applying, the file is sent whole
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_atomically(destination, write):
+    """
+    Write a file with write(file) next to destination and move it into place,
+    so readers never see a partial file and a failed write leaves the old one.
+    """
+    directory = os.path.dirname(os.path.abspath(destination))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".transfer-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        # mkstemp creates files only the owner can read, keep the permissions of the file replaced instead
+        if os.path.exists(destination):
+            shutil.copymode(destination, temp_path)
+        else:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class HashingWriter:
+    """
+    Binary file wrapper computing the SHA-256 of everything written through it.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class TransferCache:
+    """
+    Content-addressed store of transferred files, used to skip sending contents the receiving side already has.
+
+    Files are stored in directory under their SHA-256 and evicted least recently used first once they take up
+    more than budget bytes; the order survives restarts through the stored files' mtimes. The digests of
+    local files are remembered per path and only computed again once their size, mtime or inode change.
+    names maps what a file was transferred as, such as a remote path, to the digest of its last contents.
+    """
+    def __init__(self, directory, budget=DEFAULT_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._blobs = None  # Digest -> size, least recently used first, read from directory on first use
+        self._size = 0
+        self._digests = OrderedDict()
+        self._names = OrderedDict()
+
+    def digest(self, path):
+        """
+        The SHA-256 of a local file, hashed only if it changed since it was last asked for.
+        """
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            cached = self._digests.get(path)
+            if cached and cached[0] == key:
+                self._digests.move_to_end(path)
+                return cached[1]
+        digest = hash_file(path)
+        if time.time_ns() - stat.st_mtime_ns >= RACY_NANOSECONDS:
+            with self._lock:
+                self._digests[path] = (key, digest)
+                self._digests.move_to_end(path)
+                while len(self._digests) > MAX_INDEXED_FILES:
+                    self._digests.popitem(last=False)
+        return digest
+
+    def remember(self, name, digest):
+        with self._lock:
+            self._names[name] = digest
+            self._names.move_to_end(name)
+            while len(self._names) > MAX_NAMES:
+                self._names.popitem(last=False)
+
+    def recall(self, name):
+        with self._lock:
+            return self._names.get(name)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _load(self):
+        # Called with the lock held
+        if self._blobs is not None:
+            return
+        found = []
+        if os.path.isdir(self.directory):
+            for prefix in os.scandir(self.directory):
+                if not prefix.is_dir():
+                    continue
+                for entry in os.scandir(prefix.path):
+                    if entry.is_file() and len(entry.name) == 64 and entry.name.startswith(prefix.name):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        self._blobs = OrderedDict((digest, size) for _, digest, size in sorted(found))
+        self._size = sum(self._blobs.values())
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.budget and self._blobs:
+            digest, size = self._blobs.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def has(self, digest):
+        with self._lock:
+            self._load()
+            return digest in self._blobs
+
+    def add(self, path, digest):
+        """
+        Store a copy of the file at path, whose SHA-256 is digest. Files larger than the budget are not stored.
+        """
+        size = os.path.getsize(path)
+        with self._lock:
+            self._load()
+            if digest in self._blobs:
+                self._blobs.move_to_end(digest)
+                return
+        if size > self.budget:
+            return
+        blob_path = self._blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        with open(path, "rb") as source:
+            write_atomically(blob_path, lambda f: shutil.copyfileobj(source, f))
+        with self._lock:
+            if digest not in self._blobs:
+                self._blobs[digest] = size
+                self._size += size
+                self._evict()
+
+    def restore(self, digest, destination):
+        """
+        Write the stored contents with this digest to destination. Returns False if they are not stored.
+        """
+        with self._lock:
+            self._load()
+            if digest not in self._blobs:
+                return False
+            self._blobs.move_to_end(digest)
+        blob_path = self._blob_path(digest)
+        try:
+            blob = open(blob_path, "rb")
+        except FileNotFoundError:
+            # Evicted meanwhile, or removed from the directory by hand
+            with self._lock:
+                size = self._blobs.pop(digest, None)
+                if size is not None:
+                    self._size -= size
+            return False
+        with blob:
+            write_atomically(destination, lambda f: shutil.copyfileobj(blob, f))
+        os.utime(blob_path)  # Most recently used, also for the next process
+        return True
+
+    def path(self, digest):
+        """
+        Where the stored contents with this digest are, None if they are not stored.
+        """
+        return self._blob_path(digest) if self.has(digest) else None